@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: bench_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, io, json, multiprocessing, os, shutil, sys, tempfile, time
+import psr9000.regbank as regbank
+import psr9000.regpatch as regpatch
+import psr9000.synth as synth
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def read_memory_status():
+    '''
+    Returns the current and the peak resident set size of this process in
+    KiB as reported by Linux, or None on other systems.
+    '''
+    try:
+        status_file = open("/proc/self/status", "r")
+    except EnvironmentError:
+        return None
+
+    status = {}
+
+    for line in status_file:
+        if line.startswith("VmRSS:") or line.startswith("VmHWM:"):
+            key, value = line.split(":")
+            status[key] = int(value.split()[0])
+
+    status_file.close()
+    return status.get("VmRSS"), status.get("VmHWM")
+
+def reset_memory_peak():
+    '''
+    Resets the peak resident set size of this process (Linux only). Returns
+    False if that isn't possible.
+    '''
+    try:
+        clear_file = open("/proc/self/clear_refs", "w")
+        clear_file.write("5")
+        clear_file.close()
+    except EnvironmentError:
+        return False
+
+    return True
+
+def text_buffer():
+    '''
+    Returns an in-memory stream for map files.
+    '''
+    if sys.version_info[0] < 3:
+        return io.BytesIO()
+    else:
+        return io.StringIO()
+
+def prepare_map(backup_dir):
+    '''
+    Returns the lines of the registration map of the given backup.
+    '''
+    banks = regbank.read_banks(backup_dir, lazy=True)
+    map_file = text_buffer()
+    regbank.write_registration_map(banks, map_file)
+    return map_file.getvalue().splitlines()
+
+def setup_phase(name, backup_dir, scratch_dir, repeat):
+    '''
+    Returns a function which runs the given phase once. Everything the phase
+    needs is prepared here, so that it isn't measured.
+    '''
+    if name == "read_banks":
+        return lambda: regbank.read_banks(backup_dir)
+    elif name == "read_banks_lazy":
+        return lambda: regbank.read_banks(backup_dir, lazy=True)
+    elif name == "write_registration_map":
+        banks = regbank.read_banks(backup_dir, lazy=True)
+        return lambda: regbank.write_registration_map(banks, text_buffer())
+    elif name == "read_registration_map":
+        map_lines = prepare_map(backup_dir)
+        return lambda: regbank.read_registration_map(map_lines)
+    elif name == "rearrange_registrations":
+        banks = regbank.read_banks(backup_dir)
+        registration_map = regbank.read_registration_map(prepare_map(backup_dir))
+        return lambda: regbank.rearrange_registrations(banks, registration_map)
+    elif name == "write_banks":
+        banks = regbank.read_banks(backup_dir)
+        output_dirs = [os.path.join(scratch_dir, "write_banks.%s.usr" % i) for i in range(repeat)]
+        return lambda: regbank.write_banks(banks, output_dirs.pop())
+    elif name == "write_banks_lazy":
+        banks = regbank.read_banks(backup_dir, lazy=True)
+        output_dirs = [os.path.join(scratch_dir, "write_banks_lazy.%s.usr" % i) for i in range(repeat)]
+        return lambda: regbank.write_banks(banks, output_dirs.pop())
+    elif name == "patch_banks":
+        banks = regbank.read_banks(backup_dir)
+        patches = [(633, bytearray(b"\x31\x0f")), (640, bytearray(b"\x02"))]
+        return lambda: regpatch.patch_banks(banks, patches)
+    else:
+        raise ValueError("Unknown phase: %s" % name)
+
+PHASES = (
+    "read_banks",
+    "read_banks_lazy",
+    "write_registration_map",
+    "read_registration_map",
+    "rearrange_registrations",
+    "write_banks",
+    "write_banks_lazy",
+    "patch_banks",
+)
+
+def run_phase(arguments):
+    '''
+    Runs one phase repeatedly inside a fresh worker process and returns the
+    best time in seconds and the peak memory in KiB. Peak memory is measured
+    with tracemalloc where available. Otherwise the growth of the resident
+    set size of the worker is used, which only works on Linux. The peak is
+    None if it cannot be measured.
+    '''
+    name, backup_dir, scratch_dir, repeat = arguments
+    run = setup_phase(name, backup_dir, scratch_dir, repeat)
+    best = None
+    peak = None
+    start_rss = None
+
+    if tracemalloc:
+        tracemalloc.start()
+    elif reset_memory_peak():
+        start_rss = read_memory_status()[0]
+
+    for i in range(repeat):
+        start = time.time()
+        run()
+        duration = time.time() - start
+
+        if best is None or duration < best:
+            best = duration
+
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    elif start_rss is not None:
+        peak = read_memory_status()[1] - start_rss
+
+    return best, peak
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns a list of messages for all phases which are slower or use more
+    memory than the baseline allows. Differences below one millisecond or
+    256 KiB are ignored as measuring noise.
+    '''
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        if not name in baseline:
+            continue
+
+        if result["seconds"] > baseline[name]["seconds"] * tolerance + 0.001:
+            regressions.append("%s: %.4fs instead of %.4fs" % (name, result["seconds"], baseline[name]["seconds"]))
+
+        if result["peak_kib"] is None or baseline[name]["peak_kib"] is None:
+            continue
+
+        if result["peak_kib"] > baseline[name]["peak_kib"] * tolerance + 256:
+            regressions.append("%s: %s KiB instead of %s KiB" % (name, result["peak_kib"], baseline[name]["peak_kib"]))
+
+    return regressions
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: bench_regs",
+        description = "Benchmark of the registration library with synthetic backups"
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        help    = "Benchmark an existing user data backup instead of a synthetic one",
+    )
+
+    cmd_parser.add_argument(
+        "-f", "--filled",
+        type    = float,
+        default = 0.75,
+        help    = "Share of non-empty registrations in the synthetic backup (default 0.75)",
+    )
+
+    cmd_parser.add_argument(
+        "-r", "--repeat",
+        type    = int,
+        default = 5,
+        help    = "Number of runs per phase, the best one counts (default 5)",
+    )
+
+    cmd_parser.add_argument(
+        "-p", "--phase",
+        action  = "append",
+        choices = PHASES,
+        help    = "Only run the given phase. Can be given several times",
+    )
+
+    cmd_parser.add_argument(
+        "-b", "--baseline",
+        help    = "JSON file with baseline results to compare with",
+    )
+
+    cmd_parser.add_argument(
+        "-s", "--save",
+        action  = "store_true",
+        default = False,
+        help    = "Save the results as new baseline instead of comparing them",
+    )
+
+    cmd_parser.add_argument(
+        "-t", "--tolerance",
+        type    = float,
+        default = 1.5,
+        help    = "Allowed factor between baseline and results (default 1.5)",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+
+    if cmd_arguments.save and not cmd_arguments.baseline:
+        sys.exit("Missing --baseline option is required with --save")
+    elif cmd_arguments.input and not os.path.exists(os.path.join(cmd_arguments.input, "Regist.reg")):
+        sys.exit("No registrations found inside input directory")
+
+    scratch_dir = tempfile.mkdtemp(prefix="bench_regs.")
+
+    try:
+        if cmd_arguments.input:
+            backup_dir = cmd_arguments.input
+        else:
+            backup_dir = os.path.join(scratch_dir, "synthetic.usr")
+            synth.generate_backup(backup_dir, filled=cmd_arguments.filled, seed=9000)
+
+        file_size = os.stat(os.path.join(backup_dir, "Regist.reg")).st_size
+        results = {}
+
+        sys.stdout.write("%-24s %10s %10s %10s\n" % ("Phase", "Seconds", "MiB/s", "Peak KiB"))
+
+        for name in cmd_arguments.phase or PHASES:
+            pool = multiprocessing.Pool(1)
+            seconds, peak = pool.apply(run_phase, [(name, backup_dir, scratch_dir, cmd_arguments.repeat)])
+            pool.close()
+            pool.join()
+
+            throughput = file_size / max(seconds, 1e-9) / 1024 / 1024
+            results[name] = {"seconds": seconds, "peak_kib": peak}
+            sys.stdout.write("%-24s %10.4f %10.1f %10s\n" % (name, seconds, throughput, peak if peak is not None else "n/a"))
+    finally:
+        shutil.rmtree(scratch_dir)
+
+    if cmd_arguments.save:
+        baseline_file = open(cmd_arguments.baseline, "w")
+        json.dump(results, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write("\n")
+        baseline_file.close()
+    elif cmd_arguments.baseline:
+        baseline_file = open(cmd_arguments.baseline, "r")
+        baseline = json.load(baseline_file)
+        baseline_file.close()
+
+        regressions = compare(results, baseline, cmd_arguments.tolerance)
+
+        for regression in regressions:
+            sys.stderr.write("REGRESSION  %s\n" % regression)
+
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: cluster_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, sys
+import psr9000.batch as batch
+import psr9000.regcluster as regcluster
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: cluster_regs",
+        description = "Find PSR-9000 registrations which differ in only a few bytes"
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        nargs   = "+",
+        help    = "Names of user data backups or patterns like \"backups/*.usr\"",
+    )
+
+    cmd_parser.add_argument(
+        "-d", "--distance",
+        type    = int,
+        default = 16,
+        help    = "Maximum number of differing bytes between near-duplicates. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-j", "--jobs",
+        type    = int,
+        default = 0,
+        help    = "Number of worker processes without NumPy (0 = one per CPU, the default)",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+
+    if not cmd_arguments.input:
+        sys.exit("Missing --input option is always required")
+    elif cmd_arguments.distance < 0:
+        sys.exit("Distance must not be negative")
+
+    inputs = batch.expand_inputs(cmd_arguments.input)
+
+    for input_dir in inputs:
+        try:
+            batch.check_input(input_dir)
+        except ValueError as err:
+            sys.exit("%s: %s" % (input_dir, err))
+
+    entries = regcluster.collect_registrations(inputs)
+    clusters = regcluster.cluster_registrations(entries, cmd_arguments.distance, cmd_arguments.jobs)
+    regcluster.write_clusters(clusters, sys.stdout)
+
+    sys.stderr.write("%s of %s registrations in %s clusters\n" % (
+        sum(len(cluster["members"]) for cluster in clusters), len(entries), len(clusters),
+    ))
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: diff_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sys
+import psr9000.batch as batch
+import psr9000.regbank as regbank
+import psr9000.regdiff as regdiff
+
+def parse_reference(reference):
+    '''
+    Parses a registration reference like "03|1" as used in map files and
+    returns the zero-based (bank, registration) tuple.
+    '''
+    fields = reference.split("|")
+
+    if len(fields) != 2:
+        raise ValueError("Registration must be given as bank|registration, e.g. 03|1")
+
+    return int(fields[0]) - 1, int(fields[1]) - 1
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: diff_regs",
+        description = "Simple tool to find the changed bytes between PSR-9000 registrations"
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        help    = "Name of user data backup",
+    )
+
+    cmd_parser.add_argument(
+        "-t", "--other",
+        help    = "Name of second user data backup. Default is to use --input again",
+    )
+
+    cmd_parser.add_argument(
+        "-a", "--old",
+        metavar = "bank|reg",
+        help    = "Registration inside --input, e.g. 03|1",
+    )
+
+    cmd_parser.add_argument(
+        "-b", "--new",
+        metavar = "bank|reg",
+        help    = "Registration inside --other to compare with --old",
+    )
+
+    cmd_parser.add_argument(
+        "-p", "--patch",
+        help    = "Also write a patch file which applies all changes",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+    other = cmd_arguments.other or cmd_arguments.input
+
+    if not cmd_arguments.input:
+        sys.exit("Missing --input option is always required")
+    elif bool(cmd_arguments.old) != bool(cmd_arguments.new):
+        sys.exit("Options --old and --new must be given together")
+    elif not cmd_arguments.old and not cmd_arguments.other:
+        sys.exit("Missing --other option is required to compare whole backups")
+    elif cmd_arguments.patch and os.path.exists(cmd_arguments.patch):
+        sys.exit("Patch file already exists")
+
+    for backup in (cmd_arguments.input, other):
+        try:
+            batch.check_input(backup)
+        except ValueError as err:
+            sys.exit("%s: %s" % (backup, err))
+
+    old_banks = regbank.read_banks(cmd_arguments.input, lazy=True)
+
+    if other == cmd_arguments.input:
+        new_banks = old_banks
+    else:
+        new_banks = regbank.read_banks(other, lazy=True)
+
+    if cmd_arguments.old:
+        try:
+            old_reference = parse_reference(cmd_arguments.old)
+            new_reference = parse_reference(cmd_arguments.new)
+        except ValueError as err:
+            sys.exit(str(err))
+
+        old_index = regbank.RegistrationIndex(old_banks)
+        new_index = regbank.RegistrationIndex(new_banks)
+        pairs = []
+
+        try:
+            old = old_index.find({"bank": old_reference[0], "registration": old_reference[1]})
+            new = new_index.find({"bank": new_reference[0], "registration": new_reference[1]})
+        except KeyError as err:
+            sys.exit(err.args[0])
+
+        if old.empty or new.empty:
+            sys.exit("Empty registrations cannot be compared")
+
+        pairs.append((old_index.banks[old_reference[0]], old, new_index.banks[new_reference[0]], new))
+    else:
+        pairs = regdiff.pair_banks(old_banks, new_banks)
+
+    results = regdiff.diff_pairs(pairs)
+    regdiff.write_diff(results, sys.stdout)
+
+    if cmd_arguments.patch:
+        patch_file = open(cmd_arguments.patch, "w")
+
+        try:
+            regdiff.write_patch_spec(results, patch_file)
+        except ValueError as err:
+            patch_file.close()
+            os.remove(cmd_arguments.patch)
+            sys.exit(str(err))
+
+        patch_file.close()
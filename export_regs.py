@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: export_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sys
+import psr9000.batch as batch
+import psr9000.regexport as regexport
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: export_regs",
+        description = "Export PSR-9000 registrations of many backups for analysis with NumPy"
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        nargs   = "+",
+        help    = "Names of user data backups or patterns like \"backups/*.usr\"",
+    )
+
+    cmd_parser.add_argument(
+        "-o", "--output",
+        help    = "Directory for the exported .npy files",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+
+    if not cmd_arguments.input:
+        sys.exit("Missing --input option is always required")
+    elif not cmd_arguments.output:
+        sys.exit("Missing --output option is always required")
+    elif os.path.exists(cmd_arguments.output):
+        sys.exit("Output directory already exits")
+
+    inputs = batch.expand_inputs(cmd_arguments.input)
+
+    for input_dir in inputs:
+        try:
+            batch.check_input(input_dir)
+        except ValueError as err:
+            sys.exit("%s: %s" % (input_dir, err))
+
+    count = regexport.export_registrations(inputs, cmd_arguments.output)
+    sys.stderr.write("%s registrations of %s backups exported\n" % (count, len(inputs)))
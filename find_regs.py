@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: find_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, sys
+import psr9000.batch as batch
+import psr9000.regsearch as regsearch
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: find_regs",
+        description = "Find PSR-9000 registrations by name across many backups"
+    )
+
+    cmd_parser.add_argument(
+        "query",
+        nargs   = "*",
+        help    = "Words to search for. Without a query the index is only updated",
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        nargs   = "+",
+        default = [],
+        help    = "Names of user data backups or patterns like \"backups/*.usr\" to add to the index",
+    )
+
+    cmd_parser.add_argument(
+        "-x", "--index",
+        default = regsearch.default_index_path(),
+        help    = "Index file. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-f", "--fuzzy",
+        action  = "store_true",
+        default = False,
+        help    = "Find similar names instead of names starting with the query words",
+    )
+
+    cmd_parser.add_argument(
+        "-t", "--threshold",
+        type    = float,
+        default = 0.5,
+        help    = "Minimum similarity between 0 and 1 for --fuzzy. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-n", "--limit",
+        type    = int,
+        default = 0,
+        help    = "Maximum number of printed registrations (0 = all)",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+    inputs = batch.expand_inputs(cmd_arguments.input)
+
+    for input_dir in inputs:
+        try:
+            batch.check_input(input_dir)
+        except ValueError as err:
+            sys.exit("%s: %s" % (input_dir, err))
+
+    index = regsearch.NameIndex.load(cmd_arguments.index)
+
+    if index.update(inputs) or inputs:
+        index.save(cmd_arguments.index)
+
+    for path, error in index.errors:
+        sys.stderr.write("FAILED  %s: %s\n" % (path, error.replace("\n", "; ")))
+
+    if not index.backups:
+        sys.exit("No backups indexed yet, use --input to add some")
+
+    if not cmd_arguments.query:
+        sys.stderr.write("%s registrations of %s backups indexed\n" % (len(index.entries), len(index.backups)))
+        sys.exit(0)
+
+    results = index.search(" ".join(cmd_arguments.query), cmd_arguments.fuzzy, cmd_arguments.threshold)
+
+    if cmd_arguments.limit > 0:
+        results = results[:cmd_arguments.limit]
+
+    regsearch.write_results(results, sys.stdout)
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: fuzz_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sys, time
+import psr9000.batch as batch
+import psr9000.fuzz as fuzz
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: fuzz_regs",
+        description = "Feed randomly damaged registration files to the parser and writer"
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        nargs   = "+",
+        default = [],
+        help    = "Backups used as seeds in addition to synthetic ones, or patterns like \"backups/*.usr\"",
+    )
+
+    cmd_parser.add_argument(
+        "-n", "--cases",
+        type    = int,
+        default = 1000,
+        help    = "Number of random cases (default: 1000)",
+    )
+
+    cmd_parser.add_argument(
+        "-s", "--seed",
+        type    = int,
+        default = None,
+        help    = "Seed of the random generator, to repeat a run (default: random)",
+    )
+
+    cmd_parser.add_argument(
+        "-c", "--corpus",
+        help    = "Directory whose files are checked first and where failing cases are saved",
+    )
+
+    cmd_parser.add_argument(
+        "-t", "--timeout",
+        type    = int,
+        default = 5,
+        help    = "Maximum seconds per case (default: 5)",
+    )
+
+    cmd_parser.add_argument(
+        "-m", "--memory",
+        type    = int,
+        default = 256,
+        help    = "Maximum megabytes a worker may allocate (default: 256, 0 = no limit)",
+    )
+
+    cmd_parser.add_argument(
+        "-j", "--jobs",
+        type    = int,
+        default = 0,
+        help    = "Number of worker processes (0 = one per CPU, the default)",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+
+    if cmd_arguments.seed is None:
+        cmd_arguments.seed = int(time.time())
+
+    seeds = fuzz.synthetic_seeds(seed=cmd_arguments.seed)
+
+    for input_dir in batch.expand_inputs(cmd_arguments.input):
+        try:
+            seeds.append(fuzz.backup_seed(input_dir))
+        except (EnvironmentError, KeyError, ValueError) as err:
+            sys.exit("Cannot read %s: %s" % (input_dir, err))
+
+    failures = 0
+    start = time.time()
+
+    # Known failures first, so that fixed bugs stay fixed
+    if cmd_arguments.corpus:
+        for name, data in fuzz.read_corpus(cmd_arguments.corpus):
+            failure = fuzz.guarded_check(data, timeout=cmd_arguments.timeout)
+
+            if failure is not None:
+                print("CORPUS  %s: %s" % (name, failure))
+                failures += 1
+
+    for name, failure in fuzz.check_seeds(seeds):
+        print("SEED    %s: %s" % (name, failure))
+        failures += 1
+
+    print("Running %s cases with seed %s on %s seed files" % (cmd_arguments.cases, cmd_arguments.seed, len(seeds)))
+
+    known = set()
+    done = 0
+
+    for result in fuzz.run_cases(
+        seeds, cmd_arguments.cases, cmd_arguments.seed, cmd_arguments.jobs,
+        cmd_arguments.timeout, cmd_arguments.memory * 1024 * 1024,
+    ):
+        done += 1
+
+        if result is None:
+            continue
+
+        name, case_seed, failure, data = result
+        failures += 1
+
+        # Report each kind of failure only once, or one bug floods the output
+        if failure in known:
+            continue
+
+        known.add(failure)
+        print("FAILED  case %s of %s: %s" % (case_seed, name, failure))
+
+        if cmd_arguments.corpus:
+            print("        saved as %s (%s bytes)" % (
+                os.path.join(cmd_arguments.corpus, fuzz.add_to_corpus(cmd_arguments.corpus, data, failure)),
+                len(data),
+            ))
+
+    print("\n%s cases run, %s failures (%s distinct) in %.2f seconds" % (
+        done, failures, len(known), time.time() - start,
+    ))
+
+    if failures:
+        sys.exit(1)
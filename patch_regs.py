@@ -16,26 +16,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import argparse, os, sys
+import argparse, os, sys, time
+import psr9000.archive as archive
+import psr9000.batch as batch
+import psr9000.instrument as instrument
 import psr9000.regbank as regbank
+import psr9000.regpatch as regpatch
 
 def patch_banks(banks, start, new_bytes):
     '''
     Takes a list of registration banks as created by read_banks(), an integer
     offset and a bytes object. All non-empty registrations in all banks are
-    patched accordingly.
+    patched accordingly. See regpatch.patch_banks() for applying several
+    patches at once.
     '''
-    start = start - 32
-    end = start + len(new_bytes)
-
-    for bank in banks:
-        for registration in bank["registrations"]:
-            if registration["empty"]:
-                continue
-
-            for new_byte in new_bytes:
-                registration["data"] = registration["data"][:start] \
-                                     + new_bytes + registration["data"][end:]
+    regpatch.patch_banks(banks, [(start, new_bytes)])
 
 if __name__ == "__main__":
     cmd_parser = argparse.ArgumentParser(
@@ -47,13 +42,31 @@ if __name__ == "__main__":
     cmd_parser.add_argument(
         "-i", "--input",
         metavar = "input",
-        help    = "Name of old user data backup",
+        nargs   = "+",
+        help    = "Name of old user data backup. Several names or patterns like "
+                  "\"backups/*.usr\" switch to batch mode",
     )
 
     cmd_parser.add_argument(
         "-o", "--output",
         metavar = "output",
-        help    = "Name of new user data backup",
+        help    = "Name of new user data backup. Directory for all new backups in batch mode",
+    )
+
+    cmd_parser.add_argument(
+        "--in-place",
+        action  = "store_true",
+        default = False,
+        help    = "Patch the input backup instead of creating a new one. Regist.reg is replaced by a "
+                  "patched copy, which costs a full copy on file systems without reflinks (ext4, FAT)",
+    )
+
+    cmd_parser.add_argument(
+        "--direct",
+        action  = "store_true",
+        default = False,
+        help    = "With --in-place, write the patched bytes straight into Regist.reg without a copy. "
+                  "Faster, but an interrupted run leaves a half patched file",
     )
 
     cmd_parser.add_argument(
@@ -69,26 +82,119 @@ if __name__ == "__main__":
         help    = "Hex-string with bytes to be written (e.g. 310f)",
     )
 
+    cmd_parser.add_argument(
+        "-p", "--patch",
+        metavar = "patch",
+        help    = "Patch file with one seek|bytes pair per line",
+    )
+
+    cmd_parser.add_argument(
+        "-j", "--jobs",
+        metavar = "jobs",
+        type    = int,
+        default = 1,
+        help    = "Number of backups processed in parallel in batch mode (0 = one per CPU)",
+    )
+
+    cmd_parser.add_argument(
+        "--profile",
+        nargs   = "?",
+        const   = "table",
+        choices = instrument.PROFILE_FORMATS,
+        help    = "Print a breakdown of the run to StdErr: a table of the library phases (default), "
+                  "the same as JSON or cProfile statistics. Batch workers are not included",
+    )
+
     cmd_arguments = cmd_parser.parse_args()
 
     if not cmd_arguments.input:
         sys.exit("Missing --input option is always required")
-    elif not cmd_arguments.output:
-        sys.exit("Missing --output option is always required")
-    elif not os.path.exists(cmd_arguments.input):
-        sys.exit("Input directory does not exit")
-    elif not os.path.isdir(cmd_arguments.input):
-        sys.exit("Input file is no directory")
-    elif not os.path.exists(os.path.join(cmd_arguments.input, "Regist.reg")):
-        sys.exit("No registrations found inside input directory")
-    elif cmd_arguments.seek < 32:
+    elif not cmd_arguments.output and not cmd_arguments.in_place:
+        sys.exit("Missing --output option is required without --in-place")
+    elif cmd_arguments.output and cmd_arguments.in_place:
+        sys.exit("Options --output and --in-place exclude each other")
+    elif cmd_arguments.direct and not cmd_arguments.in_place:
+        sys.exit("Option --direct can only be used with --in-place")
+    elif not cmd_arguments.patch and cmd_arguments.seek is None:
+        sys.exit("Missing --seek option is required without --patch")
+    elif cmd_arguments.seek is not None and cmd_arguments.seek < 32:
         sys.exit("Seek position must be greater than 32 bytes to skip registration header")
-    elif not cmd_arguments.bytes:
-        sys.exit("Missing --bytes option is always required")
+    elif cmd_arguments.seek is not None and not cmd_arguments.bytes:
+        sys.exit("Missing --bytes option is required with --seek")
+    elif cmd_arguments.patch and not os.path.exists(cmd_arguments.patch):
+        sys.exit("Patch file does not exist")
+
+    if cmd_arguments.profile:
+        instrument.start_profile(cmd_arguments.profile, sys.stderr)
+
+    patches = []
+
+    try:
+        if cmd_arguments.patch:
+            patch_file = open(cmd_arguments.patch, "r")
+            patches = regpatch.read_patch_spec(patch_file)
+            patch_file.close()
+
+        if cmd_arguments.seek is not None:
+            patches.append((cmd_arguments.seek, bytearray.fromhex(cmd_arguments.bytes)))
+
+        patches = regpatch.check_patches(patches)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    inputs = batch.expand_inputs(cmd_arguments.input)
+
+    if len(inputs) > 1:
+        start = time.time()
+
+        if cmd_arguments.in_place:
+            outputs = [None] * len(inputs)
+        else:
+            if not os.path.isdir(cmd_arguments.output):
+                os.mkdir(cmd_arguments.output)
+
+            try:
+                outputs = batch.output_names(inputs, cmd_arguments.output)
+            except ValueError as err:
+                sys.exit(str(err))
+
+        errors = batch.run_batch(
+            batch.patch_backup,
+            [(input_dir, output_dir, patches, cmd_arguments.direct) for input_dir, output_dir in zip(inputs, outputs)],
+            cmd_arguments.jobs,
+        )
+
+        if batch.print_report(inputs, errors, sys.stderr, time.time() - start):
+            sys.exit(1)
+
+        sys.exit(0)
+
+    cmd_arguments.input = inputs[0]
+
+    try:
+        batch.check_input(cmd_arguments.input)
+    except ValueError as err:
+        sys.exit(str(err))
 
     if cmd_arguments.input == cmd_arguments.output:
         sys.stderr.write("WARNING: Input directory is the same as output directory\n")
 
-    banks = regbank.read_banks(cmd_arguments.input)
-    patch_banks(banks, cmd_arguments.seek, bytearray.fromhex(cmd_arguments.bytes))
-    regbank.write_banks(banks, cmd_arguments.output)
+    if cmd_arguments.in_place:
+        try:
+            regpatch.patch_file(cmd_arguments.input, patches, direct=cmd_arguments.direct)
+        except ValueError as err:
+            sys.exit(str(err))
+    elif not archive.is_archive(cmd_arguments.input) and not archive.archive_format(cmd_arguments.output):
+        try:
+            regpatch.patch_file(cmd_arguments.input, patches, cmd_arguments.output)
+        except ValueError as err:
+            sys.exit(str(err))
+    else:
+        banks = regbank.read_banks(cmd_arguments.input)
+
+        try:
+            regpatch.patch_banks(banks, patches)
+        except ValueError as err:
+            sys.exit(str(err))
+
+        regbank.write_banks(banks, cmd_arguments.output, cmd_arguments.input)
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: zip and tar archives of user data backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# tarfile and zipfile are imported where they are needed, so that programs
+# which never touch an archive don't pay for importing them
+import binascii, errno, io, os, posixpath, time
+
+# File name suffixes of supported archives and the tarfile mode to write
+# them. Zip files are written with the zipfile module instead.
+ARCHIVE_FORMATS = (
+    (".zip", "zip"),
+    (".tar", "w"),
+    (".tar.gz", "w:gz"),
+    (".tgz", "w:gz"),
+    (".tar.bz2", "w:bz2"),
+    (".tbz2", "w:bz2"),
+)
+
+def archive_suffix(path):
+    '''
+    Returns the archive suffix the file name ends with, e.g. ".tar.gz", or
+    None if the name has no known archive suffix.
+    '''
+    for suffix, mode in ARCHIVE_FORMATS:
+        if path.lower().endswith(suffix):
+            return suffix
+
+    return None
+
+def archive_format(path):
+    '''
+    Returns the write mode of the archive format matching the file name,
+    or None if the name has no known archive suffix.
+    '''
+    return dict(ARCHIVE_FORMATS).get(archive_suffix(path))
+
+def is_archive(path):
+    '''
+    Returns True if the given backup path names a zip or tar archive instead
+    of a directory. Existing directories are never considered archives,
+    even if their name looks like one.
+    '''
+    return archive_format(path) is not None and not os.path.isdir(path)
+
+class BackupArchive(object):
+    '''
+    Read access to a user data backup inside a zip or tar archive. The
+    backup may be stored at the top of the archive or inside a directory,
+    but the archive must contain exactly one Regist.reg file. Members are
+    read straight from the archive without extracting anything to disk.
+
+    Raises a ValueError if the archive cannot be read or doesn't contain
+    exactly one backup.
+    '''
+
+    def __init__(self, path):
+        import tarfile, zipfile
+
+        self.path = path
+        self._zip = None
+        self._tar = None
+
+        try:
+            if zipfile.is_zipfile(path):
+                self._zip = zipfile.ZipFile(path, "r")
+                sizes = dict(
+                    (info.filename, info.file_size) for info in self._zip.infolist()
+                    if not info.filename.endswith("/")
+                )
+            else:
+                self._tar = tarfile.open(path, "r:*")
+                sizes = dict((info.name, info.size) for info in self._tar.getmembers() if info.isfile())
+        except (tarfile.TarError, zipfile.BadZipfile) as err:
+            raise ValueError("Cannot read archive: %s" % err)
+
+        names = list(sizes)
+        registration_names = [name for name in names if posixpath.basename(name).lower() == "regist.reg"]
+
+        if not registration_names:
+            self.close()
+            raise ValueError("No registrations found inside input archive")
+        elif len(registration_names) > 1:
+            self.close()
+            raise ValueError("Archive contains more than one backup")
+
+        self.prefix = posixpath.dirname(registration_names[0])
+        self.names = {}
+        self.sizes = {}
+
+        for name in names:
+            if posixpath.dirname(name) == self.prefix:
+                self.names[posixpath.basename(name)] = name
+                self.sizes[posixpath.basename(name)] = sizes[name]
+
+    def members(self):
+        '''
+        Returns the sorted file names of the backup, without the directory
+        they are stored in inside the archive.
+        '''
+        return sorted(self.names)
+
+    def find(self, file_name):
+        '''
+        Returns the name of a backup file as stored in the archive. File
+        names are compared case-insensitive, because the instrument writes
+        them in upper case. Raises a KeyError if there is no such file.
+        '''
+        for name in self.names:
+            if name.lower() == file_name.lower():
+                return name
+
+        raise KeyError("Couldn't find %s inside archive %s" % (file_name, self.path))
+
+    def size(self, file_name):
+        '''
+        Returns the uncompressed size of a backup file, as listed in the
+        archive directory. Nothing is decompressed.
+        '''
+        return self.sizes[self.find(file_name)]
+
+    def read(self, file_name):
+        '''
+        Returns the content of a backup file.
+        '''
+        member_name = self.names[self.find(file_name)]
+
+        if self._zip is not None:
+            return self._zip.read(member_name)
+
+        member_file = self._tar.extractfile(member_name)
+        data = member_file.read()
+        member_file.close()
+        return data
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+        if self._tar is not None:
+            self._tar.close()
+
+        self._zip = None
+        self._tar = None
+
+def read_member(path, file_name):
+    '''
+    Returns the content of a single file of the backup inside an archive.
+    '''
+    backup_archive = BackupArchive(path)
+
+    try:
+        return backup_archive.read(file_name)
+    finally:
+        backup_archive.close()
+
+def create_temp_file(path):
+    '''
+    Creates an empty temporary file in the directory of path, so that it
+    can be renamed to path once it is complete, and returns its name. The
+    file gets the same permissions as a new file created at path.
+    '''
+    directory, name = os.path.split(os.path.abspath(path))
+
+    while True:
+        temp_path = os.path.join(directory, ".%s.%s.tmp" % (name, binascii.hexlify(os.urandom(4)).decode("ascii")))
+
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                continue
+
+            raise
+
+        os.close(fd)
+        return temp_path
+
+def write_archive(path, members, files=()):
+    '''
+    Writes a new archive with the given (file name, path) tuples of files,
+    which are streamed from disk, followed by the given iterable of (file
+    name, data) tuples. The format is chosen by the file name (see
+    ARCHIVE_FORMATS). All files are stored at the top of the archive.
+
+    The archive is written to a temporary file next to path, which is only
+    renamed to path when it is complete. So nothing is kept in memory
+    except a single member at a time, and an interrupted run doesn't leave
+    a broken archive behind.
+    '''
+    import tarfile, zipfile
+
+    mode = archive_format(path)
+    now = time.time()
+    temp_path = create_temp_file(path)
+
+    try:
+        if mode == "zip":
+            output_archive = zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED, True)
+
+            for name, file_path in files:
+                output_archive.write(file_path, name)
+
+            for name, data in members:
+                info = zipfile.ZipInfo(name, time.localtime(now)[:6])
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                output_archive.writestr(info, data)
+
+            output_archive.close()
+        else:
+            output_archive = tarfile.open(temp_path, mode)
+
+            def add_member(name, size, data_file):
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = int(now)
+                info.mode = 0o644
+                output_archive.addfile(info, data_file)
+
+            for name, file_path in files:
+                data_file = open(file_path, "rb")
+                add_member(name, os.fstat(data_file.fileno()).st_size, data_file)
+                data_file.close()
+
+            for name, data in members:
+                add_member(name, len(data), io.BytesIO(data))
+
+            output_archive.close()
+
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: parallel processing of many backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import glob, multiprocessing, os
+import psr9000.archive as archive
+import psr9000.cache as cache
+import psr9000.regbank as regbank
+import psr9000.regpatch as regpatch
+
+def expand_inputs(patterns):
+    '''
+    Takes a list of backup directories or glob patterns like "backups/*.usr"
+    and returns the list of matching directories. The order is kept and
+    duplicates are removed. Patterns without any match are returned as they
+    are, so that they can be reported as missing later.
+    '''
+    inputs = []
+
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+
+        for match in matches:
+            if not match in inputs:
+                inputs.append(match)
+
+    return inputs
+
+def output_names(inputs, output_dir):
+    '''
+    Returns the output path for each input directory. Each backup is
+    created inside output_dir with the same name as its input directory.
+    Raises a ValueError if two inputs share the same name.
+    '''
+    outputs = []
+
+    for input_dir in inputs:
+        output = os.path.join(output_dir, os.path.basename(os.path.normpath(input_dir)))
+
+        if output in outputs:
+            raise ValueError("Input backups with the same name: %s" % os.path.basename(output))
+
+        outputs.append(output)
+
+    return outputs
+
+def check_input(input_dir):
+    '''
+    Raises a ValueError if the directory is no user data backup. Zip and tar
+    archives must contain exactly one backup (see archive.BackupArchive).
+    '''
+    if not os.path.exists(input_dir):
+        raise ValueError("Input directory does not exit")
+    elif archive.is_archive(input_dir):
+        archive.BackupArchive(input_dir).close()
+    elif not os.path.isdir(input_dir):
+        raise ValueError("Input file is no directory")
+    elif not os.path.exists(os.path.join(input_dir, "Regist.reg")):
+        raise ValueError("No registrations found inside input directory")
+
+def read_input(input_dir, use_cache=False):
+    '''
+    Reads a backup lazily, optionally through the index cache (see
+    cache.read_banks_cached()). Archives are never cached, because their
+    Regist.reg must be read into memory anyway.
+    '''
+    if use_cache and not archive.is_archive(input_dir):
+        return cache.read_banks_cached(input_dir)
+    else:
+        return regbank.read_banks(input_dir, lazy=True)
+
+def split_backup(input_dir, map_path, use_cache=False):
+    '''
+    Batch job: Writes the registration map of a backup to a new file.
+    '''
+    check_input(input_dir)
+
+    if os.path.exists(map_path):
+        raise ValueError("Map file already exists")
+
+    banks = read_input(input_dir, use_cache)
+    map_file = open(map_path, "w")
+    regbank.write_registration_map(banks, map_file)
+    map_file.close()
+
+def create_backup(input_dir, output_dir, registration_map, use_cache=False):
+    '''
+    Batch job: Creates a new backup with rearranged registrations from a
+    registration map as created by read_registration_map().
+    '''
+    check_input(input_dir)
+
+    if os.path.exists(output_dir):
+        raise ValueError("Output directory already exits")
+
+    banks = read_input(input_dir, use_cache)
+    new_banks = regbank.rearrange_registrations(banks, registration_map)
+    regbank.write_banks(new_banks, output_dir, input_dir)
+
+def patch_backup(input_dir, output_dir, patches, direct=False):
+    '''
+    Batch job: Patches all registrations of a backup. Without output_dir the
+    backup is patched in place, or directly inside Regist.reg with
+    direct=True. Plain directories are patched by copying only Regist.reg
+    and writing the patched bytes (see regpatch.patch_file()), archives are
+    read and written as a whole.
+    '''
+    check_input(input_dir)
+
+    if output_dir is None:
+        regpatch.patch_file(input_dir, patches, direct=direct)
+    elif not archive.is_archive(input_dir) and not archive.archive_format(output_dir):
+        regpatch.patch_file(input_dir, patches, output_dir)
+    else:
+        banks = regbank.read_banks(input_dir)
+        regpatch.patch_banks(banks, patches)
+        regbank.write_banks(banks, output_dir, input_dir)
+
+def run_job(job):
+    '''
+    Runs a single (function, arguments) job and returns None on success or
+    an error message. Errors are caught here so that one broken backup
+    doesn't abort the whole batch.
+    '''
+    function, arguments = job
+
+    try:
+        function(*arguments)
+    except (EnvironmentError, KeyError, ValueError) as err:
+        if isinstance(err, KeyError):
+            return err.args[0]
+        else:
+            return str(err)
+    except Exception as err:
+        return "%s: %s" % (err.__class__.__name__, err)
+
+    return None
+
+def run_batch(function, argument_list, jobs=1):
+    '''
+    Calls the given module-level function once for each tuple in
+    argument_list. With jobs > 1 the calls are distributed across a pool of
+    worker processes, so that many backups can be processed on all cores.
+    With jobs = 0 one worker per CPU is used.
+
+    Returns a list with one error message or None per call, in the order of
+    argument_list.
+    '''
+    work = [(function, arguments) for arguments in argument_list]
+
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs == 1 or len(work) < 2:
+        return [run_job(job) for job in work]
+
+    pool = multiprocessing.Pool(min(jobs, len(work)))
+
+    try:
+        return pool.map(run_job, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def print_report(names, errors, stream, duration=None):
+    '''
+    Prints one line per backup and a final summary. Returns the number of
+    failed backups.
+    '''
+    failed = 0
+
+    for name, error in zip(names, errors):
+        if error is None:
+            stream.write("OK      %s\n" % name)
+        else:
+            failed += 1
+            stream.write("FAILED  %s: %s\n" % (name, error.replace("\n", "; ")))
+
+    stream.write("\n%s backups processed, %s succeeded, %s failed" % (len(names), len(names) - failed, failed))
+
+    if duration is not None:
+        stream.write(" in %.2f seconds" % duration)
+
+    stream.write("\n")
+    return failed
@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: persistent cache of parsed registration indices (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib, os, pickle, tempfile
+import psr9000.regbank as regbank
+
+# Default upper limit for the size of all cache entries together
+MAX_CACHE_SIZE = 16 * 1024 * 1024
+
+def default_cache_dir():
+    '''
+    Returns the directory where cache entries are stored by default. That is
+    $XDG_CACHE_HOME/psr-tools or ~/.cache/psr-tools.
+    '''
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "psr-tools")
+
+def cache_key(registration_path):
+    '''
+    Returns the cache key of a Regist.reg file. It is built from the absolute
+    path, size, inode and modification time of the file plus a hash of the
+    3088 bytes long bank directory at its beginning. So re-saved backups are
+    detected even if their time stamps didn't change. The modification time
+    is used with full precision: nanoseconds where available, otherwise
+    repr() of the float, as "%s" rounds it to centiseconds on Python 2.
+    '''
+    stat = os.stat(registration_path)
+    mtime = getattr(stat, "st_mtime_ns", None)
+
+    if mtime is None:
+        mtime = repr(stat.st_mtime)
+
+    registration_file = open(registration_path, "rb")
+    directory = registration_file.read(0x0C10)
+    registration_file.close()
+
+    key = hashlib.sha1()
+    key.update(os.path.abspath(registration_path).encode("utf-8"))
+    key.update(("|%s|%s|%s|" % (stat.st_size, mtime, stat.st_ino)).encode("utf-8"))
+    key.update(directory)
+
+    return key.hexdigest(), stat.st_size
+
+def dump_index(banks):
+    '''
+    Reduces a lazily read bank list to tuples of plain values which can be
+    pickled.
+    '''
+    index = []
+
+    for bank in banks:
+        registrations = []
+
+        for registration in bank.registrations:
+            registrations.append((
+                registration.number,
+                registration.empty,
+                registration.name,
+                registration.size,
+                registration.offset,
+            ))
+
+        index.append((bank.number, bank.name, bank.position, bank.size, registrations))
+
+    return index
+
+def load_index(index, registration_path, size):
+    '''
+    Creates a lazy bank list from the tuples created by dump_index(). The
+    Regist.reg file is only opened once a payload is accessed.
+    '''
+    source = regbank.RegistrationFile(registration_path, size)
+    banks = []
+
+    for bank_number, bank_name, bank_position, bank_size, registrations in index:
+        bank = regbank.Bank(bank_number, bank_name, bank_position, bank_size)
+
+        for reg_number, reg_empty, reg_name, reg_size, reg_offset in registrations:
+            bank.registrations.append(regbank.Registration(
+                reg_number, reg_empty, reg_name, reg_size, None, None, reg_offset, source,
+            ))
+
+        banks.append(bank)
+
+    return banks
+
+def evict(cache_dir, max_size, suffix=".idx"):
+    '''
+    Deletes the least recently used cache entries until all remaining
+    entries together are not larger than max_size bytes. Only files with
+    the given suffix are considered entries.
+    '''
+    entries = []
+    total_size = 0
+
+    for name in os.listdir(cache_dir):
+        if not name.endswith(suffix):
+            continue
+
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total_size += stat.st_size
+
+    entries.sort()
+
+    while entries and total_size > max_size:
+        mtime, size, name = entries.pop(0)
+
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+
+        total_size -= size
+
+def read_banks_cached(input_dir, cache_dir=None, max_size=MAX_CACHE_SIZE):
+    '''
+    Same as read_banks(input_dir, lazy=True) but the parsed index of banks
+    and registrations is kept in an on-disk cache. Once a backup has been
+    read, it isn't parsed again until it changes. Instead the index is
+    loaded from the cache and the Regist.reg file isn't even opened until a
+    registration payload is really needed.
+
+    Cache entries are marked as used on each hit and the least recently
+    used entries are deleted when all entries together grow larger than
+    max_size bytes. Broken entries are silently ignored and replaced.
+    '''
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    registration_path = os.path.join(input_dir, "Regist.reg")
+    key, size = cache_key(registration_path)
+    entry_path = os.path.join(cache_dir, key + ".idx")
+
+    try:
+        entry_file = open(entry_path, "rb")
+
+        try:
+            index = pickle.load(entry_file)
+        finally:
+            entry_file.close()
+
+        os.utime(entry_path, None)
+        return load_index(index, registration_path, size)
+    except Exception:
+        pass
+
+    banks = regbank.read_banks(input_dir, lazy=True)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=cache_dir)
+    temp_file = os.fdopen(fd, "wb")
+    pickle.dump(dump_index(banks), temp_file, 2)
+    temp_file.close()
+    os.rename(temp_path, entry_path)
+
+    evict(cache_dir, max_size)
+    return banks
@@ -0,0 +1,343 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: single entry point with chainable stages (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Modules of the library are imported by the functions which need them, so
+# that --help and invalid command lines return at once and each run only
+# imports what its stages use.
+import argparse, os, sys
+
+# Command line argument which separates chained stages
+STAGE_SEPARATOR = "+"
+
+# Same as instrument.PROFILE_FORMATS, which is only imported for --profile
+PROFILE_FORMATS = ("table", "json", "cprofile")
+
+EPILOG = '''\
+Stages are chained with "%(separator)s" and run on the same banks in memory, so the
+backup is read and written only once:
+
+  psr-tools -i old.usr -o new.usr patch -p pedal.patch %(separator)s create -m regs.map
+
+Without --input or --output the banks are read from StdIn or written to
+StdOut as the content of a Regist.reg file, so that stages can also be
+connected with pipes:
+
+  psr-tools -i old.usr patch -p pedal.patch | psr-tools -f old.usr -o new.usr create -m regs.map
+''' % {"separator": STAGE_SEPARATOR}
+
+def binary_stream(stream):
+    '''
+    Returns the binary stream behind StdIn or StdOut. On Python 2 these are
+    binary already.
+    '''
+    return getattr(stream, "buffer", stream)
+
+def split_stages(argv):
+    '''
+    Splits the command line at each STAGE_SEPARATOR and returns a list with
+    the arguments of each stage.
+    '''
+    stages = [[]]
+
+    for argument in argv:
+        if argument == STAGE_SEPARATOR:
+            stages.append([])
+        else:
+            stages[-1].append(argument)
+
+    return stages
+
+def build_parser(chained=False):
+    '''
+    Returns the argument parser for the first stage, which also takes the
+    options of the whole run, or with chained=True for all further stages.
+    '''
+    if chained:
+        cmd_parser = argparse.ArgumentParser(prog="psr-tools ... %s" % STAGE_SEPARATOR)
+    else:
+        cmd_parser = argparse.ArgumentParser(
+            prog            = "psr-tools",
+            description     = "Chainable tools to work with PSR-9000 user data backups",
+            epilog          = EPILOG,
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+        )
+
+        cmd_parser.add_argument(
+            "-i", "--input",
+            help    = "User data backup to read. Default is to read Regist.reg content from StdIn",
+        )
+
+        cmd_parser.add_argument(
+            "-o", "--output",
+            help    = "New user data backup. Default is to write Regist.reg content to StdOut",
+        )
+
+        cmd_parser.add_argument(
+            "-f", "--files",
+            help    = "Backup whose other files (styles, songs, ...) are carried over to --output. "
+                      "Default is the --input backup",
+        )
+
+        cmd_parser.add_argument(
+            "--cache",
+            action  = "store_true",
+            default = False,
+            help    = "Keep the parsed index of the input backup in a cache to speed up repeated runs",
+        )
+
+        cmd_parser.add_argument(
+            "--profile",
+            nargs   = "?",
+            const   = "table",
+            choices = PROFILE_FORMATS,
+            help    = "Print a breakdown of the run to StdErr: a table of the library phases (default), "
+                      "the same as JSON or cProfile statistics",
+        )
+
+    stage_parsers = cmd_parser.add_subparsers(dest="stage", title="stages", metavar="STAGE")
+
+    split_parser = stage_parsers.add_parser(
+        "split",
+        help    = "Print the registration map (only as last stage)",
+    )
+
+    split_parser.add_argument(
+        "-m", "--map",
+        help    = "Map file to write. Default is to write StdOut",
+    )
+
+    create_parser = stage_parsers.add_parser(
+        "create",
+        help    = "Rearrange registrations as listed in a map file",
+    )
+
+    create_parser.add_argument(
+        "-m", "--map",
+        help    = "Map file. Default is to read StdIn, unless the banks are read from there",
+    )
+
+    patch_parser = stage_parsers.add_parser(
+        "patch",
+        help    = "Patch all non-empty registrations",
+    )
+
+    patch_parser.add_argument(
+        "-s", "--seek",
+        type    = int,
+        help    = "Seek position inside each registration",
+    )
+
+    patch_parser.add_argument(
+        "-b", "--bytes",
+        help    = "Hex-string with bytes to be written (e.g. 310f)",
+    )
+
+    patch_parser.add_argument(
+        "-p", "--patch",
+        help    = "Patch file with one seek|bytes pair per line",
+    )
+
+    return cmd_parser
+
+def check_stage(arguments):
+    '''
+    Raises a ValueError if the options of a stage don't fit together, so
+    that mistakes are reported before anything is read.
+    '''
+    if arguments.stage == "create":
+        if arguments.map and not os.path.exists(arguments.map):
+            raise ValueError("Map file does not exist")
+    elif arguments.stage == "split":
+        if arguments.map and os.path.exists(arguments.map):
+            raise ValueError("Map file already exists")
+    elif arguments.stage == "patch":
+        if not arguments.patch and arguments.seek is None:
+            raise ValueError("Missing --seek option is required without --patch")
+        elif arguments.seek is not None and arguments.seek < 32:
+            raise ValueError("Seek position must be greater than 32 bytes to skip registration header")
+        elif arguments.seek is not None and not arguments.bytes:
+            raise ValueError("Missing --bytes option is required with --seek")
+        elif arguments.patch and not os.path.exists(arguments.patch):
+            raise ValueError("Patch file does not exist")
+    else:
+        raise ValueError("Missing stage")
+
+def run_split(banks, arguments):
+    '''
+    Stage: Writes the registration map of the banks. Returns None, because
+    nothing can follow.
+    '''
+    import psr9000.regbank as regbank
+
+    if arguments.map:
+        map_file = open(arguments.map, "w")
+        regbank.write_registration_map(banks, map_file)
+        map_file.close()
+    else:
+        regbank.write_registration_map(banks, sys.stdout)
+
+    return None
+
+def run_create(banks, arguments):
+    '''
+    Stage: Returns the banks rearranged according to the map file (see
+    rearrange_registrations()).
+    '''
+    import psr9000.regbank as regbank
+
+    if arguments.map:
+        map_file = open(arguments.map, "r")
+    else:
+        map_file = sys.stdin
+
+    try:
+        registration_map = regbank.read_registration_map(map_file)
+    finally:
+        if arguments.map:
+            map_file.close()
+
+    return regbank.rearrange_registrations(banks, registration_map)
+
+def run_patch(banks, arguments):
+    '''
+    Stage: Patches all non-empty registrations of the banks in place (see
+    regpatch.patch_banks()) and returns them.
+    '''
+    import psr9000.regpatch as regpatch
+
+    patches = []
+
+    if arguments.patch:
+        patch_file = open(arguments.patch, "r")
+
+        try:
+            patches = regpatch.read_patch_spec(patch_file)
+        finally:
+            patch_file.close()
+
+    if arguments.seek is not None:
+        patches.append((arguments.seek, bytearray.fromhex(arguments.bytes)))
+
+    regpatch.patch_banks(banks, patches)
+    return banks
+
+# Functions running the stages, which take the list of banks and the parsed
+# arguments of the stage and return the new list of banks
+STAGES = {
+    "split": run_split,
+    "create": run_create,
+    "patch": run_patch,
+}
+
+def read_input(options):
+    '''
+    Reads the banks from the input backup lazily, or from StdIn.
+    '''
+    if options.input is None:
+        import psr9000.regbank as regbank
+        return regbank.read_registration_stream(binary_stream(sys.stdin))
+
+    import psr9000.batch as batch
+    batch.check_input(options.input)
+    return batch.read_input(options.input, options.cache)
+
+def write_output(banks, options):
+    '''
+    Writes the banks to the output backup, or to StdOut.
+    '''
+    import psr9000.regbank as regbank
+
+    if options.output is None:
+        regbank.write_registration_stream(banks, binary_stream(sys.stdout))
+    else:
+        regbank.write_banks(banks, options.output, options.files or options.input)
+
+def parse_command_line(argv):
+    '''
+    Returns the options of the run and a list with the parsed arguments of
+    each stage. Exits with a message if the command line is invalid.
+    '''
+    segments = split_stages(argv)
+    options = build_parser().parse_args(segments[0])
+    stages = [options] + [build_parser(chained=True).parse_args(segment) for segment in segments[1:]]
+
+    for name in ("input", "output", "files"):
+        if getattr(options, name) == "-":
+            setattr(options, name, None)
+
+    try:
+        for arguments in stages:
+            check_stage(arguments)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    last_stage = stages[-1].stage
+    stdin_readers = len([arguments for arguments in stages if arguments.stage == "create" and not arguments.map])
+
+    if options.input is None:
+        stdin_readers += 1
+
+    if "split" in [arguments.stage for arguments in stages[:-1]]:
+        sys.exit("Stage split can only be the last stage")
+    elif last_stage == "split" and (options.output or options.files):
+        sys.exit("Options --output and --files cannot be used when the last stage is split")
+    elif stdin_readers > 1:
+        sys.exit("StdIn can only be read once, use --input or --map")
+    elif options.input is None and sys.stdin.isatty():
+        sys.exit("Missing --input option is required unless StdIn is a pipe")
+    elif options.output is None and last_stage != "split" and sys.stdout.isatty():
+        sys.exit("Missing --output option is required unless StdOut is a pipe")
+    elif options.input is not None and options.input == options.output:
+        sys.exit("Input must be different from output")
+    elif options.output and os.path.exists(options.output):
+        sys.exit("Output directory already exists")
+    elif options.files and not os.path.exists(options.files):
+        sys.exit("Backup given with --files does not exist")
+
+    return options, stages
+
+def main(argv=None):
+    '''
+    Runs the stages given on the command line (by default sys.argv) one
+    after another on the same list of banks. The input is read once before
+    the first stage and the result of the last stage is written once.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    options, stages = parse_command_line(argv)
+
+    if options.profile:
+        import psr9000.instrument as instrument
+        instrument.start_profile(options.profile, sys.stderr)
+
+    try:
+        banks = read_input(options)
+
+        for arguments in stages:
+            banks = STAGES[arguments.stage](banks, arguments)
+
+        if banks is not None:
+            write_output(banks, options)
+    except KeyError as err:
+        sys.exit(err.args[0])
+    except (EnvironmentError, ValueError) as err:
+        sys.exit(str(err))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: fuzzing of the registration parser and writer (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib, io, multiprocessing, os, random, signal, struct, traceback
+import psr9000.archive as archive
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Values written into size and position fields. They are chosen to hit
+# the limits of the format and of the signed 32 bit fields.
+BOUNDARY_VALUES = (0, 1, -1, 21, 22, 23, 48, 573, 0x0C10, 0x7fffffff, -0x80000000)
+
+# Number of mutations applied to a seed for each case
+MAX_MUTATIONS = 8
+
+class CaseTimeout(Exception):
+    pass
+
+def synthetic_seeds(count=4, seed=0):
+    '''
+    Returns a list of (name, data) tuples with the Regist.reg content of
+    small synthetic backups (see synth.generate_banks()).
+    '''
+    rng = random.Random(seed)
+    seeds = []
+
+    for i in range(count):
+        banks = synth.generate_banks(
+            bank_count=rng.randint(1, 6), filled=rng.random(), variation=4, seed=rng.getrandbits(32),
+        )
+
+        registration_file = io.BytesIO()
+        regbank.write_registration_file(banks, registration_file)
+        seeds.append(("synthetic-%s" % i, registration_file.getvalue()))
+
+    return seeds
+
+def backup_seed(input_dir):
+    '''
+    Returns a (name, data) tuple with the Regist.reg content of a backup
+    directory or archive.
+    '''
+    if archive.is_archive(input_dir):
+        return input_dir, archive.read_member(input_dir, "Regist.reg")
+
+    registration_file = open(os.path.join(input_dir, "Regist.reg"), "rb")
+    data = registration_file.read()
+    registration_file.close()
+    return input_dir, data
+
+def field_offsets(data):
+    '''
+    Returns the offsets of the size and position fields of the bank
+    directory and of the registration headers of a valid Regist.reg file.
+    Mutating these is much more likely to hit a bug than random bytes.
+    '''
+    offsets = []
+
+    try:
+        banks = regbank.read_registration_file(regbank.RegistrationBuffer("seed", data), lazy=True)
+    except ValueError:
+        return offsets
+
+    for i in range(64):
+        offsets.extend((i * 48 + 16, i * 48 + 20))
+
+    for bank in banks:
+        for registration in bank.registrations:
+            offsets.extend((registration.offset, registration.offset + 6))
+
+    return offsets
+
+def random_mutation(data, rng, offsets):
+    '''
+    Returns a random mutation of the data, as a tuple which can be applied
+    with apply_mutations().
+    '''
+    kind = rng.choice(("flip", "byte", "field", "field", "truncate", "delete", "insert"))
+    length = max(len(data), 1)
+
+    if kind == "flip":
+        return ("flip", rng.randrange(length), rng.randrange(8))
+    elif kind == "byte":
+        return ("byte", rng.randrange(length), rng.getrandbits(8))
+    elif kind == "field":
+        offset = rng.choice(offsets) if offsets else rng.randrange(length)
+
+        if rng.random() < 0.7:
+            value = rng.choice(BOUNDARY_VALUES + (len(data), len(data) - offset))
+        else:
+            value = rng.randint(-0x80000000, 0x7fffffff)
+
+        return ("field", offset, max(-0x80000000, min(0x7fffffff, value)))
+    elif kind == "truncate":
+        return ("truncate", rng.randrange(length))
+    elif kind == "delete":
+        return ("delete", rng.randrange(length), rng.randint(1, 64))
+    else:
+        return ("insert", rng.randrange(length), rng.randint(1, 64), rng.getrandbits(8))
+
+def apply_mutations(data, mutations):
+    '''
+    Applies a list of mutations as created by random_mutation() in order.
+    Mutations which don't fit the data anymore are skipped.
+    '''
+    data = bytearray(data)
+
+    for mutation in mutations:
+        kind, offset = mutation[:2]
+
+        if kind == "truncate":
+            del data[offset:]
+        elif offset >= len(data):
+            continue
+        elif kind == "flip":
+            data[offset] ^= 1 << mutation[2]
+        elif kind == "byte":
+            data[offset] = mutation[2]
+        elif kind == "field":
+            data[offset:offset + 4] = struct.pack(">l", mutation[2])[:len(data) - offset]
+        elif kind == "delete":
+            del data[offset:offset + mutation[2]]
+        elif kind == "insert":
+            data[offset:offset] = bytearray([mutation[3]]) * mutation[2]
+
+    return bytes(data)
+
+def write_registrations(banks):
+    registration_file = io.BytesIO()
+    regbank.write_registration_file(banks, registration_file)
+    return registration_file.getvalue()
+
+def read_registrations(data):
+    return regbank.read_registration_file(regbank.RegistrationBuffer("fuzz", data))
+
+def bank_model(banks):
+    '''
+    Returns what must survive writing and reading a bank list: the numbers
+    and names of all banks and registrations and the payloads of non-empty
+    registrations. Registrations without a name are written as empty ones.
+    '''
+    model = []
+
+    for bank in banks:
+        registrations = []
+
+        for registration in bank.registrations:
+            if registration.empty or not registration.name:
+                registrations.append((registration.number, None, None))
+            else:
+                registrations.append((registration.number, registration.name, bytes(registration.data)))
+
+        model.append((bank.number, bank.name, registrations))
+
+    return model
+
+def check_data(data, exact=False):
+    '''
+    Checks the parser and writer with the content of a Regist.reg file.
+    Returns None if everything is fine, otherwise a failure message which
+    starts with its kind:
+
+      crash:     reading or writing raised something else than a ValueError
+      invalid:   the file written from the parsed banks cannot be read
+      changed:   reading the written file returns other registrations
+      unstable:  reading and writing the written file again changes it
+      roundtrip: with exact=True, the written file differs from the input
+
+    Files which are rejected with a ValueError are fine.
+    '''
+    def last_line():
+        return traceback.format_exc().strip().splitlines()[-1]
+
+    try:
+        banks = read_registrations(data)
+    except ValueError:
+        return None
+    except Exception:
+        return "crash: reading: %s" % last_line()
+
+    try:
+        written = write_registrations(banks)
+    except Exception:
+        return "crash: writing: %s" % last_line()
+
+    if exact and written != data:
+        return "roundtrip: written file differs from the input"
+
+    try:
+        reread = read_registrations(written)
+    except ValueError as err:
+        return "invalid: %s" % err
+    except Exception:
+        return "crash: rereading: %s" % last_line()
+
+    if bank_model(reread) != bank_model(banks):
+        return "changed: the written file contains other registrations"
+
+    rewritten = write_registrations(reread)
+
+    if rewritten != written:
+        return "unstable: rewriting the written file changes it"
+
+    return None
+
+def failure_kind(failure):
+    return failure.split(":", 1)[0]
+
+def guarded_check(data, exact=False, timeout=5):
+    '''
+    Runs check_data() with a time limit (SIGALRM, where available). Memory
+    is limited for the whole worker process (see init_worker()).
+    '''
+    def on_alarm(signum, frame):
+        raise CaseTimeout()
+
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, on_alarm)
+        signal.alarm(timeout)
+
+    try:
+        return check_data(data, exact)
+    except CaseTimeout:
+        return "timeout: more than %s seconds" % timeout
+    except MemoryError:
+        return "memory: memory limit exceeded"
+    finally:
+        if hasattr(signal, "SIGALRM"):
+            signal.alarm(0)
+
+def minimize(seed_data, mutations, failure, timeout=5):
+    '''
+    Reduces a failing case to as few mutations as possible which still
+    fail the same way, by trying to leave out each mutation. Then the file
+    is cut at the end as far as possible. Returns the smallest failing data.
+    '''
+    kind = failure_kind(failure)
+
+    def fails(data):
+        result = guarded_check(data, timeout=timeout)
+        return result is not None and failure_kind(result) == kind
+
+    i = 0
+
+    while i < len(mutations):
+        candidate = mutations[:i] + mutations[i + 1:]
+
+        if fails(apply_mutations(seed_data, candidate)):
+            mutations = candidate
+        else:
+            i += 1
+
+    data = apply_mutations(seed_data, mutations)
+    step = len(data) // 2
+
+    while step >= 1:
+        if len(data) > step and fails(data[:-step]):
+            data = data[:-step]
+        else:
+            step //= 2
+
+    return data
+
+def init_worker(memory_limit):
+    '''
+    Limits the address space of a worker process to its current size plus
+    memory_limit bytes, so that a case which allocates too much fails with a
+    MemoryError instead of taking down the machine.
+    '''
+    if resource is None or not memory_limit:
+        return
+
+    try:
+        statm = open("/proc/self/statm")
+        current = int(statm.read().split()[0]) * resource.getpagesize()
+        statm.close()
+    except (EnvironmentError, ValueError):
+        return
+
+    resource.setrlimit(resource.RLIMIT_AS, (current + memory_limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+# Seeds of the current worker process, set by run_cases()
+worker_seeds = []
+
+def init_seeds(seeds, memory_limit):
+    global worker_seeds
+    worker_seeds = [(name, data, field_offsets(data)) for name, data in seeds]
+    init_worker(memory_limit)
+
+def run_case(arguments):
+    '''
+    Pool job: Mutates a seed with a random generator initialized from
+    case_seed and checks the result. Returns None or a (seed name, case
+    seed, failure, minimized data) tuple.
+    '''
+    case_seed, timeout = arguments
+    rng = random.Random(case_seed)
+    name, seed_data, offsets = rng.choice(worker_seeds)
+    mutations = [random_mutation(seed_data, rng, offsets) for i in range(rng.randint(1, MAX_MUTATIONS))]
+    failure = guarded_check(apply_mutations(seed_data, mutations), timeout=timeout)
+
+    if failure is None:
+        return None
+
+    return name, case_seed, failure, minimize(seed_data, mutations, failure, timeout)
+
+def run_cases(seeds, cases, seed=0, jobs=0, timeout=5, memory_limit=256 * 1024 * 1024):
+    '''
+    Runs the given number of random cases on a pool of jobs worker
+    processes (0 = one per CPU). Yields None for each passed case and a
+    tuple as returned by run_case() for each failure.
+    '''
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    rng = random.Random(seed)
+    work = [(rng.getrandbits(48), timeout) for i in range(cases)]
+    pool = multiprocessing.Pool(jobs, init_seeds, (seeds, memory_limit))
+
+    try:
+        for result in pool.imap_unordered(run_case, work, 8):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def check_seeds(seeds):
+    '''
+    Returns a list of (name, failure) tuples for all seeds which don't
+    survive a round trip through read_banks() and write_banks() with the
+    same bytes.
+    '''
+    failures = []
+
+    for name, data in seeds:
+        failure = guarded_check(data, exact=True)
+
+        if failure is not None:
+            failures.append((name, failure))
+
+    return failures
+
+def corpus_name(data):
+    return hashlib.sha1(data).hexdigest()[:16] + ".reg"
+
+def read_corpus(corpus_dir):
+    '''
+    Returns a list of (name, data) tuples of all files in a corpus directory.
+    '''
+    corpus = []
+
+    if not os.path.isdir(corpus_dir):
+        return corpus
+
+    for name in sorted(os.listdir(corpus_dir)):
+        if not name.endswith(".reg"):
+            continue
+
+        corpus_file = open(os.path.join(corpus_dir, name), "rb")
+        corpus.append((name, corpus_file.read()))
+        corpus_file.close()
+
+    return corpus
+
+def add_to_corpus(corpus_dir, data, failure):
+    '''
+    Stores a failing input in the corpus directory together with a text
+    file describing the failure. Returns the file name.
+    '''
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    name = corpus_name(data)
+    corpus_file = open(os.path.join(corpus_dir, name), "wb")
+    corpus_file.write(data)
+    corpus_file.close()
+
+    note_file = open(os.path.join(corpus_dir, name[:-4] + ".txt"), "w")
+    note_file.write(failure + "\n")
+    note_file.close()
+
+    return name
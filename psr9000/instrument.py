@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: instrumentation of the registration library (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit, functools, json, threading, time
+
+# Counters reported by the library functions. Only system calls made
+# directly by the library are counted, not the ones of buffered file
+# objects. Objects are the banks, registrations and map entries created.
+COUNTERS = ("bytes_read", "bytes_written", "syscalls", "objects")
+
+# Profile output formats of the --profile option
+PROFILE_FORMATS = ("table", "json", "cprofile")
+
+# Registered hooks. Each hook is called as hook(event, name, value) with:
+#
+#   "start", phase name, None     when a phase begins
+#   "end",   phase name, seconds  when a phase ends, even by an exception
+#   "count", counter name, amount for each counter update (see COUNTERS)
+#
+# Hooks are called in the thread running the phase. Without any hook the
+# instrumented functions run without measuring anything.
+hooks = []
+
+def add_hook(hook):
+    hooks.append(hook)
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+def emit(event, name, value):
+    for hook in hooks:
+        hook(event, name, value)
+
+def count(counter, amount=1):
+    '''
+    Adds the amount to a counter of the running phase.
+    '''
+    if hooks:
+        emit("count", counter, amount)
+
+def phase(name):
+    '''
+    Decorator which reports each call of a function as a phase with the
+    given name to all hooks.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not hooks:
+                return function(*args, **kwargs)
+
+            emit("start", name, None)
+            start = time.time()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                emit("end", name, time.time() - start)
+
+        return wrapper
+
+    return decorator
+
+class Profiler(object):
+    '''
+    Hook which sums up the calls, the time and the counters of each phase.
+    Times include nested phases, while counters are only added to the
+    innermost running phase. Counters outside of any phase are ignored.
+    '''
+
+    def __init__(self):
+        self.phases = {}
+        self.order = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_phase(self, name):
+        if not name in self.phases:
+            self.phases[name] = dict([("calls", 0), ("seconds", 0.0)] + [(counter, 0) for counter in COUNTERS])
+            self.order.append(name)
+
+        return self.phases[name]
+
+    def __call__(self, event, name, value):
+        stack = self.local.__dict__.setdefault("stack", [])
+
+        if event == "start":
+            stack.append(name)
+            return
+
+        with self.lock:
+            if event == "end":
+                stack.pop()
+                current = self.get_phase(name)
+                current["calls"] += 1
+                current["seconds"] += value
+            elif stack:
+                current = self.get_phase(stack[-1])
+                current[name] = current.get(name, 0) + value
+
+    def start(self):
+        add_hook(self)
+
+    def stop(self):
+        remove_hook(self)
+
+    def as_dict(self):
+        return dict((name, dict(values)) for name, values in self.phases.items())
+
+    def write_table(self, stream):
+        '''
+        Prints one line per phase in the order the phases were first seen.
+        '''
+        stream.write("%-24s %6s %10s %12s %14s %9s %9s\n" % (
+            "Phase", "Calls", "ms", "Bytes read", "Bytes written", "Syscalls", "Objects",
+        ))
+
+        for name in self.order:
+            values = self.phases[name]
+            stream.write("%-24s %6s %10.2f %12s %14s %9s %9s\n" % (
+                name, values["calls"], values["seconds"] * 1000, values["bytes_read"],
+                values["bytes_written"], values["syscalls"], values["objects"],
+            ))
+
+    def write_json(self, stream):
+        json.dump(self.as_dict(), stream, indent=1, sort_keys=True)
+        stream.write("\n")
+
+def start_profile(profile_format, stream):
+    '''
+    Starts profiling the rest of the program and prints the result to the
+    stream when the program exits, also through sys.exit(). profile_format
+    is one of PROFILE_FORMATS. "table" and "json" report the phases of the
+    library (see Profiler), while "cprofile" prints the 30 most expensive
+    functions of a complete cProfile run. Worker processes of batch runs
+    are not included.
+    '''
+    if profile_format == "cprofile":
+        import cProfile, pstats
+        profile = cProfile.Profile()
+
+        def report():
+            profile.disable()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(30)
+
+        atexit.register(report)
+        profile.enable()
+        return
+
+    profiler = Profiler()
+
+    def report():
+        profiler.stop()
+
+        if profile_format == "json":
+            profiler.write_json(stream)
+        else:
+            profiler.write_table(stream)
+
+    atexit.register(report)
+    profiler.start()
@@ -0,0 +1,345 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: compiled rearrangement plans (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib, json, os, tempfile
+import psr9000.cache as cache
+import psr9000.instrument as instrument
+import psr9000.regbank as regbank
+
+# Format version of plans. Cached plans of other versions are ignored.
+PLAN_VERSION = 2
+
+# Default upper limit for the size of all cached plans together
+MAX_CACHE_SIZE = 4 * 1024 * 1024
+
+def index_hash(banks):
+    '''
+    Returns a hash of everything a plan depends on in a lazily read bank
+    list: bank and registration numbers, names, sizes and offsets, and the
+    registration headers. Payloads are not read, as plans only refer to
+    them by offset. So a backup which has been saved again without changes
+    has the same hash.
+    '''
+    key = hashlib.sha1()
+
+    for bank in banks:
+        key.update(repr((bank.number, bank.name, bank.position, bank.size)).encode("ascii"))
+
+        for registration in bank.registrations:
+            key.update(repr((
+                registration.number, registration.empty, registration.name,
+                registration.size, registration.offset,
+            )).encode("ascii"))
+
+            if not registration.empty:
+                key.update(bytes(registration.head))
+
+    return key.hexdigest()
+
+def plan_key(map_text, banks):
+    '''
+    Returns the cache key of the plan for a map file with the given content
+    and a backup (see index_hash()).
+    '''
+    if not isinstance(map_text, bytes):
+        map_text = map_text.encode("utf-8")
+
+    key = hashlib.sha1()
+    key.update(map_text)
+    key.update(index_hash(banks).encode("ascii"))
+    return key.hexdigest()
+
+@instrument.phase("compile_plan")
+def compile_plan(banks, registration_map, index=None):
+    '''
+    Rearranges a lazily read bank list with rearrange_registrations() and
+    compiles the layout of the new Regist.reg file into a plan. A plan is
+    a dictionary of plain values which can be stored as JSON:
+
+    {
+        "version": 2,
+        "size": 12345,
+        "banks": [[number, name, position, size], ...],
+        "operations": [
+            ["bank", output_offset, name],
+            ["registration", output_offset, number, size, name],
+            ["empty", output_offset, number],
+            ["fill", output_offset, length],
+            ["copy", output_offset, source_offset, length],
+            ...
+        ],
+    }
+
+    The bank directory is built from the banks. The operations are sorted
+    by output offset. bank, registration and empty write headers (with the
+    new names), fill writes a run of zero bytes and copy copies a block of
+    the input Regist.reg. Registrations whose header doesn't change are
+    copied together with their header and adjacent copies are merged, so
+    banks which are kept as they are become a single block copy.
+
+    Raises a KeyError if registrations cannot be found and a ValueError if
+    there are more than 64 banks or registrations are held in memory or
+    come from different files.
+    '''
+    new_banks = regbank.rearrange_registrations(banks, registration_map, index)
+
+    if len(new_banks) > 64:
+        raise ValueError("A backup cannot contain more than 64 banks")
+
+    operations = []
+    layout = []
+    source = None
+    position = 0x0C10
+
+    def add_copy(output_offset, source_offset, length):
+        if operations and operations[-1][0] == "copy":
+            last = operations[-1]
+
+            if last[1] + last[3] == output_offset and last[2] + last[3] == source_offset:
+                last[3] += length
+                return
+
+        operations.append(["copy", output_offset, source_offset, length])
+
+    for bank in new_banks:
+        layout.append([bank.number, bank.name, position, regbank.bank_length(bank)])
+        operations.append(["bank", position, bank.name])
+        position += 48
+
+        for registration in bank.registrations:
+            if registration.empty or not registration.name:
+                operations.append(["empty", position, registration.number])
+                operations.append(["fill", position + 10, len(regbank.EMPTY_REGISTRATION)])
+                position += 10 + len(regbank.EMPTY_REGISTRATION)
+                continue
+
+            location = registration.data_location()
+
+            if not location:
+                raise ValueError("Plans can only be compiled for lazily read registrations")
+
+            registration_source, offset, length = location
+
+            if source is None:
+                source = registration_source
+            elif registration_source is not source:
+                raise ValueError("Plans can only copy registrations from a single backup")
+
+            header = regbank.registration_header(registration.number, length + 22, registration.name)
+
+            if bytes(source.view(registration.offset, 32)) == header:
+                add_copy(position, registration.offset, 32 + length)
+            else:
+                operations.append(["registration", position, registration.number, length + 22, registration.name])
+                add_copy(position + 32, offset, length)
+
+            position += 32 + length
+
+    return {
+        "version": PLAN_VERSION,
+        "size": position,
+        "banks": layout,
+        "operations": operations,
+    }
+
+@instrument.phase("execute_plan")
+def execute_plan(plan, source, registration_file):
+    '''
+    Writes the Regist.reg content described by a plan to an empty file
+    opened for reading and writing. source is the RegistrationFile of the
+    input backup the plan has been compiled for. First the bank directory
+    and all headers are written in one pass, leaving holes for the copies.
+    Then the copies are done in the order of their source offsets with
+    copy_range(). Returns the list of bank file names as listed in
+    USERFILE.INI, so this can be passed to regbank.write_backup().
+
+    Raises a ValueError if the plan doesn't fit the source.
+    '''
+    banks = [regbank.Bank(number, name, position, size) for number, name, position, size in plan["banks"]]
+    layout = [(position, size) for number, name, position, size in plan["banks"]]
+    index_bytes, bank_files = regbank.build_index(banks, layout)
+    copies = []
+
+    registration_file.write(index_bytes)
+
+    for operation in plan["operations"]:
+        kind, output_offset = operation[:2]
+
+        if kind == "copy":
+            copies.append((operation[2], output_offset, operation[3]))
+            continue
+
+        registration_file.seek(output_offset)
+
+        if kind == "bank":
+            registration_file.write(regbank.bank_header(operation[2]))
+        elif kind == "registration":
+            registration_file.write(regbank.registration_header(*operation[2:5]))
+        elif kind == "empty":
+            registration_file.write(regbank.empty_header(operation[2]))
+        elif kind == "fill":
+            registration_file.write(b"\x00" * operation[2])
+        else:
+            raise ValueError("Unknown plan operation: %s" % kind)
+
+    if copies:
+        end = max(source_offset + length for source_offset, output_offset, length in copies)
+
+        if source is None or source.size < end:
+            raise ValueError("Plan doesn't fit the input backup")
+
+    registration_file.flush()
+    copies.sort()
+
+    for source_offset, output_offset, length in copies:
+        regbank.copy_range(source, registration_file, source_offset, output_offset, length)
+
+    registration_file.truncate(plan["size"])
+
+    # The copies are counted by copy_range()
+    instrument.count("bytes_written", plan["size"] - sum(length for source_offset, output_offset, length in copies))
+    return bank_files
+
+def banks_source(banks):
+    '''
+    Returns the RegistrationFile of a lazily read bank list, or None if it
+    has no registrations.
+    '''
+    for bank in banks:
+        for registration in bank.registrations:
+            if registration.source is not None:
+                return registration.source
+
+    return None
+
+def write_plan(plan, banks, output_dir, input_dir=None):
+    '''
+    Writes a new backup from a plan compiled for the lazily read bank list
+    of input_dir. All other files are handled like in write_banks().
+    '''
+    source = banks_source(banks)
+    regbank.write_backup(output_dir, lambda registration_file: execute_plan(plan, source, registration_file), input_dir)
+
+def dump_plan(plan):
+    '''
+    Returns the plan as JSON text. Names are stored as Latin-1.
+    '''
+    def text(name):
+        return name.decode("latin-1") if isinstance(name, bytes) else name
+
+    plan = dict(plan)
+    plan["banks"] = [[number, text(name), position, size] for number, name, position, size in plan["banks"]]
+    plan["operations"] = [
+        [text(value) if isinstance(value, (bytes, type(u""))) else value for value in operation]
+        for operation in plan["operations"]
+    ]
+
+    return json.dumps(plan, sort_keys=True)
+
+def load_plan(data):
+    '''
+    Reverses dump_plan(). Raises a ValueError if the data isn't a plan of
+    the current version.
+    '''
+    def native(name):
+        return name.encode("latin-1") if bytes is str else name
+
+    plan = json.loads(data)
+
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise ValueError("Unsupported plan format")
+
+    plan["banks"] = [[number, native(name), position, size] for number, name, position, size in plan["banks"]]
+    plan["operations"] = [
+        [operation[0]] + [native(value) if isinstance(value, type(u"")) else value for value in operation[1:]]
+        for operation in plan["operations"]
+    ]
+
+    return plan
+
+def write_plan_text(plan, stream):
+    '''
+    Prints a plan with one operation per line, so that it can be read and
+    compared with diff before anything is written.
+    '''
+    stream.write("# %s bytes, %s banks\n" % (plan["size"], len(plan["banks"])))
+
+    for number, name, position, size in plan["banks"]:
+        stream.write("index        bank %02d at 0x%06x, %s bytes, %s\n" % (number + 1, position, size, name))
+
+    for operation in plan["operations"]:
+        kind, output_offset = operation[:2]
+
+        if kind == "bank":
+            detail = operation[2]
+        elif kind == "registration":
+            detail = "%s, %s bytes, %s" % (operation[2] + 1, operation[3], operation[4])
+        elif kind == "empty":
+            detail = "%s" % (operation[2] + 1)
+        elif kind == "fill":
+            detail = "%s bytes" % operation[2]
+        else:
+            detail = "%s bytes from 0x%06x" % (operation[3], operation[2])
+
+        stream.write("0x%06x %-12s %s\n" % (output_offset, kind, detail))
+
+def get_plan(map_text, banks, use_cache=False, cache_dir=None, max_size=MAX_CACHE_SIZE):
+    '''
+    Returns the plan for a map file with the given content and a lazily
+    read bank list. With use_cache=True plans are kept in the plans
+    directory of the index cache (see cache.default_cache_dir()), keyed by
+    plan_key(). So running the same map against the same backup, even if
+    it has been saved again, doesn't parse the map at all.
+
+    Raises the same errors as read_registration_map() and compile_plan().
+    '''
+    if use_cache:
+        if cache_dir is None:
+            cache_dir = os.path.join(cache.default_cache_dir(), "plans")
+
+        entry_path = os.path.join(cache_dir, plan_key(map_text, banks) + ".plan")
+
+        try:
+            entry_file = open(entry_path, "rb")
+
+            try:
+                plan = load_plan(entry_file.read().decode("utf-8"))
+            finally:
+                entry_file.close()
+
+            os.utime(entry_path, None)
+            return plan
+        except Exception:
+            pass
+
+    registration_map = regbank.read_registration_map(map_text.splitlines(True))
+    plan = compile_plan(banks, registration_map)
+
+    if use_cache:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=cache_dir)
+        temp_file = os.fdopen(fd, "wb")
+        temp_file.write(dump_plan(plan).encode("utf-8"))
+        temp_file.close()
+        os.rename(temp_path, entry_path)
+
+        cache.evict(cache_dir, max_size, ".plan")
+
+    return plan
@@ -16,7 +16,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, struct
+import io, mmap, os, struct
+import psr9000.archive as archive
+import psr9000.instrument as instrument
+import psr9000.userfiles as userfiles
 
 def filter_string(string):
     '''
@@ -31,10 +34,258 @@ def filter_string(string):
     else:
         return string[:length].rstrip()
 
-def read_banks(input_dir):
+class RegistrationFile(object):
+    '''
+    Read-only memory map of a Regist.reg file. The file is never read as a
+    whole. Instead single fields are unpacked right from the mapped pages and
+    payloads can be handed out as zero-copy slices with view(), so that the
+    operating system only loads the parts of the file that are really used.
+
+    If the size of the file is already known, e.g. from a cached index, the
+    file is only opened and mapped when the first byte is accessed.
+    '''
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = size
+        self._file = None
+        self._buffer = None
+
+        if size is None:
+            self.open()
+
+    def open(self):
+        '''
+        Opens and maps the file unless this has already been done.
+        '''
+        if self._file is not None:
+            return
+
+        self._file = open(self.path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+
+        if self.size:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            instrument.count("syscalls", 3)
+        else:
+            self._buffer = b""
+            instrument.count("syscalls", 2)
+
+    def get_file(self):
+        self.open()
+        return self._file
+
+    def get_buffer(self):
+        self.open()
+        return self._buffer
+
+    file = property(get_file)
+    buffer = property(get_buffer)
+
+    def read(self, offset, length):
+        '''
+        Returns a copy of the given byte range.
+        '''
+        return self.buffer[offset:offset + length]
+
+    def view(self, offset, length):
+        '''
+        Returns a zero-copy slice of the given byte range. Python 2 always
+        gets a read-only buffer object instead of a memoryview, because it
+        cannot create a memoryview of a mmap object and bytes() of a
+        memoryview returns its repr there, not its content. Both can be
+        written to files or converted with bytes() or bytearray() just like
+        a string.
+        '''
+        try:
+            return buffer(self.buffer, offset, length)
+        except NameError:
+            return memoryview(self.buffer)[offset:offset + length]
+
+    def close(self):
+        '''
+        Unmaps the file. Slices returned by view() must not be used afterwards.
+        '''
+        if self._file is None:
+            return
+
+        if self.size:
+            self._buffer.close()
+
+        self._file.close()
+        self._file = None
+        self._buffer = None
+
+class RegistrationBuffer(RegistrationFile):
+    '''
+    RegistrationFile for a Regist.reg file which has already been read into
+    memory, e.g. from a zip or tar archive. It has no file object, so its
+    payloads are always copied through Python (see copy_range()).
+    '''
+
+    def __init__(self, path, data):
+        self.path = path
+        self.size = len(data)
+        self._file = None
+        self._buffer = data
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+class Record(object):
+    '''
+    Common base of Bank and Registration. Both classes use __slots__ to keep
+    the memory footprint small when many backups are loaded at once. For
+    compatibility with code written against the old dict-based format all
+    fields can still be accessed like dictionary items, e.g. bank["name"].
+    '''
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, key):
+        if not key in self.fields:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if not key in self.fields:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        if not key in self.fields:
+            return default
+
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.fields)
+
+    def as_dict(self):
+        '''
+        Returns a plain dictionary in the format documented at read_banks().
+        '''
+        return dict((key, self[key]) for key in self.fields)
+
+class Registration(Record):
+    '''
+    A single registration. See read_banks() for the meaning of the fields.
+    Additionally offset contains the position of the registration header
+    inside the Regist.reg file it has been read from and source the
+    RegistrationFile itself, if the registration has been read lazily.
+    In that case head and data are sliced from the file on each access.
+    '''
+    __slots__ = ("number", "empty", "name", "size", "offset", "source", "_head", "_data")
+    fields = ("number", "empty", "name", "size", "head", "data")
+
+    def __init__(self, number, empty, name, size, head=b"", data=b"", offset=None, source=None):
+        self.number = number
+        self.empty = empty
+        self.name = name
+        self.size = size
+        self.offset = offset
+        self.source = source
+        self._head = head
+        self._data = data
+
+    @classmethod
+    def from_dict(cls, registration):
+        return cls(
+            registration["number"],
+            registration["empty"],
+            registration["name"],
+            registration["size"],
+            registration["head"],
+            registration["data"],
+        )
+
+    def copy(self):
+        '''
+        Returns a shallow copy. Payloads are shared, not copied.
+        '''
+        return Registration(
+            self.number, self.empty, self.name, self.size,
+            self._head, self._data, self.offset, self.source,
+        )
+
+    def get_head(self):
+        if self._head is None:
+            return self.source.view(self.offset, 32)
+
+        return self._head
+
+    def set_head(self, head):
+        self._head = head
+
+    def get_data(self):
+        if self._data is None:
+            source, offset, length = self.data_location()
+            return source.view(offset, length)
+
+        return self._data
+
+    def data_location(self):
+        '''
+        Returns a (source, offset, length) tuple describing where the data
+        field can be found inside the mapped file, or None if the data is
+        held in memory.
+        '''
+        if self._data is not None:
+            return None
+
+        length = min(self.size - 22, self.source.size - self.offset - 32)
+        return self.source, self.offset + 32, max(0, length)
+
+    def set_data(self, data):
+        self._data = data
+
+    head = property(get_head, set_head)
+    data = property(get_data, set_data)
+
+class Bank(Record):
+    '''
+    A registration bank with a list of Registration objects. See read_banks()
+    for the meaning of the fields.
+    '''
+    __slots__ = ("number", "name", "position", "size", "registrations")
+    fields = ("number", "name", "position", "size", "registrations")
+
+    def __init__(self, number, name, position, size, registrations=None):
+        self.number = number
+        self.name = name
+        self.position = position
+        self.size = size
+        self.registrations = registrations if registrations is not None else []
+
+    @classmethod
+    def from_dict(cls, bank):
+        return cls(
+            bank["number"],
+            bank["name"],
+            bank["position"],
+            bank["size"],
+            [Registration.from_dict(registration) for registration in bank["registrations"]],
+        )
+
+    def as_dict(self):
+        bank = Record.as_dict(self)
+        bank["registrations"] = [registration.as_dict() for registration in self.registrations]
+        return bank
+
+@instrument.phase("read_banks")
+def read_banks(input_dir, lazy=False):
     '''
     Reads in registrations and returns a list of all banks with contained
-    registrations. The list is of following format:
+    registrations. Banks and registrations are Bank and Registration objects
+    which can also be accessed like the following dictionaries:
 
     [
         {
@@ -62,64 +313,127 @@ def read_banks(input_dir):
     the complete registration header including the name, as it has been read
     from the file (32 bytes).
 
+    The file is memory mapped and only the index and the registration headers
+    are parsed. By default the head and data fields are copied into strings
+    and the file is closed again. With lazy=True they are zero-copy slices of
+    the mapped file instead (see RegistrationFile.view()), which are only
+    created when the fields are accessed. So listing a backup never touches
+    the registration payloads. The mapping stays open as long as any of the
+    registrations is referenced. Don't overwrite the file while lazily read
+    registrations are still in use.
+
+    input_dir may also be a zip or tar archive (see archive.is_archive()).
+    Regist.reg is then read from the archive into memory without extracting
+    anything to disk.
+
     Raises a ValueError if the binary registration file cannot be parsed.
     '''
+    if archive.is_archive(input_dir):
+        registration_file = RegistrationBuffer(input_dir, archive.read_member(input_dir, "Regist.reg"))
+    else:
+        registration_file = RegistrationFile(os.path.join(input_dir, "Regist.reg"))
+
+    try:
+        banks = read_registration_file(registration_file, lazy)
+    except:
+        registration_file.close()
+        raise
+
+    if not lazy:
+        registration_file.close()
+
+    return banks
+
+def read_registration_file(registration_file, lazy=False):
+    '''
+    Does the work of read_banks() for an open RegistrationFile or
+    RegistrationBuffer, which is not closed. All sizes and positions read
+    from the file are checked before they are used, so that broken files
+    raise a ValueError instead of reading beyond the file or looping for a
+    long time. Registrations which reach beyond the end of the file are cut
+    off, like it happens with truncated backups.
+    '''
     banks = []
-    registration_file = open(os.path.join(input_dir, "Regist.reg"), "rb")
-    magic_bytes = registration_file.read(4)
+    bytes_read = 64 * 48
+    objects = 0
 
-    if not magic_bytes == "\xd0\x06\x00\x00":
-        raise ValueError("Unknown registration format: %s" % magic_bytes)
+    if isinstance(registration_file, RegistrationBuffer):
+        bytes_read = registration_file.size
 
-    registration_file.seek(0)
+    buf = registration_file.buffer
+    magic_bytes = buf[:4]
 
-    for i in range(64):
-        index_entry = registration_file.read(48)
+    if not magic_bytes == b"\xd0\x06\x00\x00":
+        raise ValueError("Unknown registration format: %s" % repr(magic_bytes))
 
-        if len(index_entry) < 48:
+    for i in range(64):
+        if (i + 1) * 48 > registration_file.size:
             raise ValueError("Aborting due to truncated data file")
 
-        bank_size, bank_position, bank_number, bank_name = struct.unpack("> 16x l l B 16s 6x x", index_entry)
+        bank_size, bank_position, bank_number, bank_name = struct.unpack_from("> 16x l l B 16s 6x x", buf, i * 48)
         bank_name = filter_string(bank_name)
 
         if not bank_size:
             continue
 
-        banks.append({
-            "number": bank_number,
-            "name": bank_name,
-            "position": bank_position,
-            "size": bank_size,
-            "registrations": []
-        })
+        if bank_position < 0 or bank_position + 48 > registration_file.size:
+            raise ValueError("Bank %s lies outside of the registration file" % (bank_number + 1))
+
+        banks.append(Bank(bank_number, bank_name, bank_position, bank_size))
 
     for bank in banks:
         offset = 48
-        registration_file.seek(bank["position"] + offset)
 
-        while offset < bank["size"]:
-            reg_head = registration_file.read(32)
-            reg_id, reg_size, reg_name = struct.unpack("> 6s l 6x 16s", reg_head)
+        while offset < bank.size:
+            position = bank.position + offset
+
+            if position + 32 > registration_file.size:
+                raise ValueError("Bank %s ends inside a registration header" % (bank.number + 1))
+
+            reg_id, reg_size, reg_name = struct.unpack_from("> 6s l 6x 16s", buf, position)
+
+            if reg_id[:3] != b"REG" or not reg_id[3:].isdigit() or int(reg_id[3:]) > 7:
+                raise ValueError("Invalid registration header in bank %s: %s" % (bank.number + 1, repr(reg_id)))
 
             reg_name = filter_string(reg_name)
             reg_number = int(reg_id[3:])
-            reg_data = registration_file.read(reg_size - 22)
-            reg_empty = reg_head[11] == b"\x00"
+            reg_length = max(0, min(reg_size - 22, registration_file.size - position - 32))
+            reg_empty = buf[position + 11:position + 12] == b"\x00"
 
-            offset += len(reg_head) + len(reg_data)
+            offset += 32 + reg_length
+            objects += 1
 
-            bank["registrations"].append({
-                "number": reg_number,
-                "empty": reg_empty,
-                "name": reg_name,
-                "size": reg_size,
-                "head": reg_head,
-                "data": reg_data,
-            })
+            if lazy:
+                registration = Registration(reg_number, reg_empty, reg_name, reg_size,
+                                            None, None, position, registration_file)
+                bytes_read += 32
+            else:
+                registration = Registration(reg_number, reg_empty, reg_name, reg_size,
+                                            registration_file.read(position, 32),
+                                            registration_file.read(position + 32, reg_length),
+                                            position)
+                bytes_read += 32 + reg_length
+
+            bank.registrations.append(registration)
+
+    if instrument.hooks:
+        if not isinstance(registration_file, RegistrationBuffer):
+            bytes_read = min(bytes_read, registration_file.size)
+
+        instrument.count("bytes_read", bytes_read)
+        instrument.count("objects", objects + len(banks))
 
-    registration_file.close()
     return banks
 
+def read_registration_stream(stream, name="<stdin>"):
+    '''
+    Reads a list of banks from a stream with the content of a Regist.reg
+    file, like StdIn of a program whose input is piped from another one
+    (see write_registration_stream()). The content is read into memory
+    and the registrations are lazily read slices of it.
+    '''
+    return read_registration_file(RegistrationBuffer(name, stream.read()), lazy=True)
+
 def write_registration_map(banks, map_file):
     '''
     Takes a list of registrations as created by read_banks() and a data stream
@@ -145,24 +459,24 @@ def write_registration_map(banks, map_file):
     are printed. Empty registrations have no name.
     '''
     for bank in banks:
-        bank_number = bank["number"] + 1
+        bank_number = bank.number + 1
 
         if bank_number < 10:
             bank_number = "0" + str(bank_number)
         else:
             bank_number = str(bank_number)[:2]
 
-        map_file.write("%s|N|%s\n" % (bank_number, bank["name"]))
+        map_file.write("%s|N|%s\n" % (bank_number, bank.name))
 
         index = -1
-        for registration in bank["registrations"]:
+        for registration in bank.registrations:
             index += 1
 
-            while index < registration["number"]:
+            while index < registration.number:
                 map_file.write("%s|%s|\n" % (bank_number, index + 1))
                 index += 1
 
-            map_file.write("%s|%s|%s\n" % (bank_number, registration["number"] + 1, registration["name"]))
+            map_file.write("%s|%s|%s\n" % (bank_number, registration.number + 1, registration.name))
 
         while index < 7:
             map_file.write("%s|%s|\n" % (bank_number, index + 1))
@@ -170,6 +484,7 @@ def write_registration_map(banks, map_file):
 
         map_file.write("\n")
 
+@instrument.phase("read_registration_map")
 def read_registration_map(map_file):
     '''
     Reads a textual registration map as created by write_registration_map()
@@ -186,6 +501,7 @@ def read_registration_map(map_file):
             "registrations": [
                 {
                     "empty": False,
+                    "source": None,
                     "bank": 23,
                     "registration": 3,
                     "name": "Registration name",
@@ -199,6 +515,19 @@ def read_registration_map(map_file):
     Empty registrations only have the "empty" field set to True. The other
     fields are not present, then.
 
+    Registrations can also be referenced by name instead of position by
+    leaving the first two fields empty, e.g. "||Stand by me". Bank and
+    registration are None, then, and the registration is looked up by its
+    title (see RegistrationIndex).
+
+    Registrations can also come from other backups than the one the map
+    has been written for. Their first field is then qualified with the name
+    of the source backup and a colon, e.g. "live2010:03|1|Stand by me" or
+    "live2010:||Stand by me". The name is returned in the source field,
+    which is None for unqualified registrations (see regmerge.py).
+
+    Lines starting with "#" are comments and ignored.
+
     The user is allowed to change the number of a bank at the first line
     of each bank. She is also allowed to change bank and registration names.
     The other fields must remain untouched as they describe where a registration
@@ -209,6 +538,7 @@ def read_registration_map(map_file):
     registration_map = []
     current_bank = {}
     bank_number = -1
+    bytes_read = 0
 
     def syntax_error(msg, line):
         raise ValueError("Syntax error in map file\n%s\n%s" % (msg, line))
@@ -227,9 +557,10 @@ def read_registration_map(map_file):
         registration_map.append(current_bank)
 
     for line in map_file:
+        bytes_read += len(line)
         line = line.strip()
 
-        if not line:
+        if not line or line.startswith("#"):
             continue
 
         fields = line.split("|")
@@ -240,6 +571,15 @@ def read_registration_map(map_file):
         fields[0] = fields[0].strip()
         fields[1] = fields[1].strip()
         fields[2] = fields[2]
+        source = None
+
+        if ":" in fields[0]:
+            source, fields[0] = fields[0].rsplit(":", 1)
+            source = source.strip()
+            fields[0] = fields[0].strip()
+
+            if not source:
+                syntax_error("Missing source name before colon", line)
 
         if fields[0]:
             try:
@@ -248,6 +588,9 @@ def read_registration_map(map_file):
                 syntax_error(err.message, line)
 
         if fields[1] == "N":
+            if source is not None:
+                syntax_error("Banks cannot have a source", line)
+
             append_current_bank()
 
             if not fields[0]:
@@ -268,169 +611,526 @@ def read_registration_map(map_file):
 
             if not fields[2]:
                 current_bank["registrations"].append({"empty": True})
+            elif not fields[0] and not fields[1]:
+                current_bank["registrations"].append({
+                    "empty": False,
+                    "source": source,
+                    "bank": None,
+                    "registration": None,
+                    "name": fields[2],
+                })
             else:
+                if not fields[0]:
+                    syntax_error("Missing bank number", line)
+
+                try:
+                    fields[1] = int(fields[1])
+                except ValueError as err:
+                    syntax_error(str(err), line)
+
                 current_bank["registrations"].append({
                     "empty": False,
+                    "source": source,
                     "bank": fields[0] - 1,
-                    "registration": int(fields[1]) - 1,
+                    "registration": fields[1] - 1,
                     "name": fields[2],
                 })
 
     append_current_bank()
+
+    if instrument.hooks:
+        instrument.count("bytes_read", bytes_read)
+        instrument.count("objects", sum(len(bank["registrations"]) + 1 for bank in registration_map))
+
     return registration_map
 
-def rearrange_registrations(banks, registration_map):
+class RegistrationIndex(object):
+    '''
+    Lookup table for a bank list as created by read_banks(). Registrations
+    can be found by bank and registration number or by their name in constant
+    time. Names are compared case-insensitive. If several banks or
+    registrations share the same number or name the first one wins.
+
+    The index is meant to be built once per loaded backup and then be
+    reused for every rearrange_registrations() call.
+    '''
+
+    def __init__(self, banks):
+        self.banks = {}
+        self.registrations = {}
+        self.names = {}
+
+        for bank in banks:
+            self.banks.setdefault(bank.number, bank)
+
+            for registration in bank.registrations:
+                self.registrations.setdefault((bank.number, registration.number), registration)
+
+                if not registration.empty and registration.name:
+                    self.names.setdefault(registration.name.strip().lower(), registration)
+
+    def find(self, map_registration):
+        '''
+        Returns the registration referenced by a non-empty registration entry
+        of read_registration_map(). Raises a KeyError with a readable message
+        if it doesn't exist. Its numbers are counted from 1 like in map files.
+        Registrations from other backups can only be found with a
+        regmerge.SourceIndex.
+        '''
+        if map_registration.get("source") is not None:
+            raise KeyError("Unknown source %s" % map_registration["source"])
+
+        bank_number = map_registration["bank"]
+        reg_number = map_registration["registration"]
+
+        if bank_number is None and reg_number is None:
+            name = map_registration["name"].strip()
+
+            try:
+                return self.names[name.lower()]
+            except KeyError:
+                raise KeyError("Couldn't find registration named '%s'" % name)
+
+        try:
+            return self.registrations[(bank_number, reg_number)]
+        except KeyError:
+            if not bank_number in self.banks:
+                raise KeyError("Couldn't find bank number %s" % (bank_number + 1))
+            else:
+                raise KeyError("Couldn't find registration %s in bank %s" % (reg_number + 1, bank_number + 1))
+
+@instrument.phase("rearrange_registrations")
+def rearrange_registrations(banks, registration_map, index=None):
     '''
     Takes a bank list as createy by read_banks() and a registration map as
     created by read_registration_map() in order to create a new bank list.
-    Raises a KeyError if a registration or bank cannot be found.
+    The registrations of the new list share their payloads with the
+    original ones. A RegistrationIndex of the bank list can be given to
+    save building a new one.
+
+    Raises a KeyError if registrations or banks cannot be found. Its message
+    lists all missing references, not just the first one.
     '''
     new_banks = []
+    missing = []
     bank_position = 0x0C10
 
-    for map_bank in registration_map:
-        current_bank = {
-            "number": map_bank["number"],
-            "name": map_bank["name"],
-            "position": bank_position,
-            "size": 48,
-            "registrations": []
-        }
+    if index is None:
+        index = RegistrationIndex(banks)
 
+    for map_bank in registration_map:
+        current_bank = Bank(map_bank["number"], map_bank["name"], bank_position, 48)
         reg_number = -1
 
         for map_registration in map_bank["registrations"]:
             reg_number += 1
-            reg_empty = True
-            reg_name = ""
-            reg_size = 0
-            reg_head = b""
-            reg_data = b""
 
             if map_registration["empty"]:
-                current_bank["size"] += 583
+                registration = Registration(reg_number, True, "", 0)
+                current_bank.size += 583
             else:
-                found_bank = None
-                found_registration = None
+                try:
+                    found_registration = index.find(map_registration)
+                except KeyError as err:
+                    missing.append(err.args[0])
+                    continue
 
-                for bank in banks:
-                    if bank["number"] == map_registration["bank"]:
-                        found_bank = bank
-                        break
+                registration = found_registration.copy()
+                registration.number = reg_number
+                registration.name = map_registration["name"]
+
+                current_bank.size += registration.size + 10
+
+            current_bank.registrations.append(registration)
+
+        bank_position += current_bank.size
+        new_banks.append(current_bank)
+
+    if missing:
+        raise KeyError("\n".join(missing))
+
+    if instrument.hooks:
+        instrument.count("objects", sum(len(bank.registrations) + 1 for bank in new_banks))
+
+    return new_banks
 
-                if not found_bank:
-                    raise KeyError("Couldn't find bank number %s'" % map_registration["bank"])
+EMPTY_REGISTRATION = 573 * b"\x00"
 
-                for registration in found_bank["registrations"]:
-                    if registration["number"] == map_registration["registration"]:
-                        found_registration = registration
+def copy_range(source, output_file, source_offset, output_offset, length):
+    '''
+    Copies a byte range from a RegistrationFile to an absolute position of
+    the output file. copy_file_range() or sendfile() are used where
+    available, so that the bytes don't need to pass through Python. The
+    output file must have been flushed before.
+
+    Sources without a file (see RegistrationBuffer) and output files without
+    a file descriptor, like io.BytesIO, are served by plain writes.
+
+    The copied bytes are counted as written and, if the source is a file,
+    as read, also when the kernel copies them.
+    '''
+    try:
+        output_fd = output_file.fileno()
+    except (AttributeError, IOError, ValueError):
+        data = source.view(source_offset, length)
+        output_file.seek(output_offset)
+        output_file.write(data)
+        count_copy(source, len(data))
+        return
+
+    syscalls = 0
+    copied_total = 0
+
+    if source.file is not None:
+        source_fd = source.file.fileno()
+
+        try:
+            if hasattr(os, "copy_file_range"):
+                while length > 0:
+                    copied = os.copy_file_range(source_fd, output_fd, length, source_offset, output_offset)
+                    syscalls += 1
+
+                    if not copied:
                         break
 
-                if not found_registration:
-                    raise KeyError("Couldn't find registration %s in bank %s'" % (map_registration["registration"], map_registration["bank"]))
+                    source_offset += copied
+                    output_offset += copied
+                    length -= copied
+                    copied_total += copied
+            elif hasattr(os, "sendfile"):
+                os.lseek(output_fd, output_offset, os.SEEK_SET)
+                syscalls += 1
 
-                reg_name = map_registration["name"]
-                reg_size = found_registration["size"]
-                reg_head = found_registration["head"]
-                reg_data = found_registration["data"]
-                reg_empty = found_registration["empty"]
+                while length > 0:
+                    copied = os.sendfile(output_fd, source_fd, source_offset, length)
+                    syscalls += 1
 
-                current_bank["size"] += reg_size + 10
+                    if not copied:
+                        break
 
-            current_bank["registrations"].append({
-                "number": reg_number,
-                "empty": reg_empty,
-                "name": reg_name,
-                "size": reg_size,
-                "head": reg_head,
-                "data": reg_data,
-            })
+                    source_offset += copied
+                    output_offset += copied
+                    length -= copied
+                    copied_total += copied
+        except OSError:
+            pass
 
+    if length > 0:
+        os.lseek(output_fd, output_offset, os.SEEK_SET)
+        data = source.view(source_offset, length)
+        copied_total += len(data)
+        syscalls += 1
 
-        bank_position += current_bank["size"]
-        new_banks.append(current_bank)
+        while len(data):
+            data = data[os.write(output_fd, data):]
+            syscalls += 1
 
-    return new_banks
+    instrument.count("syscalls", syscalls)
+    count_copy(source, copied_total)
 
-def write_banks(banks, output_dir):
+def count_copy(source, length):
     '''
-    Writes the given list of registration banks to the output directory. The
-    output directory will be a valid user data backup. This function ignores
-    the header field from the registration list.
+    Counts the bytes copied by copy_range(). Sources without a file have
+    been read into memory and counted by read_registration_file() already.
     '''
-    already_exists = os.path.exists(output_dir)
+    if source.file is not None:
+        instrument.count("bytes_read", length)
 
-    if not already_exists:
-        os.mkdir(output_dir)
+    instrument.count("bytes_written", length)
 
-    registration_file = open(os.path.join(output_dir, "Regist.reg"), "wb")
+def build_index(banks, layout=None):
+    '''
+    Returns the 3088 bytes long bank directory at the beginning of Regist.reg
+    for the given list of registration banks and the list of bank file
+    names as listed in USERFILE.INI.
+
+    The position and size of each bank are computed from what write_bank()
+    writes, not taken from the bank objects, so that the directory always
+    matches the file. layout can give a list of (position, size) tuples
+    instead, e.g. for banks without registration objects.
+    '''
+    index_bytes = bytearray(0x0C10)
+    index_bytes[0:2] = b"\xd0\x06"
     bank_files = []
-    amount = 0
 
-    for bank in banks:
-        amount += 1
+    if layout is None:
+        layout = []
+        position = 0x0C10
 
-        if amount == 1:
-            registration_file.write("\xd0\x06" + 14 * "\x00")
-            first_bank = False
-        else:
-            registration_file.write(16 * "\x00")
+        for bank in banks:
+            layout.append((position, bank_length(bank)))
+            position += layout[-1][1]
 
-        if bank["number"] < 16:
-            hex_number = "0" + hex(bank["number"])[2:]
+    for i, bank in enumerate(banks):
+        if bank.number < 16:
+            hex_number = "0" + hex(bank.number)[2:]
         else:
-            hex_number = hex(bank["number"])[2:4]
+            hex_number = hex(bank.number)[2:4]
 
-        long_name = bank["name"] + ((16 - len(bank["name"])) * " ") + "%s.reg" % (hex_number.upper())
-        index_bytes = struct.pack("> l l B 22s x", bank["size"], bank["position"], bank["number"], long_name)
-        registration_file.write(index_bytes)
+        long_name = bank.name + ((16 - len(bank.name)) * " ") + "%s.reg" % (hex_number.upper())
+        struct.pack_into("> l l B 22s x", index_bytes, i * 48 + 16, layout[i][1], layout[i][0], bank.number, long_name)
         bank_files.append(long_name)
 
-    while amount < 64:
-        amount += 1
-        registration_file.write(48 * "\x00")
+    return index_bytes, bank_files
 
-    registration_file.write(16 * "\x00")
+def registration_length(registration):
+    '''
+    Returns the number of bytes write_bank() writes for a registration.
+    '''
+    if registration.empty or not registration.name:
+        return 583
 
-    for bank in banks:
-        bank_bytes = struct.pack("> 16s 32s", bank["name"], "PSR-9000PREGIST Ver1.00         ")
-        registration_file.write(bank_bytes)
+    location = registration.data_location()
+
+    if location:
+        return 32 + location[2]
+    else:
+        return 32 + len(registration.data)
+
+def bank_length(bank):
+    '''
+    Returns the number of bytes write_bank() writes for a bank.
+    '''
+    return 48 + sum(registration_length(registration) for registration in bank.registrations)
+
+def bank_header(name):
+    '''
+    Returns the 48 bytes long header of a bank with the given name.
+    '''
+    return struct.pack("> 16s 32s", name, "PSR-9000PREGIST Ver1.00         ")
 
-        for registration in bank["registrations"]:
-            registration_file.write("REG00" + str(registration["number"]))
+def registration_header(number, size, name):
+    '''
+    Returns the 32 bytes long header of a non-empty registration as written
+    by write_bank(). size is the size field, not the payload length.
+    '''
+    return struct.pack("> 6s l 6s 16s", "REG00" + str(number), size, "\x08\x01\x00\x00\x00\x00", name)
+
+def empty_header(number):
+    '''
+    Returns the 10 bytes long header of an empty registration. It is
+    followed by 573 zero bytes (see EMPTY_REGISTRATION).
+    '''
+    return struct.pack("> 6s l", "REG00" + str(number), 573)
 
-            if not registration["empty"] and registration["name"]:
-                registration_file.write(struct.pack("> l", registration["size"]))
-                registration_file.write("\x08\x01\x00\x00\x00\x00")
-                registration_file.write(struct.pack("16s", registration["name"]))
-                registration_file.write(registration["data"])
+def write_bank(bank, registration_file, position, copies):
+    '''
+    Writes a bank with all of its registrations at the current position of
+    the registration file, which must be given as position. The size field
+    of each registration header is taken from the payload, so that the
+    file stays consistent even if the payload has been cut off. Payloads of
+    lazily read registrations are not written. Instead a hole is left for
+    each of them and a copy job is appended to copies, which must then be
+    passed to copy_payloads(). Returns the position after the bank.
+    '''
+    bank_bytes = bank_header(bank.name)
+    registration_file.write(bank_bytes)
+    position += len(bank_bytes)
+
+    for registration in bank.registrations:
+        if not registration.empty and registration.name:
+            location = registration.data_location()
+
+            if location:
+                length = location[2]
             else:
-                registration_file.write(struct.pack("> l", 573))
-                registration_file.write(573 * "\x00")
+                length = len(registration.data)
 
-    registration_file.close()
+            registration_file.write(registration_header(registration.number, length + 22, registration.name))
+            position += 32
+
+            if location:
+                source, offset, length = location
+                copies.append((source.path, offset, source, position, length))
+                registration_file.seek(length, os.SEEK_CUR)
+                position += length
+            else:
+                registration_file.write(registration.data)
+                position += len(registration.data)
+        else:
+            registration_file.write(empty_header(registration.number))
+            registration_file.write(EMPTY_REGISTRATION)
+            position += 583
+
+    return position
+
+def copy_payloads(copies, registration_file):
+    '''
+    Fills the holes left by write_bank() in the order of their source
+    positions (see copy_range()).
+    '''
+    registration_file.flush()
+    copies.sort(key=lambda copy: copy[:2])
+
+    for source_path, source_offset, source, output_offset, length in copies:
+        copy_range(source, registration_file, source_offset, output_offset, length)
+
+def write_registration_file(banks, registration_file):
+    '''
+    Writes the Regist.reg content of the given list of registration banks to
+    an open file, which must be empty and opened for reading and writing.
+    This function ignores the header field from the registration list.
+
+    The index is built in a single buffer and all headers are written in one
+    sequential pass. Payloads of lazily read registrations are not loaded.
+    Instead holes are left for them, which are then filled directly from the
+    source file in the order of their source positions (see copy_range()).
+    So memory usage doesn't grow with the size of the backup.
+
+    Returns the list of bank file names as listed in USERFILE.INI.
+    '''
+    index_bytes, bank_files = build_index(banks)
+    copies = []
+
+    registration_file.write(index_bytes)
+    position = len(index_bytes)
+
+    for bank in banks:
+        position = write_bank(bank, registration_file, position, copies)
+
+    copy_payloads(copies, registration_file)
+    registration_file.truncate(position)
+
+    # The payloads are counted by copy_range()
+    instrument.count("bytes_written", position - sum(copy[4] for copy in copies))
+    return bank_files
+
+def write_registration_stream(banks, stream):
+    '''
+    Writes the Regist.reg content of a list of banks to a stream which
+    cannot seek, like StdOut. The content is built in memory first, because
+    write_registration_file() fills holes in the file after writing the
+    headers. Raises a ValueError if there are more than 64 banks.
+    '''
+    if len(banks) > 64:
+        raise ValueError("A backup cannot contain more than 64 banks")
+
+    registration_file = io.BytesIO()
+    write_registration_file(banks, registration_file)
+    stream.write(registration_file.getvalue())
+
+def userfile_ini(bank_files, total_size):
+    '''
+    Returns the content of a USERFILE.INI file for a backup with the given
+    bank file names and Regist.reg size.
+    '''
+    lines = [
+        "[TITLE]",
+        "9000Pro USERFILE.INI",
+        "YAMAHA Corporation",
+        "[DISK NO]",
+        "DISK000",
+        "[INSTRUMENT]",
+        "9000Pro",
+        "[VERSION]",
+        "Ver2.06",
+        "[TOTAL USER DATA SIZE]",
+        "%sKB" % total_size,
+        "[REGISTRATION]",
+        "TOTAL FILE NUM:%s" % len(bank_files),
+    ]
+
+    for index, bank_file in enumerate(bank_files):
+        lines.append("%s = %s" % (index + 1, bank_file))
+
+    lines.append("[DATAEND]")
+    return "".join(line + "\r\n" for line in lines)
+
+@instrument.phase("write_banks")
+def write_banks(banks, output_dir, input_dir=None):
+    '''
+    Writes the given list of registration banks to the output directory. The
+    output directory will be a valid user data backup. This function ignores
+    the header field from the registration list. See write_registration_file()
+    for how Regist.reg is written.
+
+    If input_dir names the backup the banks come from, all of its other
+    files (styles, songs, ...) are carried over to a new output directory as
+    cheaply as possible and its USERFILE.INI is merged with the new
+    registration entries (see userfiles.copy_files()).
+
+    If output_dir has the name of a zip or tar archive (see archive.py), a
+    new archive with Regist.reg and USERFILE.INI is written instead. The
+    Regist.reg file is then written to a temporary file next to the
+    archive, which is streamed into it (see archive.write_archive()).
+
+    Raises a ValueError if there are more than 64 banks.
+    '''
+    if len(banks) > 64:
+        raise ValueError("A backup cannot contain more than 64 banks")
+
+    write_backup(output_dir, lambda registration_file: write_registration_file(banks, registration_file), input_dir)
+
+def write_backup(output_dir, write_registrations, input_dir=None):
+    '''
+    Does the work of write_banks() with any function which writes the
+    content of Regist.reg, like write_registration_file() or
+    plan.execute_plan(). write_registrations is called with the empty
+    output file, opened for reading and writing, and must return the list
+    of bank file names as listed in USERFILE.INI.
+    '''
+    if archive.archive_format(output_dir) and not os.path.isdir(output_dir):
+        registration_path = archive.create_temp_file(output_dir)
+
+        try:
+            registration_file = open(registration_path, "w+b")
+            bank_files = write_registrations(registration_file)
+            registration_file.close()
+            total_size = os.path.getsize(registration_path)
+
+            if input_dir is None:
+                archive.write_archive(
+                    output_dir, [("USERFILE.INI", userfile_ini(bank_files, total_size))],
+                    [("Regist.reg", registration_path)],
+                )
+                return
+
+            backup = userfiles.open_backup(input_dir)
+
+            try:
+                config = userfile_ini(bank_files, total_size + userfiles.file_sizes(backup))
+                original_config = userfiles.read_file(backup, "USERFILE.INI")
+
+                if original_config is not None:
+                    config = userfiles.merge_userfile_ini(original_config, config)
+
+                def members():
+                    for name in userfiles.list_files(backup):
+                        yield name, backup.read(name)
+
+                    yield "USERFILE.INI", config
+
+                archive.write_archive(output_dir, members(), [("Regist.reg", registration_path)])
+            finally:
+                backup.close()
+        finally:
+            os.remove(registration_path)
+
+        return
+
+    already_exists = os.path.exists(output_dir)
 
     if not already_exists:
-        config_file = open(os.path.join(output_dir, "USERFILE.INI"), "wb")
-        config_file.write("[TITLE]\r\n")
-        config_file.write("9000Pro USERFILE.INI\r\n")
-        config_file.write("YAMAHA Corporation\r\n")
-        config_file.write("[DISK NO]\r\n")
-        config_file.write("DISK000\r\n")
-        config_file.write("[INSTRUMENT]\r\n")
-        config_file.write("9000Pro\r\n")
-        config_file.write("[VERSION]\r\n")
-        config_file.write("Ver2.06\r\n")
-        config_file.write("[TOTAL USER DATA SIZE]\r\n")
-        config_file.write("%sKB\r\n" % os.stat(os.path.join(output_dir, "Regist.reg")).st_size)
-        config_file.write("[REGISTRATION]\r\n")
-        config_file.write("TOTAL FILE NUM:%s\r\n" % len(bank_files))
-
-        index = 0
-
-        for bank_file in bank_files:
-            index += 1
-            config_file.write("%s = %s\r\n" % (index, bank_file))
+        os.mkdir(output_dir)
+
+    registration_file = open(os.path.join(output_dir, "Regist.reg"), "w+b")
+    bank_files = write_registrations(registration_file)
+    registration_file.close()
+
+    if already_exists:
+        return
+
+    total_size = os.stat(os.path.join(output_dir, "Regist.reg")).st_size
 
-        config_file.write("[DATAEND]\r\n")
+    if input_dir is None:
+        config_file = open(os.path.join(output_dir, "USERFILE.INI"), "wb")
+        config_file.write(userfile_ini(bank_files, total_size))
         config_file.close()
+    else:
+        backup = userfiles.open_backup(input_dir)
+
+        try:
+            total_size += userfiles.file_sizes(backup)
+            userfiles.copy_files(backup, output_dir, userfile_ini(bank_files, total_size))
+        finally:
+            backup.close()
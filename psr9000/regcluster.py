@@ -0,0 +1,333 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: near-duplicate registration clustering (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import psr9000.regbank as regbank
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Upper limit for the temporary arrays of one block of distances in bytes
+BLOCK_SIZE = 32 * 1024 * 1024
+
+# Upper limit for the one-hot encoded rows of close_pairs() in bytes
+ONEHOT_SIZE = 128 * 1024 * 1024
+
+# Number of candidate pairs handed to a worker process at once by
+# close_pairs_python(). Fewer candidates are checked without a pool.
+CHUNK_SIZE = 20000
+
+# Rows compared by the worker processes of close_pairs_python()
+worker_rows = None
+
+def collect_registrations(inputs):
+    '''
+    Reads the given backup directories lazily and returns a list of
+    (input_dir, bank_number, registration) tuples for all non-empty
+    registrations.
+    '''
+    entries = []
+
+    for input_dir in inputs:
+        for bank in regbank.read_banks(input_dir, lazy=True):
+            for registration in bank.registrations:
+                if not registration.empty:
+                    entries.append((input_dir, bank.number, registration))
+
+    return entries
+
+def close_pairs(matrix, max_distance):
+    '''
+    Returns a list of (i, j) tuples with i < j for all rows of a NumPy uint8
+    matrix which differ in at most max_distance bytes.
+
+    Columns with the same byte in all rows are dropped first. If the
+    remaining columns don't contain too many different values, each row
+    is one-hot encoded per (column, value) pair, so that the number of
+    equal bytes of all pairs is a matrix product. Otherwise the rows are
+    compared directly. Both ways work on blocks of rows to limit the memory
+    used.
+    '''
+    count = matrix.shape[0]
+    varying = numpy.flatnonzero((matrix != matrix[0]).any(axis=0))
+    matrix = matrix[:, varying]
+    width = len(varying)
+    pairs = []
+
+    if width <= max_distance:
+        return [(i, j) for i in range(count) for j in range(i + 1, count)]
+
+    codes = matrix.astype(numpy.int32) + numpy.arange(width, dtype=numpy.int32) * 256
+    values, inverse = numpy.unique(codes, return_inverse=True)
+
+    if count * len(values) * 4 <= ONEHOT_SIZE:
+        onehot = numpy.zeros((count, len(values)), numpy.float32)
+        onehot[numpy.repeat(numpy.arange(count), width), inverse.ravel()] = 1
+        rows = max(1, BLOCK_SIZE // (count * 4))
+
+        for start in range(0, count, rows):
+            end = min(count, start + rows)
+            distances = width - numpy.dot(onehot[start:end], onehot[start:].T)
+
+            for i, j in zip(*numpy.nonzero(distances <= max_distance + 0.5)):
+                if i < j:
+                    pairs.append((start + int(i), start + int(j)))
+
+        return pairs
+
+    rows = max(1, int((BLOCK_SIZE // width) ** 0.5))
+
+    for start in range(0, count, rows):
+        end = min(count, start + rows)
+
+        for other in range(start, count, rows):
+            other_end = min(count, other + rows)
+            distances = (matrix[start:end, None, :] != matrix[None, other:other_end, :]).sum(axis=2)
+
+            for i, j in zip(*numpy.nonzero(distances <= max_distance)):
+                if start + i < other + j:
+                    pairs.append((start + int(i), other + int(j)))
+
+    return pairs
+
+def within_distance(a, b, max_distance):
+    '''
+    Returns whether two byte strings of the same length differ in at most
+    max_distance bytes. Stops as soon as more bytes differ.
+    '''
+    distance = 0
+
+    for x, y in zip(a, b):
+        if x != y:
+            distance += 1
+
+            if distance > max_distance:
+                return False
+
+    return True
+
+def init_worker(rows):
+    global worker_rows
+    worker_rows = rows
+
+def check_candidates(arguments):
+    '''
+    Pool job: Returns the candidate pairs of worker_rows which really are
+    close.
+    '''
+    candidates, max_distance = arguments
+    return [(i, j) for i, j in candidates if within_distance(worker_rows[i], worker_rows[j], max_distance)]
+
+def close_pairs_python(payloads, max_distance, jobs=0):
+    '''
+    Same as close_pairs() for a list of byte strings, without NumPy.
+
+    Columns with the same byte in all payloads are dropped first. The other
+    columns are split into max_distance + 1 segments. Two rows which differ
+    in at most max_distance bytes must be equal in at least one segment,
+    so only rows sharing a segment are compared as candidates, instead of
+    all pairs. The candidates are checked with a pool of jobs worker
+    processes (0 = one per CPU) in chunks of CHUNK_SIZE.
+    '''
+    count = len(payloads)
+
+    if count < 2:
+        return []
+
+    columns = [offset - 32 for offset in differing_offsets(payloads)]
+    width = len(columns)
+
+    if width <= max_distance:
+        return [(i, j) for i in range(count) for j in range(i + 1, count)]
+
+    rows = []
+
+    for payload in payloads:
+        payload = bytearray(payload)
+        rows.append(bytes(bytearray(payload[column] for column in columns)))
+
+    segments = max_distance + 1
+    bounds = [width * k // segments for k in range(segments + 1)]
+    candidates = set()
+
+    for start, end in zip(bounds, bounds[1:]):
+        buckets = {}
+
+        for i, row in enumerate(rows):
+            buckets.setdefault(row[start:end], []).append(i)
+
+        for bucket in buckets.values():
+            for a in range(len(bucket)):
+                for b in range(a + 1, len(bucket)):
+                    candidates.add((bucket[a], bucket[b]))
+
+    candidates = sorted(candidates)
+
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs == 1 or len(candidates) <= CHUNK_SIZE:
+        init_worker(rows)
+
+        try:
+            return check_candidates((candidates, max_distance))
+        finally:
+            init_worker(None)
+
+    chunks = [(candidates[i:i + CHUNK_SIZE], max_distance) for i in range(0, len(candidates), CHUNK_SIZE)]
+    pool = multiprocessing.Pool(min(jobs, len(chunks)), init_worker, (rows,))
+    pairs = []
+
+    try:
+        for result in pool.imap(check_candidates, chunks):
+            pairs.extend(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return pairs
+
+def differing_offsets(payloads):
+    '''
+    Returns the sorted offsets where not all of the given payloads of the
+    same length contain the same byte. Offsets are counted from the start
+    of the REGxxx header like patch_regs.py expects.
+    '''
+    if numpy is not None:
+        matrix = numpy.array([numpy.frombuffer(payload, numpy.uint8) for payload in payloads])
+        return [int(offset) + 32 for offset in numpy.flatnonzero((matrix != matrix[0]).any(axis=0))]
+
+    offsets = []
+
+    for i, values in enumerate(zip(*[bytearray(payload) for payload in payloads])):
+        if values.count(values[0]) != len(values):
+            offsets.append(i + 32)
+
+    return offsets
+
+def cluster_registrations(entries, max_distance=16, jobs=0):
+    '''
+    Groups registrations as returned by collect_registrations() whose
+    payloads have the same length and differ in at most max_distance bytes.
+    Groups are transitive: If A is close to B and B is close to C, all three
+    end up in the same cluster even if A and C differ more.
+
+    Identical payloads are merged before comparing, so each distinct
+    payload is only compared once. Without NumPy the comparisons run on a
+    pool of jobs worker processes (see close_pairs_python()). Returns a
+    list of dictionaries like the following, largest clusters first.
+    Registrations without any near duplicate are not returned.
+
+    {
+        "members": [(input_dir, bank_number, registration), ...],
+        "offsets": [633, 634, ...],
+    }
+    '''
+    groups = {}
+
+    for entry in entries:
+        data = bytes(entry[2].data)
+        groups.setdefault(len(data), {}).setdefault(data, []).append(entry)
+
+    clusters = []
+
+    for length in sorted(groups):
+        payloads = list(groups[length])
+
+        if numpy is not None and len(payloads) > 1:
+            matrix = numpy.empty((len(payloads), length), numpy.uint8)
+
+            for row, payload in enumerate(payloads):
+                matrix[row] = numpy.frombuffer(payload, numpy.uint8)
+
+            pairs = close_pairs(matrix, max_distance)
+        else:
+            pairs = close_pairs_python(payloads, max_distance, jobs)
+
+        parents = list(range(len(payloads)))
+
+        def root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+
+            return i
+
+        for i, j in pairs:
+            parents[root(i)] = root(j)
+
+        members = {}
+
+        for i in range(len(payloads)):
+            members.setdefault(root(i), []).append(i)
+
+        for rows in sorted(members.values()):
+            cluster = []
+
+            for row in rows:
+                cluster.extend(groups[length][payloads[row]])
+
+            if len(cluster) > 1:
+                clusters.append({
+                    "members": cluster,
+                    "offsets": differing_offsets([payloads[row] for row in rows]),
+                })
+
+    clusters.sort(key=lambda cluster: -len(cluster["members"]))
+    return clusters
+
+def format_offsets(offsets):
+    '''
+    Returns a list of offsets as text with contiguous offsets shortened to
+    ranges, e.g. "633-634, 700".
+    '''
+    ranges = []
+
+    for offset in offsets:
+        if ranges and ranges[-1][1] == offset - 1:
+            ranges[-1][1] = offset
+        else:
+            ranges.append([offset, offset])
+
+    return ", ".join(
+        str(start) if start == end else "%s-%s" % (start, end)
+        for start, end in ranges
+    )
+
+def write_clusters(clusters, output_file):
+    '''
+    Prints the clusters found by cluster_registrations() in a human-readable
+    form. Bank and registration numbers are counted from 1 like in map
+    files.
+    '''
+    for number, cluster in enumerate(clusters):
+        output_file.write("Cluster %s: %s registrations, %s differing bytes\n" % (
+            number + 1, len(cluster["members"]), len(cluster["offsets"]),
+        ))
+
+        for input_dir, bank_number, registration in cluster["members"]:
+            output_file.write("  %s  %02d|%s|%s\n" % (
+                input_dir, bank_number + 1, registration.number + 1, registration.name,
+            ))
+
+        if cluster["offsets"]:
+            output_file.write("  offsets: %s\n" % format_offsets(cluster["offsets"]))
+
+        output_file.write("\n")
@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: psr-9000 registration comparison (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def find_runs(old_data, new_data):
+    '''
+    Compares two registration payloads (the data field of read_banks()) and
+    returns a list of (offset, old_bytes, new_bytes) tuples, one for each
+    run of contiguous changed bytes. Offsets are counted from the start of
+    the REGxxx header like the --seek option of patch_regs.py expects. Only
+    the common length of both payloads is compared.
+    '''
+    length = min(len(old_data), len(new_data))
+    old_data = bytearray(old_data[:length])
+    new_data = bytearray(new_data[:length])
+
+    if numpy is not None:
+        changed = numpy.frombuffer(old_data, numpy.uint8) != numpy.frombuffer(new_data, numpy.uint8)
+        return runs_from_mask(changed, old_data, new_data)
+
+    runs = []
+    start = None
+
+    for i in range(length + 1):
+        if i < length and old_data[i] != new_data[i]:
+            if start is None:
+                start = i
+        elif start is not None:
+            runs.append((start + 32, bytes(old_data[start:i]), bytes(new_data[start:i])))
+            start = None
+
+    return runs
+
+def runs_from_mask(changed, old_data, new_data):
+    '''
+    Turns a NumPy boolean array of changed positions into the list of runs
+    described at find_runs().
+    '''
+    positions = numpy.flatnonzero(changed)
+
+    if not len(positions):
+        return []
+
+    breaks = numpy.flatnonzero(numpy.diff(positions) > 1) + 1
+    starts = positions[numpy.concatenate(([0], breaks))]
+    ends = positions[numpy.concatenate((breaks - 1, [len(positions) - 1]))] + 1
+
+    return [
+        (int(start) + 32, bytes(old_data[start:end]), bytes(new_data[start:end]))
+        for start, end in zip(starts, ends)
+    ]
+
+def pair_banks(old_banks, new_banks):
+    '''
+    Returns a list of (old_bank, old_registration, new_bank, new_registration)
+    tuples for all registrations which are non-empty in both bank lists and
+    sit at the same bank and registration number.
+    '''
+    new_registrations = {}
+    pairs = []
+
+    for bank in new_banks:
+        for registration in bank.registrations:
+            new_registrations[(bank.number, registration.number)] = (bank, registration)
+
+    for bank in old_banks:
+        for registration in bank.registrations:
+            if registration.empty:
+                continue
+
+            new_bank, new_registration = new_registrations.get((bank.number, registration.number), (None, None))
+
+            if new_registration is None or new_registration.empty:
+                continue
+
+            pairs.append((bank, registration, new_bank, new_registration))
+
+    return pairs
+
+def diff_pairs(pairs):
+    '''
+    Compares a list of registration pairs as returned by pair_banks() and
+    returns a list of dictionaries like the following, one for each pair:
+
+    {
+        "old_bank": 0,
+        "old": <Registration>,
+        "new_bank": 0,
+        "new": <Registration>,
+        "runs": [(633, b"\\x02\\x10", b"\\x31\\x0f"), ...],
+    }
+
+    With NumPy all pairs of the same payload length are stacked into two
+    matrices and compared in a single vectorized operation. Otherwise each
+    pair is compared on its own.
+    '''
+    results = []
+    groups = {}
+
+    for old_bank, old, new_bank, new in pairs:
+        results.append({
+            "old_bank": old_bank.number,
+            "old": old,
+            "new_bank": new_bank.number,
+            "new": new,
+            "runs": [],
+        })
+
+        if numpy is None:
+            results[-1]["runs"] = find_runs(old.data, new.data)
+        else:
+            length = min(len(old.data), len(new.data))
+            groups.setdefault(length, []).append(results[-1])
+
+    for length, group in groups.items():
+        if not length:
+            continue
+
+        old_matrix = numpy.empty((len(group), length), numpy.uint8)
+        new_matrix = numpy.empty((len(group), length), numpy.uint8)
+
+        for row, result in enumerate(group):
+            old_matrix[row] = numpy.frombuffer(result["old"].data, numpy.uint8, length)
+            new_matrix[row] = numpy.frombuffer(result["new"].data, numpy.uint8, length)
+
+        changed = old_matrix != new_matrix
+
+        for row in numpy.flatnonzero(changed.any(axis=1)):
+            group[row]["runs"] = runs_from_mask(changed[row], old_matrix[row].tobytes(), new_matrix[row].tobytes())
+
+    return results
+
+def shorten(data, length=16):
+    '''
+    Returns the hex-string of the given bytes, cut after length bytes.
+    '''
+    text = binascii.hexlify(data[:length]).decode("ascii")
+
+    if len(data) > length:
+        text += "..."
+
+    return text
+
+def write_diff(results, output_file):
+    '''
+    Prints the differences found by diff_pairs() in a human-readable form.
+    Bank and registration numbers are counted from 1 like in map files.
+    Pairs without differences are skipped.
+    '''
+    for result in results:
+        old = result["old"]
+        new = result["new"]
+
+        if not result["runs"] and old.size == new.size:
+            continue
+
+        output_file.write("%02d|%s|%s <-> %02d|%s|%s\n" % (
+            result["old_bank"] + 1, old.number + 1, old.name,
+            result["new_bank"] + 1, new.number + 1, new.name,
+        ))
+
+        if old.size != new.size:
+            output_file.write("  size %s -> %s\n" % (old.size, new.size))
+
+        for offset, old_bytes, new_bytes in result["runs"]:
+            output_file.write("  %5s (0x%03x) %3s bytes  %s -> %s\n" % (
+                offset, offset, len(new_bytes), shorten(old_bytes), shorten(new_bytes),
+            ))
+
+        output_file.write("\n")
+
+def write_patch_spec(results, output_file):
+    '''
+    Writes a patch file as read by regpatch.read_patch_spec(), which sets the
+    bytes of all changes found by diff_pairs() to their new values. Changes
+    are collected byte by byte, so changes found in several pairs may
+    overlap as long as they agree. Neighbouring bytes are joined into one
+    patch line again.
+
+    Raises a ValueError if the pairs contain different new values for the
+    same byte, because they cannot be combined into one patch then.
+    '''
+    values = {}
+
+    for result in results:
+        for offset, old_bytes, new_bytes in result["runs"]:
+            for i, value in enumerate(bytearray(new_bytes)):
+                if values.setdefault(offset + i, value) != value:
+                    raise ValueError("Registrations differ inconsistently at offset %s" % (offset + i))
+
+    patches = []
+
+    for offset in sorted(values):
+        if patches and patches[-1][0] + len(patches[-1][1]) == offset:
+            patches[-1][1].append(values[offset])
+        else:
+            patches.append((offset, bytearray([values[offset]])))
+
+    for offset, new_bytes in patches:
+        output_file.write("%s|%s\n" % (offset, binascii.hexlify(bytes(new_bytes)).decode("ascii")))
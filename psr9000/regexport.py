@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: columnar export of registrations (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json, os, struct
+import psr9000.regbank as regbank
+
+# Columns written by export_registrations() with their NumPy type
+COLUMNS = (
+    ("bank", "|u1"),
+    ("registration", "|u1"),
+    ("name", "|S16"),
+    ("size", "<i4"),
+    ("empty", "|b1"),
+    ("source", "<i4"),
+)
+
+def write_npy_header(npy_file, descr, shape):
+    '''
+    Writes the header of a NumPy .npy file (format version 1.0). The data
+    must follow in C order. The header is padded so that the data starts
+    at a multiple of 64 bytes, which NumPy expects for memory mapping.
+    '''
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%s), }" % (
+        descr, "".join("%d," % value for value in shape),
+    )
+
+    padding = 64 - (10 + len(header) + 1) % 64
+    header = header + " " * (padding % 64) + "\n"
+
+    npy_file.write(b"\x93NUMPY\x01\x00")
+    npy_file.write(struct.pack("<H", len(header)))
+    npy_file.write(header.encode("ascii"))
+
+def export_registrations(inputs, output_dir):
+    '''
+    Writes all registrations of the given backup directories into a
+    columnar store, which is a directory with the following files:
+
+      payload.npy       uint8 matrix with one row per registration
+      bank.npy          bank numbers (counted from 0)
+      registration.npy  registration numbers (counted from 0)
+      name.npy          registration names (16 bytes)
+      size.npy          registration sizes as in the registration header
+      empty.npy         True for empty registrations
+      source.npy        index of the backup in sources.json
+      sources.json      list of the backup directories
+
+    Each payload row contains the data field of read_banks(), so column
+    i of the matrix is offset i + 32 in patch_regs.py terms. Rows are padded
+    with zeros to the largest payload. All files can be opened with
+    numpy.load(..., mmap_mode="r"), see open_registrations(). NumPy is not
+    needed for the export itself.
+
+    The backups are read twice, first to find the matrix size and then to
+    copy the payloads, so that only one backup is held in memory at a time.
+    Returns the number of exported registrations.
+    '''
+    count = 0
+    width = 0
+
+    for input_dir in inputs:
+        for bank in regbank.read_banks(input_dir, lazy=True):
+            for registration in bank.registrations:
+                count += 1
+                width = max(width, len(registration.data))
+
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    column_files = {}
+
+    for column, descr in COLUMNS:
+        column_files[column] = open(os.path.join(output_dir, column + ".npy"), "wb")
+        write_npy_header(column_files[column], descr, (count,))
+
+    payload_file = open(os.path.join(output_dir, "payload.npy"), "wb")
+    write_npy_header(payload_file, "|u1", (count, width))
+
+    for source, input_dir in enumerate(inputs):
+        for bank in regbank.read_banks(input_dir, lazy=True):
+            for registration in bank.registrations:
+                data = registration.data
+                payload_file.write(data)
+                payload_file.write(b"\x00" * (width - len(data)))
+
+                column_files["bank"].write(struct.pack("<B", bank.number))
+                column_files["registration"].write(struct.pack("<B", registration.number))
+                column_files["name"].write(struct.pack("16s", registration.name))
+                column_files["size"].write(struct.pack("<i", registration.size))
+                column_files["empty"].write(struct.pack("<?", registration.empty))
+                column_files["source"].write(struct.pack("<i", source))
+
+    payload_file.close()
+
+    for column_file in column_files.values():
+        column_file.close()
+
+    sources_file = open(os.path.join(output_dir, "sources.json"), "w")
+    json.dump([os.path.abspath(input_dir) for input_dir in inputs], sources_file, indent=4)
+    sources_file.close()
+
+    return count
+
+def open_registrations(store_dir):
+    '''
+    Opens a columnar store written by export_registrations() and returns a
+    dictionary with a memory mapped NumPy array for each column, including
+    "payload", plus "sources" with the list of backup directories. Nothing
+    is read until the arrays are accessed. Requires NumPy.
+    '''
+    import numpy
+
+    store = {}
+
+    for column in ["payload"] + [column for column, descr in COLUMNS]:
+        store[column] = numpy.load(os.path.join(store_dir, column + ".npy"), mmap_mode="r")
+
+    sources_file = open(os.path.join(store_dir, "sources.json"), "r")
+    store["sources"] = json.load(sources_file)
+    sources_file.close()
+
+    return store
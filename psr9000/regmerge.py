@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: merge registrations of several backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import multiprocessing.pool
+import psr9000.archive as archive
+import psr9000.batch as batch
+import psr9000.instrument as instrument
+import psr9000.regbank as regbank
+
+# Default number of backups loaded at the same time
+LOAD_THREADS = 8
+
+def source_name(path):
+    '''
+    Returns the name under which a backup can be referenced in map files if
+    no name is given: its file name without extension, e.g. "live2010" for
+    "backups/live2010.usr" or "backups/live2010.tar.gz".
+    '''
+    name = os.path.basename(os.path.normpath(path))
+    suffix = archive.archive_suffix(name)
+
+    if suffix:
+        return name[:-len(suffix)]
+
+    return os.path.splitext(name)[0]
+
+def parse_sources(specs):
+    '''
+    Takes a list of source backups given as "NAME=PATH" or just "PATH" (see
+    source_name()) and returns a dictionary which maps names to paths.
+    Raises a ValueError if two sources share the same name.
+    '''
+    sources = {}
+
+    for spec in specs:
+        if "=" in spec:
+            name, path = spec.split("=", 1)
+            name = name.strip()
+        else:
+            name, path = source_name(spec), spec
+
+        if not name:
+            raise ValueError("Missing source name: %s" % spec)
+        elif name in sources:
+            raise ValueError("Several sources named %s" % name)
+
+        sources[name] = path
+
+    return sources
+
+def map_references(registration_map):
+    '''
+    Returns a dictionary with the (bank, registration) numbers and the
+    lowercase names referenced by a registration map for each source. The
+    key None stands for unqualified registrations.
+    '''
+    references = {}
+
+    for map_bank in registration_map:
+        for map_registration in map_bank["registrations"]:
+            if map_registration["empty"]:
+                continue
+
+            positions, names = references.setdefault(map_registration.get("source"), (set(), set()))
+
+            if map_registration["bank"] is None and map_registration["registration"] is None:
+                names.add(map_registration["name"].strip().lower())
+            else:
+                positions.add((map_registration["bank"], map_registration["registration"]))
+
+    return references
+
+@instrument.phase("read_payloads")
+def read_payloads(registrations):
+    '''
+    Loads the payloads of lazily read registrations into memory. Each
+    Regist.reg file is opened once and read with plain seeks and reads in
+    ascending offset order, instead of faulting in pages of the mapped
+    file. So the disk is read sequentially and other threads keep running
+    while it is busy.
+
+    Bytes read from files are counted like in copy_range(). Backups from
+    archives have already been counted when they were read into memory.
+    '''
+    files = {}
+    bytes_read = 0
+    syscalls = 0
+    located = []
+
+    for registration in registrations:
+        location = registration.data_location()
+
+        if location:
+            source, offset, length = location
+            located.append((source.path, offset, length, source, registration))
+
+    located.sort(key=lambda entry: entry[:2])
+
+    try:
+        for path, offset, length, source, registration in located:
+            if isinstance(source, regbank.RegistrationBuffer):
+                registration.data = bytes(source.read(offset, length))
+                continue
+
+            if not path in files:
+                files[path] = open(path, "rb")
+                syscalls += 1
+
+            files[path].seek(offset)
+            registration.data = files[path].read(length)
+            bytes_read += len(registration.data)
+            syscalls += 2
+    finally:
+        for source_file in files.values():
+            source_file.close()
+
+        instrument.count("bytes_read", bytes_read)
+        instrument.count("syscalls", syscalls + len(files))
+
+def load_source(arguments):
+    '''
+    Pool job: Reads the index of a backup and loads the payloads of the
+    referenced registrations only (see read_payloads()). The file is closed
+    afterwards, so that many backups can be merged without running out of
+    file handles. Returns the list of banks with all other registrations
+    left out.
+    '''
+    input_dir, positions, names, use_cache = arguments
+    batch.check_input(input_dir)
+    banks = batch.read_input(input_dir, use_cache)
+    referenced = []
+
+    for bank in banks:
+        bank.registrations = [
+            registration for registration in bank.registrations
+            if (bank.number, registration.number) in positions
+            or (not registration.empty and registration.name.strip().lower() in names)
+        ]
+
+        referenced.extend(bank.registrations)
+
+    read_payloads(referenced)
+
+    for source in set(registration.source for registration in referenced if registration.source):
+        source.close()
+
+    return banks
+
+def load_sources(sources, registration_map, input_dir=None, jobs=LOAD_THREADS, use_cache=False):
+    '''
+    Loads all backups referenced by a registration map concurrently in a
+    pool of jobs threads. sources maps source names to backup paths (see
+    parse_sources()). Unqualified registrations are taken from input_dir.
+    Only the referenced registrations are read (see load_source()). Threads
+    are used instead of processes, because reading is bound by the disk and
+    lazily read registrations cannot be passed between processes anyway.
+
+    Returns a SourceIndex for rearrange_registrations(). Raises a
+    ValueError if the map references unknown sources or a backup cannot be
+    read.
+    '''
+    references = map_references(registration_map)
+    sources = dict(sources)
+
+    if input_dir is not None:
+        sources[None] = input_dir
+    elif None in references:
+        raise ValueError("Registrations without source need an input backup")
+
+    unknown = sorted(name for name in references if not name in sources)
+
+    if unknown:
+        raise ValueError("Unknown sources in map file: %s" % ", ".join(unknown))
+
+    names = sorted(references, key=lambda name: (name is not None, name))
+    work = [(sources[name],) + references[name] + (use_cache,) for name in names]
+
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs == 1 or len(work) < 2:
+        results = [load_source(arguments) for arguments in work]
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(work)))
+
+        try:
+            results = pool.map(load_source, work, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return SourceIndex(dict(
+        (name, regbank.RegistrationIndex(banks)) for name, banks in zip(names, results)
+    ))
+
+class SourceIndex(object):
+    '''
+    Lookup table for registrations of several backups with one
+    RegistrationIndex per source name. It can be passed to
+    rearrange_registrations() instead of a RegistrationIndex.
+    '''
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def find(self, map_registration):
+        source = map_registration.get("source")
+
+        try:
+            index = self.indexes[source]
+        except KeyError:
+            raise KeyError("Unknown source %s" % source)
+
+        map_registration = dict(map_registration, source=None)
+
+        if source is None:
+            return index.find(map_registration)
+
+        try:
+            return index.find(map_registration)
+        except KeyError as err:
+            raise KeyError("%s: %s" % (source, err.args[0]))
+
+def merge_registrations(sources, registration_map, input_dir=None, jobs=LOAD_THREADS, use_cache=False):
+    '''
+    Returns a new bank list as created by rearrange_registrations() with
+    registrations from all sources (see load_sources()). It can be written
+    with write_banks(). Raises a KeyError if registrations cannot be found.
+    '''
+    index = load_sources(sources, registration_map, input_dir, jobs, use_cache)
+    return regbank.rearrange_registrations([], registration_map, index)
@@ -0,0 +1,444 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: psr-9000 registration patch library (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, tempfile
+import psr9000.archive as archive
+import psr9000.instrument as instrument
+import psr9000.regbank as regbank
+import psr9000.userfiles as userfiles
+
+# NumPy is imported on first use by load_numpy(), because importing it
+# takes longer than patching a typical backup. numpy_checked tells whether
+# the import has already been tried.
+numpy = None
+numpy_checked = False
+
+def load_numpy():
+    '''
+    Imports NumPy unless this has already been tried and returns it, or
+    None if it is not installed.
+    '''
+    global numpy, numpy_checked
+
+    if not numpy_checked:
+        numpy_checked = True
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+    return numpy
+
+def parse_offset(offset):
+    '''
+    Parses a decimal offset or a hex offset with 0x prefix.
+    '''
+    offset = offset.strip().lower()
+
+    if offset.startswith("0x"):
+        return int(offset[2:], 16)
+    else:
+        return int(offset, 10)
+
+def read_patch_spec(spec_file):
+    '''
+    Reads a patch specification from the given data stream. Each line
+    contains one patch with two or three fields separated by the pipe symbol:
+
+    # Volume pedal
+    633|310f
+    0x280|02
+    # Only where offset 640 currently contains 02 and 641 doesn't contain ff
+    633|310f|640=02,641!=ff
+
+    The first field is the seek position inside each registration, counted
+    from the start of the REGxxx header just like the --seek option of
+    patch_regs.py. It may be given as decimal or as hex number with 0x
+    prefix. The second field contains a hex-string with the new bytes.
+    The optional third field contains comma-separated conditions. A patch
+    is only applied to registrations which fulfill all of its conditions.
+    Empty lines and lines starting with # are ignored.
+
+    Returns a list of (offset, bytearray, conditions) tuples as expected by
+    check_patches(), where conditions is a list of (offset, bytearray, equal)
+    tuples. Raises a ValueError if the specification contains syntax errors.
+    '''
+    patches = []
+
+    def syntax_error(msg, line):
+        raise ValueError("Syntax error in patch file\n%s\n%s" % (msg, line))
+
+    for line in spec_file:
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        fields = line.split("|")
+
+        if not len(fields) in (2, 3):
+            syntax_error("Expected 2 or 3 fields but got %s" % len(fields), line)
+
+        conditions = []
+
+        try:
+            offset = parse_offset(fields[0])
+            new_bytes = bytearray.fromhex(fields[1].strip())
+
+            if len(fields) == 3:
+                for condition in fields[2].split(","):
+                    equal = not "!=" in condition
+                    condition = condition.replace("!=", "=").split("=")
+
+                    if len(condition) != 2:
+                        raise ValueError("Conditions must look like 640=02 or 640!=02")
+
+                    conditions.append((parse_offset(condition[0]), bytearray.fromhex(condition[1].strip()), equal))
+        except ValueError as err:
+            syntax_error(str(err), line)
+
+        if not new_bytes or [condition for condition in conditions if not condition[1]]:
+            syntax_error("No bytes given", line)
+
+        patches.append((offset, new_bytes, conditions))
+
+    return patches
+
+def check_patches(patches):
+    '''
+    Takes a list of (offset, bytes) or (offset, bytes, conditions) tuples,
+    with offsets relative to the REGxxx header of a registration, and returns
+    them as (offset, bytes, conditions) tuples sorted by offset. Raises a
+    ValueError if a patch or condition touches the 32 byte registration
+    header or if two patches overlap.
+    '''
+    patches = sorted([(patch[0], patch[1], tuple(patch[2]) if len(patch) > 2 else ()) for patch in patches],
+                     key=lambda patch: patch[0])
+    end = 32
+
+    for offset, new_bytes, conditions in patches:
+        if offset < 32:
+            raise ValueError("Patch at offset %s would overwrite the registration header" % offset)
+        elif offset < end:
+            raise ValueError("Patch at offset %s overlaps with the previous patch" % offset)
+
+        for condition_offset, value, equal in conditions:
+            if condition_offset < 32:
+                raise ValueError("Condition at offset %s would test the registration header" % condition_offset)
+
+        end = offset + len(new_bytes)
+
+    return patches
+
+def check_sizes(banks, patches):
+    '''
+    Raises a ValueError if the unconditional patches of a list returned by
+    check_patches() don't fit into all non-empty registrations of the given
+    banks. The message lists all registrations that are too short.
+    Conditional patches are skipped for registrations that are too short.
+    '''
+    end = max([offset + len(new_bytes) for offset, new_bytes, conditions in patches if not conditions] or [0])
+    errors = []
+
+    for bank in banks:
+        for registration in bank.registrations:
+            if registration.empty:
+                continue
+
+            if end > 32 + len(registration.data):
+                errors.append("Patches up to offset %s exceed registration %s in bank %s (%s bytes)" % (
+                    end, registration.number + 1, bank.number + 1, 32 + len(registration.data)
+                ))
+
+    if errors:
+        raise ValueError("\n".join(errors))
+
+def matches(data, offset, new_bytes, conditions):
+    '''
+    Returns True if a patch with the given conditions shall be applied to a
+    registration with the given payload. This is the case if the payload is
+    long enough for the patch and all conditions and if all conditions are
+    fulfilled.
+    '''
+    if offset - 32 + len(new_bytes) > len(data):
+        return False
+
+    for condition_offset, value, equal in conditions:
+        start = condition_offset - 32
+
+        if start + len(value) > len(data):
+            return False
+        elif (bytearray(data[start:start + len(value)]) == value) != equal:
+            return False
+
+    return True
+
+def patch_registration(registration, patches):
+    '''
+    Applies a list of patches as returned by check_patches() to a single
+    registration. All conditions are checked against the original payload
+    before anything is changed. The data field is turned into a bytearray
+    once and then modified in place. Returns True if anything was patched.
+    '''
+    data = registration.data
+    patches = [patch for patch in patches if matches(data, *patch)]
+
+    if not patches:
+        return False
+
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+        registration.data = data
+
+    for offset, new_bytes, conditions in patches:
+        start = offset - 32
+        data[start:start + len(new_bytes)] = new_bytes
+
+    return True
+
+def patch_matrix(registrations, patches):
+    '''
+    Vectorized version of patch_registration() for many registrations. All
+    payloads are copied into one NumPy matrix, padded to the largest size.
+    Each condition is then evaluated for all registrations at once and the
+    patches are written as masked assignments. Finally only the payloads of
+    the registrations which have been changed are replaced.
+    '''
+    lengths = numpy.array([len(registration.data) for registration in registrations])
+    matrix = numpy.zeros((len(registrations), max(lengths.max(), 1)), numpy.uint8)
+
+    for row, registration in enumerate(registrations):
+        # Older NumPy versions refuse to read from an empty buffer
+        if lengths[row]:
+            matrix[row, :lengths[row]] = numpy.frombuffer(registration.data, numpy.uint8, lengths[row])
+
+    masks = []
+    changed = numpy.zeros(len(registrations), bool)
+
+    for offset, new_bytes, conditions in patches:
+        mask = lengths >= offset - 32 + len(new_bytes)
+
+        for condition_offset, value, equal in conditions:
+            start = condition_offset - 32
+            end = start + len(value)
+
+            if end > matrix.shape[1]:
+                mask[:] = False
+                continue
+
+            found = (matrix[:, start:end] == numpy.frombuffer(bytes(value), numpy.uint8)).all(axis=1)
+            mask &= (lengths >= end) & (found if equal else ~found)
+
+        masks.append(mask)
+
+    for (offset, new_bytes, conditions), mask in zip(patches, masks):
+        start = offset - 32
+        matrix[mask, start:start + len(new_bytes)] = numpy.frombuffer(bytes(new_bytes), numpy.uint8)
+        changed |= mask
+
+    for row in numpy.flatnonzero(changed):
+        registrations[row].data = bytearray(matrix[row, :lengths[row]].tobytes())
+
+    return int(changed.sum())
+
+@instrument.phase("patch_banks")
+def patch_banks(banks, patches):
+    '''
+    Takes a list of registration banks as created by read_banks() and a list
+    of patches as described at check_patches(). All non-empty registrations
+    in all banks are patched accordingly in a single pass. Conditions of
+    conditional patches are always checked against the unpatched data.
+
+    If NumPy is available (see load_numpy()) all registrations are patched
+    at once with patch_matrix(). Otherwise each registration is patched on
+    its own with patch_registration().
+
+    Returns the number of patched registrations. Raises a ValueError if the
+    patches are invalid (see check_patches()) or unconditional patches don't
+    fit into all registrations. Nothing is changed in that case.
+    '''
+    patches = check_patches(patches)
+
+    if not patches:
+        return 0
+
+    check_sizes(banks, patches)
+    registrations = []
+
+    for bank in banks:
+        for registration in bank.registrations:
+            if not registration.empty:
+                registrations.append(registration)
+
+    if not registrations:
+        return 0
+    elif load_numpy() is not None:
+        amount = patch_matrix(registrations, patches)
+    else:
+        amount = len([registration for registration in registrations if patch_registration(registration, patches)])
+
+    if instrument.hooks:
+        instrument.count("bytes_read", sum(len(registration.data) for registration in registrations))
+        instrument.count("objects", amount)
+
+    return amount
+
+def write_at(output_file, offset, data):
+    '''
+    Writes the data at the given absolute position of a file opened for
+    writing. Uses a single pwrite() system call where available.
+    '''
+    if hasattr(os, "pwrite"):
+        os.pwrite(output_file.fileno(), data, offset)
+    else:
+        output_file.seek(offset)
+        output_file.write(data)
+
+def sync_directory(path):
+    '''
+    Syncs a directory to disk, so that a file renamed into it survives a
+    crash. Does nothing on platforms which cannot open directories.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+@instrument.phase("patch_file")
+def patch_file(input_dir, patches, output_dir=None, direct=False):
+    '''
+    Patches all non-empty registrations of a backup directly inside its
+    Regist.reg file. Patches never change any sizes, so only the index and
+    the registration headers are read (see read_banks(lazy=True)) in order
+    to compute the absolute file positions. Then only the patched bytes are
+    written. Everything else, including USERFILE.INI, stays untouched.
+
+    The patches are always applied to a temporary copy inside the output
+    directory, which is synced to disk and then atomically replaces
+    output_dir/Regist.reg. Without output_dir the input backup itself is
+    replaced that way, so an interrupted run (e.g. a USB stick pulled too
+    early) leaves either the old or the new file, never a half patched one.
+    The copy is made with userfiles.clone_file(), so on file systems with
+    reflinks (Btrfs, XFS) only the patched blocks take up new space. Other
+    file systems, like ext4 or the FAT and exFAT of USB sticks and SD cards,
+    get a full copy of Regist.reg for each run, even if only a few bytes
+    change. If the output directory doesn't exist yet, all other files of
+    the backup are carried over, too.
+
+    With direct=True and without output_dir, the patched bytes are written
+    straight into the input Regist.reg instead, which avoids the copy but
+    can leave a half patched file if the run is interrupted.
+
+    Returns the number of patched registrations. Raises a ValueError if the
+    patches are invalid or don't fit into all registrations, or if the
+    backup is an archive. Nothing is written in that case.
+    '''
+    if archive.is_archive(input_dir):
+        raise ValueError("Archives cannot be patched in place")
+
+    patches = check_patches(patches)
+
+    if not patches and output_dir is None:
+        return 0
+
+    banks = regbank.read_banks(input_dir, lazy=True)
+    writes = []
+    amount = 0
+    check_sizes(banks, patches)
+
+    for bank in banks:
+        for registration in bank.registrations:
+            if registration.empty:
+                continue
+
+            data = registration.data
+            found = False
+
+            for offset, new_bytes, conditions in patches:
+                if matches(data, offset, new_bytes, conditions):
+                    writes.append((registration.offset + offset, bytes(new_bytes)))
+                    found = True
+
+            amount += found
+
+    input_path = os.path.join(input_dir, "Regist.reg")
+    instrument.count("bytes_written", sum(len(new_bytes) for offset, new_bytes in writes))
+    instrument.count("syscalls", len(writes))
+
+    if output_dir is None:
+        if not writes:
+            return amount
+
+        if direct:
+            output_file = open(input_path, "r+b")
+
+            try:
+                for offset, new_bytes in writes:
+                    write_at(output_file, offset, new_bytes)
+
+                output_file.flush()
+                os.fsync(output_file.fileno())
+            finally:
+                output_file.close()
+
+            return amount
+
+        output_dir = input_dir
+
+    already_exists = os.path.exists(output_dir)
+
+    if not already_exists:
+        os.mkdir(output_dir)
+
+    fd, temp_path = tempfile.mkstemp(prefix=".Regist.reg.", dir=output_dir)
+    os.close(fd)
+
+    try:
+        userfiles.clone_file(input_path, temp_path, hardlink=False)
+        output_file = open(temp_path, "r+b")
+
+        for offset, new_bytes in writes:
+            write_at(output_file, offset, new_bytes)
+
+        output_file.flush()
+        os.fsync(output_file.fileno())
+        output_file.close()
+        os.rename(temp_path, os.path.join(output_dir, "Regist.reg"))
+        sync_directory(output_dir)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
+
+    if not already_exists:
+        for name in os.listdir(input_dir):
+            if name.lower() != "regist.reg" and os.path.isfile(os.path.join(input_dir, name)):
+                userfiles.clone_file(
+                    os.path.join(input_dir, name), os.path.join(output_dir, name), name.lower() != "userfile.ini",
+                )
+
+    return amount
@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: registration name search (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect, os, pickle, re, tempfile
+import psr9000.archive as archive
+import psr9000.cache as cache
+import psr9000.regbank as regbank
+
+def default_index_path():
+    '''
+    Returns the file where the name index is kept by default.
+    '''
+    return os.path.join(cache.default_cache_dir(), "names.idx")
+
+def split_words(name):
+    '''
+    Returns the lower-case words of a registration name.
+    '''
+    return [word for word in re.split("[^0-9a-z\x80-\xff]+", name.lower()) if word]
+
+def trigrams(name):
+    '''
+    Returns the set of all three character sequences of a name. Words are
+    padded with blanks so that word beginnings get a higher weight.
+    '''
+    text = "  " + " ".join(split_words(name)) + " "
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+class NameIndex(object):
+    '''
+    Persistent search index over the registration names of many backups.
+    Only the bank directory and registration headers of each backup are
+    read (see read_banks(..., lazy=True)), never the payloads. Backups are
+    only read again when their cache key (see cache.cache_key()) changes.
+
+    Besides the plain list of entries the index holds two lookup tables:
+    An inverted index from each word to the entries containing it, with a
+    sorted vocabulary for prefix queries, and a table from each trigram to
+    the entries containing it for fuzzy queries.
+    '''
+
+    def __init__(self):
+        self.backups = {}
+        self.entries = []
+        self.vocabulary = []
+        self.words = {}
+        self.trigrams = {}
+        self.errors = []
+
+    @classmethod
+    def load(cls, index_path):
+        '''
+        Loads an index saved by save(). Returns an empty index if the file
+        doesn't exist or cannot be read.
+        '''
+        try:
+            index_file = open(index_path, "rb")
+
+            try:
+                index = pickle.load(index_file)
+            finally:
+                index_file.close()
+
+            if isinstance(index, cls):
+                return index
+        except Exception:
+            pass
+
+        return cls()
+
+    def save(self, index_path):
+        '''
+        Atomically writes the index to the given file.
+        '''
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+
+        fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=index_dir)
+        temp_file = os.fdopen(fd, "wb")
+        pickle.dump(self, temp_file, 2)
+        temp_file.close()
+        os.rename(temp_path, index_path)
+
+    def update(self, input_dirs, check_all=True):
+        '''
+        Adds the given backup directories to the index and re-reads all
+        indexed backups which changed since, or with check_all=False only
+        the given ones. Backups which don't exist anymore are removed, and
+        so are backups which cannot be read. These are listed in the errors
+        attribute as (path, message) tuples, so that one broken backup
+        doesn't stop the others. Returns the number of backups read.
+        '''
+        paths = set(os.path.abspath(input_dir) for input_dir in input_dirs)
+        changed = False
+        count = 0
+        self.errors = []
+
+        if check_all:
+            paths.update(self.backups)
+
+        for path in sorted(paths):
+            if archive.is_archive(path):
+                registration_path = path
+            else:
+                registration_path = os.path.join(path, "Regist.reg")
+
+            try:
+                key, size = cache.cache_key(registration_path)
+            except EnvironmentError:
+                changed |= self.backups.pop(path, None) is not None
+                continue
+
+            if path in self.backups and self.backups[path][0] == key:
+                continue
+
+            names = []
+
+            try:
+                for bank in regbank.read_banks(path, lazy=True):
+                    for registration in bank.registrations:
+                        if not registration.empty and registration.name:
+                            names.append((bank.number, registration.number, registration.name))
+            except (EnvironmentError, ValueError) as err:
+                self.errors.append((path, str(err)))
+                changed |= self.backups.pop(path, None) is not None
+                continue
+
+            self.backups[path] = (key, names)
+            changed = True
+            count += 1
+
+        if changed or not self.entries:
+            self.build()
+
+        return count
+
+    def remove(self, input_dirs):
+        '''
+        Removes the given backup directories from the index.
+        '''
+        removed = [self.backups.pop(os.path.abspath(input_dir), None) for input_dir in input_dirs]
+
+        if [entry for entry in removed if entry is not None]:
+            self.build()
+
+    def build(self):
+        '''
+        Rebuilds the lookup tables from the indexed backups.
+        '''
+        self.entries = []
+        self.words = {}
+        self.trigrams = {}
+
+        for path in sorted(self.backups):
+            for bank_number, reg_number, name in self.backups[path][1]:
+                entry = len(self.entries)
+                self.entries.append((path, bank_number, reg_number, name))
+
+                for word in split_words(name):
+                    self.words.setdefault(word, set()).add(entry)
+
+                for trigram in trigrams(name):
+                    self.trigrams.setdefault(trigram, []).append(entry)
+
+        self.vocabulary = sorted(self.words)
+
+    def find_prefix(self, prefix):
+        '''
+        Returns the set of entries with a word starting with prefix.
+        '''
+        entries = set()
+        i = bisect.bisect_left(self.vocabulary, prefix)
+
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            entries.update(self.words[self.vocabulary[i]])
+            i += 1
+
+        return entries
+
+    def search(self, query, fuzzy=False, threshold=0.5):
+        '''
+        Searches registration names and returns a list of (score, path,
+        bank, registration, name) tuples with the best matches first.
+
+        By default every word of the query must be the beginning of a word
+        of the name, so "stand by" finds "Stand By Me". All such names have
+        a score of 1.0.
+
+        Fuzzy queries compare the trigrams of query and name instead, which
+        tolerates typos like "stnad by me". The score is the Dice coefficient
+        of both trigram sets and names scoring below threshold are skipped.
+        '''
+        results = []
+
+        if not fuzzy:
+            entries = None
+
+            for word in split_words(query):
+                if entries is None:
+                    entries = self.find_prefix(word)
+                else:
+                    entries &= self.find_prefix(word)
+
+            for entry in sorted(entries or []):
+                results.append((1.0,) + self.entries[entry])
+
+            return results
+
+        query_trigrams = trigrams(query)
+        shared = {}
+
+        for trigram in query_trigrams:
+            for entry in self.trigrams.get(trigram, []):
+                shared[entry] = shared.get(entry, 0) + 1
+
+        for entry, count in shared.items():
+            name = self.entries[entry][3]
+            score = 2.0 * count / (len(query_trigrams) + len(trigrams(name)))
+
+            if score >= threshold:
+                results.append((score,) + self.entries[entry])
+
+        results.sort(key=lambda result: (-result[0],) + result[1:])
+        return results
+
+def write_results(results, output_file):
+    '''
+    Prints search results as registration lines of a map file, so that they
+    can be pasted into the map of the backup they come from. Each backup
+    starts with a comment line containing its path, which is skipped by
+    read_registration_map().
+    '''
+    path = None
+
+    for score, result_path, bank_number, reg_number, name in results:
+        if result_path != path:
+            if path is not None:
+                output_file.write("\n")
+
+            path = result_path
+            output_file.write("# %s\n" % path)
+
+        output_file.write("%02d|%s|%s\n" % (bank_number + 1, reg_number + 1, name))
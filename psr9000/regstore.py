@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: content-addressed registration store (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib, json, os, tempfile
+import psr9000.instrument as instrument
+import psr9000.regbank as regbank
+import psr9000.regmerge as regmerge
+
+def hash_registration(registration):
+    '''
+    Returns the SHA-1 hex digest of the data field of a registration. The
+    name is not part of the hash, so renamed copies of a registration are
+    still stored only once.
+    '''
+    return hashlib.sha1(registration.data).hexdigest()
+
+class RegistrationStore(object):
+    '''
+    Archive of registrations where each distinct registration payload is
+    stored only once. The store is a directory with the following content:
+
+      objects/ab/cdef...    payload (data field) of a registration, named
+                            after its SHA-1 hash
+      refs/ab/cdef...       names of all backups using the payload, one per
+                            line
+      backups/NAME.json     banks and registrations of a backup, with hash
+                            references instead of payloads (names are
+                            stored as Latin-1)
+
+    So finding all backups with a given registration is a single file
+    lookup, and every stored backup can be rebuilt with write_banks().
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        for directory in ("objects", "refs", "backups"):
+            if not os.path.isdir(os.path.join(path, directory)):
+                os.makedirs(os.path.join(path, directory))
+
+    def object_path(self, directory, digest):
+        return os.path.join(self.path, directory, digest[:2], digest[2:])
+
+    def backup_path(self, name):
+        return os.path.join(self.path, "backups", name + ".json")
+
+    def write_file(self, path, content):
+        '''
+        Atomically creates a file with the given content.
+        '''
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+
+        fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+        temp_file = os.fdopen(fd, "wb")
+        temp_file.write(content)
+        temp_file.close()
+        os.rename(temp_path, path)
+
+    def backups(self):
+        '''
+        Returns the sorted names of all stored backups.
+        '''
+        return sorted(name[:-5] for name in os.listdir(os.path.join(self.path, "backups")) if name.endswith(".json"))
+
+    def add_backup(self, input_dir, name=None):
+        '''
+        Adds a backup directory to the store under the given name, which
+        defaults to the name of the directory. Payloads which are already
+        stored are not written again. Returns a tuple with the number of
+        non-empty registrations and the number of newly stored payloads.
+        Raises a ValueError if a backup with the same name already exists.
+        '''
+        if name is None:
+            name = os.path.basename(os.path.normpath(input_dir))
+
+        if os.path.exists(self.backup_path(name)):
+            raise ValueError("Backup %s has already been stored" % name)
+
+        banks = regbank.read_banks(input_dir, lazy=True)
+        stored_banks = []
+        references = set()
+        total = 0
+        added = 0
+
+        for bank in banks:
+            stored_registrations = []
+
+            for registration in bank.registrations:
+                digest = None
+
+                if not registration.empty:
+                    digest = hash_registration(registration)
+                    total += 1
+
+                    if not os.path.exists(self.object_path("objects", digest)):
+                        self.write_file(self.object_path("objects", digest), registration.data)
+                        added += 1
+
+                    references.add(digest)
+
+                stored_registrations.append({
+                    "number": registration.number,
+                    "empty": registration.empty,
+                    "name": registration.name.decode("latin-1"),
+                    "size": registration.size,
+                    "hash": digest,
+                })
+
+            stored_banks.append({
+                "number": bank.number,
+                "name": bank.name.decode("latin-1"),
+                "position": bank.position,
+                "size": bank.size,
+                "registrations": stored_registrations,
+            })
+
+        for digest in references:
+            ref_path = self.object_path("refs", digest)
+
+            if not os.path.isdir(os.path.dirname(ref_path)):
+                try:
+                    os.makedirs(os.path.dirname(ref_path))
+                except OSError:
+                    pass
+
+            ref_file = open(ref_path, "a")
+            ref_file.write(name + "\n")
+            ref_file.close()
+
+        content = json.dumps({"source": os.path.abspath(input_dir), "banks": stored_banks}, indent=1)
+        self.write_file(self.backup_path(name), content.encode("utf-8"))
+
+        return total, added
+
+    def read_backup(self, name):
+        '''
+        Returns the stored description of a backup as saved by add_backup().
+        Raises a KeyError if there is no such backup.
+        '''
+        try:
+            backup_file = open(self.backup_path(name), "r")
+        except EnvironmentError:
+            raise KeyError("Couldn't find backup %s" % name)
+
+        backup = json.load(backup_file)
+        backup_file.close()
+        return backup
+
+    @instrument.phase("load_backup")
+    def load_backup(self, name):
+        '''
+        Returns the banks of a stored backup like read_banks() does. The
+        payloads are read from the object files.
+        '''
+        banks = []
+        bytes_read = 0
+        syscalls = 0
+
+        for stored_bank in self.read_backup(name)["banks"]:
+            bank = regbank.Bank(
+                stored_bank["number"], stored_bank["name"].encode("latin-1"),
+                stored_bank["position"], stored_bank["size"],
+            )
+
+            for stored in stored_bank["registrations"]:
+                data = b""
+
+                if stored["hash"]:
+                    object_file = open(self.object_path("objects", stored["hash"]), "rb")
+                    data = object_file.read()
+                    object_file.close()
+                    bytes_read += len(data)
+                    syscalls += 3
+
+                bank.registrations.append(regbank.Registration(
+                    stored["number"], stored["empty"], stored["name"].encode("latin-1"), stored["size"], b"", data,
+                ))
+
+            banks.append(bank)
+
+        instrument.count("bytes_read", bytes_read)
+        instrument.count("syscalls", syscalls)
+        return banks
+
+    def load_mix(self, registration_map, name=None):
+        '''
+        Returns a new bank list as created by rearrange_registrations() with
+        registrations from several stored backups. Registrations of the map
+        qualified with a source (e.g. "live2010:03|1|Stand by me") are taken
+        from the stored backup of that name, unqualified ones from the
+        stored backup given by name. Raises a KeyError if backups or
+        registrations cannot be found.
+        '''
+        references = regmerge.map_references(registration_map)
+
+        if None in references and name is None:
+            raise KeyError("Registrations without source need a stored backup to rebuild")
+
+        indexes = {}
+
+        for source in references:
+            indexes[source] = regbank.RegistrationIndex(self.load_backup(name if source is None else source))
+
+        return regbank.rearrange_registrations([], registration_map, regmerge.SourceIndex(indexes))
+
+    def rebuild_backup(self, name, output_dir):
+        '''
+        Writes a stored backup to a new backup directory.
+        '''
+        regbank.write_banks(self.load_backup(name), output_dir)
+
+    def backups_containing(self, digest):
+        '''
+        Returns the names of all backups which contain a registration with
+        the given hash.
+        '''
+        try:
+            ref_file = open(self.object_path("refs", digest), "r")
+        except EnvironmentError:
+            return []
+
+        names = []
+
+        for line in ref_file:
+            if line.strip() and not line.strip() in names:
+                names.append(line.strip())
+
+        ref_file.close()
+        return names
@@ -0,0 +1,534 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: local HTTP/JSON service (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections, contextlib, io, json, os, shutil, tempfile, threading, time
+import psr9000.archive as archive
+import psr9000.regbank as regbank
+import psr9000.regpatch as regpatch
+import psr9000.regsearch as regsearch
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+    import queue
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+    import Queue as queue
+
+# Default upper limit for the size of all cached Regist.reg files together
+MAX_CACHE_SIZE = 256 * 1024 * 1024
+
+class HTTPError(Exception):
+    '''
+    Error which is reported to the client with the given HTTP status.
+    '''
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def backup_signature(input_dir):
+    '''
+    Returns the modification time, size and inode of the Regist.reg file (or
+    archive) of a backup, which change whenever the backup is written.
+    '''
+    if archive.is_archive(input_dir):
+        stat = os.stat(input_dir)
+    else:
+        stat = os.stat(os.path.join(input_dir, "Regist.reg"))
+
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+class CacheEntry(object):
+    '''
+    A backup held by BackupCache: the signature of its file, the open
+    RegistrationFile or RegistrationBuffer and the lazily read banks. users
+    counts the requests currently working with the banks, so that an
+    evicted entry is only closed when the last of them is done.
+    '''
+
+    def __init__(self, signature, source, banks):
+        self.signature = signature
+        self.source = source
+        self.banks = banks
+        self.users = 0
+        self.evicted = False
+
+class BackupCache(object):
+    '''
+    Thread-safe LRU cache of lazily read backups (see read_banks()). Each
+    entry remembers the modification time, size and inode of its Regist.reg
+    file (or archive) and is read again once they change. The least recently
+    used entries are dropped when the Regist.reg data of all entries
+    together grows larger than max_size bytes. For archives this is the
+    uncompressed Regist.reg held in memory, not the size of the archive.
+    Dropped entries are closed as soon as no request uses them anymore.
+    '''
+
+    def __init__(self, max_size=MAX_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def drop(self, entry):
+        '''
+        Removes the size of an entry which is no longer in the cache and
+        closes it unless it is still in use. The lock must be held.
+        '''
+        entry.evicted = True
+        self.size -= entry.source.size
+
+        if not entry.users:
+            entry.source.close()
+
+    def acquire(self, input_dir):
+        '''
+        Returns the entry of a backup, from the cache if possible, and marks
+        it as used. It must be given back with release().
+        '''
+        signature = backup_signature(input_dir)
+
+        with self.lock:
+            entry = self.entries.pop(input_dir, None)
+
+            if entry is not None and entry.signature == signature:
+                self.entries[input_dir] = entry
+                entry.users += 1
+                self.hits += 1
+                return entry
+            elif entry is not None:
+                self.drop(entry)
+
+            self.misses += 1
+
+        if archive.is_archive(input_dir):
+            source = regbank.RegistrationBuffer(input_dir, archive.read_member(input_dir, "Regist.reg"))
+        else:
+            source = regbank.RegistrationFile(os.path.join(input_dir, "Regist.reg"))
+
+        try:
+            entry = CacheEntry(signature, source, regbank.read_registration_file(source, lazy=True))
+        except:
+            source.close()
+            raise
+
+        with self.lock:
+            if input_dir in self.entries:
+                self.drop(self.entries.pop(input_dir))
+
+            self.entries[input_dir] = entry
+            self.size += source.size
+            entry.users += 1
+
+            while self.size > self.max_size and len(self.entries) > 1:
+                self.drop(self.entries.popitem(last=False)[1])
+                self.evictions += 1
+
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.users -= 1
+
+            if entry.evicted and not entry.users:
+                entry.source.close()
+
+    @contextlib.contextmanager
+    def use(self, input_dir):
+        '''
+        Context manager which returns the banks of a backup (see acquire()).
+        They must not be used after the with block.
+        '''
+        entry = self.acquire(input_dir)
+
+        try:
+            yield entry.banks
+        finally:
+            self.release(entry)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+class Metrics(object):
+    '''
+    Thread-safe request counters and latencies per endpoint.
+    '''
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, duration, failed):
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {
+                "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+            })
+
+            entry["count"] += 1
+            entry["errors"] += failed
+            entry["total_ms"] += duration * 1000
+            entry["max_ms"] = max(entry["max_ms"], duration * 1000)
+
+    def report(self):
+        with self.lock:
+            report = {}
+
+            for endpoint, entry in self.endpoints.items():
+                report[endpoint] = dict(entry)
+                report[endpoint]["mean_ms"] = entry["total_ms"] / entry["count"]
+
+            return report
+
+def copy_banks(banks):
+    '''
+    Returns a copy of a bank list which can be changed without touching the
+    cached original. Payloads are still shared until they are patched.
+    '''
+    new_banks = []
+
+    for bank in banks:
+        new_bank = regbank.Bank(bank.number, bank.name, bank.position, bank.size)
+        new_bank.registrations = [registration.copy() for registration in bank.registrations]
+        new_banks.append(new_bank)
+
+    return new_banks
+
+def banks_as_json(banks):
+    '''
+    Returns a bank list as plain values for JSON. Bank and registration
+    numbers are counted from 1 like in map files.
+    '''
+    return [{
+        "number": bank.number + 1,
+        "name": bank.name.decode("latin-1") if isinstance(bank.name, bytes) else bank.name,
+        "registrations": [{
+            "number": registration.number + 1,
+            "empty": registration.empty,
+            "name": registration.name.decode("latin-1") if isinstance(registration.name, bytes) else registration.name,
+            "size": registration.size,
+        } for registration in bank.registrations],
+    } for bank in banks]
+
+class BackupService(object):
+    '''
+    Implementation of all endpoints, independent of HTTP. Backups are
+    referenced by their path relative to the root directory and must not
+    lie outside of it.
+    '''
+
+    def __init__(self, root, max_size=MAX_CACHE_SIZE):
+        self.root = os.path.abspath(root)
+        self.cache = BackupCache(max_size)
+        self.metrics = Metrics()
+        self.names = regsearch.NameIndex()
+        self.name_signatures = {}
+        self.name_errors = {}
+        self.names_lock = threading.Lock()
+
+    def resolve(self, name):
+        '''
+        Returns the absolute path of a backup inside the root directory.
+        '''
+        if not name:
+            raise HTTPError(400, "Missing backup parameter")
+
+        path = os.path.abspath(os.path.join(self.root, name))
+
+        if not path.startswith(self.root + os.sep):
+            raise HTTPError(400, "Backup must lie inside the root directory")
+        elif archive.is_archive(path) and os.path.isfile(path):
+            return path
+        elif not os.path.exists(os.path.join(path, "Regist.reg")):
+            raise HTTPError(404, "No backup named %s" % name)
+
+        return path
+
+    def backups(self):
+        '''
+        Returns the sorted names of all backups directly inside the root
+        directory.
+        '''
+        names = []
+
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+
+            if os.path.exists(os.path.join(path, "Regist.reg")) or (archive.is_archive(path) and os.path.isfile(path)):
+                names.append(name)
+
+        return names
+
+    def list_banks(self, name):
+        with self.cache.use(self.resolve(name)) as banks:
+            return banks_as_json(banks)
+
+    def write_map(self, name):
+        map_file = io.BytesIO() if bytes is str else io.StringIO()
+
+        with self.cache.use(self.resolve(name)) as banks:
+            regbank.write_registration_map(banks, map_file)
+
+        return map_file.getvalue()
+
+    def search(self, query, fuzzy=False):
+        '''
+        Searches the registration names of all backups inside the root
+        directory (see regsearch.NameIndex). Only backups whose signature
+        changed since the last search are read again. Backups which cannot
+        be read are skipped and listed with an error entry at the end.
+        '''
+        if not query:
+            raise HTTPError(400, "Missing q parameter")
+
+        with self.names_lock:
+            paths = [os.path.join(self.root, name) for name in self.backups()]
+            changed = []
+
+            for path in paths:
+                try:
+                    signature = backup_signature(path)
+                except EnvironmentError:
+                    signature = None
+
+                if self.name_signatures.get(path) != signature:
+                    self.name_signatures[path] = signature
+                    self.name_errors.pop(path, None)
+                    changed.append(path)
+
+            removed = set(self.name_signatures).difference(paths)
+
+            for path in removed:
+                del self.name_signatures[path]
+                self.name_errors.pop(path, None)
+
+            self.names.remove(removed)
+
+            if changed:
+                self.names.update(changed, check_all=False)
+                self.name_errors.update(self.names.errors)
+
+            results = self.names.search(query, fuzzy)
+            errors = sorted(self.name_errors.items())
+
+        return [{
+            "score": score,
+            "backup": os.path.relpath(path, self.root),
+            "bank": bank_number + 1,
+            "registration": reg_number + 1,
+            "name": name.decode("latin-1") if isinstance(name, bytes) else name,
+        } for score, path, bank_number, reg_number, name in results] + [{
+            "backup": os.path.relpath(path, self.root),
+            "error": error,
+        } for path, error in errors]
+
+    def build_archive(self, input_dir, banks, archive_format):
+        '''
+        Writes the banks into a new archive and returns its content. Other
+        files of the input backup are included (see write_banks()).
+        '''
+        if not archive.archive_format("backup." + archive_format):
+            raise HTTPError(400, "Unknown archive format %s" % archive_format)
+
+        temp_dir = tempfile.mkdtemp(prefix="psr-tools-")
+
+        try:
+            output_path = os.path.join(temp_dir, "backup." + archive_format)
+            regbank.write_banks(banks, output_path, input_dir)
+
+            output_file = open(output_path, "rb")
+            data = output_file.read()
+            output_file.close()
+            return data
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def rearrange(self, name, map_text, archive_format="zip"):
+        '''
+        Creates a new backup from a registration map and returns it as an
+        archive.
+        '''
+        input_dir = self.resolve(name)
+
+        with self.cache.use(input_dir) as banks:
+            try:
+                registration_map = regbank.read_registration_map(map_text.splitlines())
+                new_banks = regbank.rearrange_registrations(banks, registration_map)
+            except KeyError as err:
+                raise HTTPError(400, err.args[0])
+            except ValueError as err:
+                raise HTTPError(400, str(err))
+
+            return self.build_archive(input_dir, new_banks, archive_format)
+
+    def patch(self, name, patch_text, archive_format="zip"):
+        '''
+        Patches a copy of a backup with a patch file (see
+        regpatch.read_patch_spec()) and returns it as an archive.
+        '''
+        input_dir = self.resolve(name)
+
+        with self.cache.use(input_dir) as cached_banks:
+            banks = copy_banks(cached_banks)
+
+            try:
+                patches = regpatch.read_patch_spec(patch_text.splitlines())
+                regpatch.patch_banks(banks, patches)
+            except ValueError as err:
+                raise HTTPError(400, str(err))
+
+            return self.build_archive(input_dir, banks, archive_format)
+
+    def report(self):
+        return {"cache": self.cache.metrics(), "requests": self.metrics.report()}
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    Maps HTTP requests to the BackupService of the server:
+
+      GET  /backups                         list of backup names
+      GET  /banks?backup=NAME               banks and registrations as JSON
+      GET  /map?backup=NAME                 registration map as text
+      GET  /search?q=WORDS[&fuzzy=1]        registrations of all backups
+      POST /rearrange?backup=NAME[&format]  map file in, backup archive out
+      POST /patch?backup=NAME[&format]      patch file in, backup archive out
+      GET  /metrics                         request latencies and cache hits
+    '''
+    server_version = "psr-tools"
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, value):
+        self.send_body(status, "application/json", json.dumps(value, indent=1).encode("utf-8"))
+
+    def read_body(self):
+        '''
+        Returns the request body as a native string.
+        '''
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+
+        if not isinstance(body, str):
+            body = body.decode("latin-1")
+
+        return body
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        service = self.server.service
+        start = time.time()
+        failed = False
+
+        try:
+            archive_format = query.get("format", "zip")
+
+            if method == "GET" and url.path == "/backups":
+                self.send_json(200, service.backups())
+            elif method == "GET" and url.path == "/banks":
+                self.send_json(200, service.list_banks(query.get("backup")))
+            elif method == "GET" and url.path == "/map":
+                map_text = service.write_map(query.get("backup"))
+
+                if not isinstance(map_text, bytes):
+                    map_text = map_text.encode("latin-1")
+
+                self.send_body(200, "text/plain; charset=latin-1", map_text)
+            elif method == "GET" and url.path == "/search":
+                self.send_json(200, service.search(query.get("q"), query.get("fuzzy") == "1"))
+            elif method == "POST" and url.path == "/rearrange":
+                data = service.rearrange(query.get("backup"), self.read_body(), archive_format)
+                self.send_body(200, "application/octet-stream", data)
+            elif method == "POST" and url.path == "/patch":
+                data = service.patch(query.get("backup"), self.read_body(), archive_format)
+                self.send_body(200, "application/octet-stream", data)
+            elif method == "GET" and url.path == "/metrics":
+                self.send_json(200, service.report())
+            else:
+                raise HTTPError(404, "Unknown endpoint %s %s" % (method, url.path))
+        except HTTPError as err:
+            failed = True
+            self.send_json(err.status, {"error": str(err)})
+        except (EnvironmentError, ValueError) as err:
+            failed = True
+            self.send_json(500, {"error": str(err)})
+        except Exception as err:
+            # Anything else is a bug or a backup the parser chokes on, but
+            # the client still gets an answer and the failure is counted
+            failed = True
+            self.send_json(500, {"error": "%s: %s" % (err.__class__.__name__, err)})
+
+        service.metrics.record("%s %s" % (method, url.path), time.time() - start, failed)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class BackupServer(HTTPServer):
+    '''
+    HTTP server which handles requests with a fixed pool of worker threads,
+    so that slow requests like rebuilding a backup don't block listings.
+    '''
+
+    def __init__(self, address, service, threads=4, verbose=False):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+        self.verbose = verbose
+        self.requests = queue.Queue(threads * 4)
+
+        for i in range(threads):
+            worker = threading.Thread(target=self.serve_requests)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def serve_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: synthetic registration backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import psr9000.regbank as regbank
+
+# Sizes of filled registrations as stored in the registration header. A real
+# registration is a bit larger than an empty one (573 bytes) and grows with
+# the number of settings which differ from the defaults.
+REGISTRATION_SIZES = (1210, 1466, 1722, 2098)
+
+def generate_banks(bank_count=64, filled=0.75, sizes=REGISTRATION_SIZES, variation=16, seed=None):
+    '''
+    Creates a list of registration banks with random content as expected by
+    write_banks(). bank_count is the number of banks (up to 64) with eight
+    registrations each. filled is the share of non-empty registrations
+    between 0.0 and 1.0. The size of each filled registration is chosen from
+    sizes.
+
+    Real registrations mostly contain the same defaults. Therefor one random
+    template is created for each size and only variation bytes are changed
+    for each registration. The same seed always creates the same banks.
+    '''
+    rng = random.Random(seed)
+    templates = {}
+    banks = []
+    bank_position = 0x0C10
+
+    for size in sizes:
+        templates[size] = bytearray(rng.getrandbits(8) for i in range(size - 22))
+
+    for bank_number in range(min(bank_count, 64)):
+        bank = regbank.Bank(bank_number, "BANK %02d" % (bank_number + 1), bank_position, 48)
+
+        for reg_number in range(8):
+            if rng.random() >= filled:
+                bank.registrations.append(regbank.Registration(reg_number, True, "", 0))
+                bank.size += 583
+                continue
+
+            size = rng.choice(sizes)
+            data = bytearray(templates[size])
+
+            for i in range(variation):
+                data[rng.randrange(len(data))] = rng.getrandbits(8)
+
+            name = "REG %02d-%d" % (bank_number + 1, reg_number + 1)
+            bank.registrations.append(regbank.Registration(reg_number, False, name, size, b"", data))
+            bank.size += size + 10
+
+        bank_position += bank.size
+        banks.append(bank)
+
+    return banks
+
+def generate_backup(output_dir, **kwargs):
+    '''
+    Writes a synthetic user data backup to output_dir. All keyword arguments
+    are passed to generate_banks(). Returns the generated banks.
+    '''
+    banks = generate_banks(**kwargs)
+    regbank.write_banks(banks, output_dir)
+    return banks
@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: other files of user data backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, shutil
+import psr9000.archive as archive
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request to share the extents of one file with another (Linux)
+FICLONE = 0x40049409
+
+# Files of a backup which are written by write_banks() itself
+GENERATED_FILES = ("regist.reg", "userfile.ini")
+
+def clone_file(source_path, output_path, hardlink=True):
+    '''
+    Creates output_path with the content of source_path as cheaply as
+    possible. These methods are tried in order:
+
+      1. A reflink (FICLONE), so that both files share their blocks until
+         one of them is changed. Supported by Btrfs, XFS and others.
+      2. A hardlink, unless hardlink=False. Both names then refer to the
+         same file, so this must not be used for files changed afterwards.
+      3. copy_file_range(), which copies inside the kernel or even on the
+         storage device.
+      4. A plain buffered copy.
+
+    Returns the name of the method used: "reflink", "hardlink", "copy_file_range"
+    or "copy".
+    '''
+    if fcntl is not None:
+        source_file = open(source_path, "rb")
+        output_file = open(output_path, "wb")
+
+        try:
+            fcntl.ioctl(output_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copymode(source_path, output_path)
+            return "reflink"
+        except EnvironmentError:
+            pass
+        finally:
+            source_file.close()
+            output_file.close()
+
+        os.remove(output_path)
+
+    if hardlink:
+        try:
+            os.link(source_path, output_path)
+            return "hardlink"
+        except (AttributeError, EnvironmentError):
+            pass
+
+    if hasattr(os, "copy_file_range"):
+        source_file = open(source_path, "rb")
+        output_file = open(output_path, "wb")
+
+        try:
+            length = os.fstat(source_file.fileno()).st_size
+            offset = 0
+
+            while offset < length:
+                copied = os.copy_file_range(source_file.fileno(), output_file.fileno(), length - offset, offset, offset)
+
+                if not copied:
+                    break
+
+                offset += copied
+
+            if offset == length:
+                shutil.copymode(source_path, output_path)
+                return "copy_file_range"
+        except EnvironmentError:
+            pass
+        finally:
+            source_file.close()
+            output_file.close()
+
+    shutil.copyfile(source_path, output_path)
+    shutil.copymode(source_path, output_path)
+    return "copy"
+
+class BackupDirectory(object):
+    '''
+    Access to the files of a backup directory with the same methods as
+    archive.BackupArchive, so that both can be handled alike (see
+    open_backup()). File names are compared case-insensitive.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.names = dict(
+            (name, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))
+        )
+
+    def members(self):
+        return sorted(self.names)
+
+    def find(self, file_name):
+        '''
+        Returns the name of a backup file as stored on disk. Raises a
+        KeyError if there is no such file.
+        '''
+        for name in self.names:
+            if name.lower() == file_name.lower():
+                return name
+
+        raise KeyError("Couldn't find %s inside %s" % (file_name, self.path))
+
+    def file_path(self, file_name):
+        return os.path.join(self.path, self.find(file_name))
+
+    def size(self, file_name):
+        return os.path.getsize(self.file_path(file_name))
+
+    def read(self, file_name):
+        input_file = open(self.file_path(file_name), "rb")
+        data = input_file.read()
+        input_file.close()
+        return data
+
+    def close(self):
+        pass
+
+def open_backup(input_dir):
+    '''
+    Returns a BackupDirectory or, for zip and tar archives, an
+    archive.BackupArchive to access the files of a backup. Open it once
+    for all files needed and close it afterwards, because each opening of
+    a compressed tar archive decompresses it from the start.
+    '''
+    if archive.is_archive(input_dir):
+        return archive.BackupArchive(input_dir)
+
+    return BackupDirectory(input_dir)
+
+def list_files(backup):
+    '''
+    Returns the sorted names of all files of a backup opened with
+    open_backup() except the ones written by write_banks() (see
+    GENERATED_FILES).
+    '''
+    return [name for name in backup.members() if not name.lower() in GENERATED_FILES]
+
+def read_file(backup, name):
+    '''
+    Returns the content of a file of a backup opened with open_backup(), or
+    None if it doesn't exist.
+    '''
+    try:
+        return backup.read(name)
+    except KeyError:
+        return None
+
+def parse_userfile_ini(data):
+    '''
+    Splits the content of a USERFILE.INI file into a list of (section,
+    lines) tuples in their original order. Sections are the lines in
+    square brackets, e.g. "[REGISTRATION]".
+    '''
+    sections = []
+
+    for line in data.splitlines():
+        if line.startswith("["):
+            sections.append((line.strip(), []))
+        elif sections and line.strip():
+            sections[-1][1].append(line.rstrip())
+
+    return sections
+
+def merge_userfile_ini(data, registration_ini):
+    '''
+    Merges the USERFILE.INI of an input backup with the one created by
+    regbank.userfile_ini() for the new Regist.reg. All sections of the
+    original file are kept in their order, so the other user files stay
+    listed. Only [TOTAL USER DATA SIZE] and [REGISTRATION] are replaced with
+    the ones of registration_ini. Missing sections are added before
+    [DATAEND]. Returns the content of the merged file.
+    '''
+    replaced = dict(
+        (section, lines) for section, lines in parse_userfile_ini(registration_ini)
+        if section in ("[TOTAL USER DATA SIZE]", "[REGISTRATION]")
+    )
+
+    sections = []
+
+    for section, lines in parse_userfile_ini(data):
+        if section == "[DATAEND]":
+            break
+
+        sections.append((section, replaced.pop(section, lines)))
+
+    for section in ("[TOTAL USER DATA SIZE]", "[REGISTRATION]"):
+        if section in replaced:
+            sections.append((section, replaced[section]))
+
+    sections.append(("[DATAEND]", []))
+
+    return "".join(
+        section + "\r\n" + "".join(line + "\r\n" for line in lines)
+        for section, lines in sections
+    )
+
+def copy_files(backup, output_dir, registration_ini, hardlink=True):
+    '''
+    Carries over all files of the input backup opened with open_backup() to
+    the output directory, except for Regist.reg and USERFILE.INI. Files of
+    an input directory are cloned with clone_file(), files of an archive
+    are written from memory one at a time. USERFILE.INI is written, too,
+    merged from the one of the input backup and registration_ini (see
+    merge_userfile_ini()). If the input backup has no USERFILE.INI,
+    registration_ini is written as it is.
+    '''
+    for name in list_files(backup):
+        output_path = os.path.join(output_dir, name)
+
+        if os.path.exists(output_path):
+            continue
+
+        if isinstance(backup, BackupDirectory):
+            clone_file(backup.file_path(name), output_path, hardlink)
+        else:
+            output_file = open(output_path, "wb")
+            output_file.write(backup.read(name))
+            output_file.close()
+
+    original_ini = read_file(backup, "USERFILE.INI")
+
+    if original_ini is not None:
+        registration_ini = merge_userfile_ini(original_ini, registration_ini)
+
+    config_file = open(os.path.join(output_dir, "USERFILE.INI"), "wb")
+    config_file.write(registration_ini)
+    config_file.close()
+
+def file_sizes(backup):
+    '''
+    Returns the total size of all files listed by list_files() of a backup
+    opened with open_backup(). Sizes of archive members are taken from the
+    archive directory without decompressing anything.
+    '''
+    return sum(backup.size(name) for name in list_files(backup))
@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: structural check of user data backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing, os, struct
+import psr9000.archive as archive
+import psr9000.regbank as regbank
+import psr9000.userfiles as userfiles
+
+# Magic of the bank header following the 16 bytes long bank name
+BANK_MAGIC = b"PSR-9000PREGIST Ver1.00"
+
+# Number of backups handed to a worker process at once
+CHUNK_SIZE = 16
+
+class Report(object):
+    '''
+    Collects the problems found in a single backup. Errors make the backup
+    unusable for the instrument or this library, warnings are oddities
+    which don't hurt. Offsets are absolute positions in Regist.reg or None
+    for problems of USERFILE.INI.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.banks = 0
+        self.registrations = 0
+        self.problems = []
+
+    def error(self, offset, message):
+        self.problems.append(("error", offset, message))
+
+    def warning(self, offset, message):
+        self.problems.append(("warning", offset, message))
+
+    def errors(self):
+        return [problem for problem in self.problems if problem[0] == "error"]
+
+    def as_dict(self):
+        return {
+            "backup": self.path,
+            "ok": not self.errors(),
+            "banks": self.banks,
+            "registrations": self.registrations,
+            "problems": [
+                {"level": level, "offset": offset, "message": message}
+                for level, offset, message in self.problems
+            ],
+        }
+
+def check_index(buf, size, report):
+    '''
+    Checks the bank directory and returns a list of (number, name, long
+    name, position, size) tuples of the banks whose ranges lie inside the
+    file, in the order of the directory.
+    '''
+    if size < 0x0C10:
+        report.error(0, "File is shorter than the bank directory (%s bytes)" % size)
+        return []
+
+    if buf[:4] != b"\xd0\x06\x00\x00":
+        report.error(0, "Unknown registration format")
+        return []
+
+    banks = []
+    numbers = set()
+
+    for i in range(64):
+        entry = i * 48
+        bank_size, bank_position, bank_number, long_name = struct.unpack_from("> l l B 22s", buf, entry + 16)
+
+        if not bank_size:
+            continue
+
+        if bank_number in numbers:
+            report.error(entry, "Bank %s is listed twice" % (bank_number + 1))
+        elif bank_number >= 64:
+            report.warning(entry, "Bank number %s is out of range" % (bank_number + 1))
+
+        numbers.add(bank_number)
+        suffix = ("%02X.reg" % bank_number).encode("ascii")
+
+        if long_name[16:] != suffix:
+            report.warning(entry, "Bank %s is listed as %s" % (bank_number + 1, repr(long_name[16:])))
+
+        if bank_size < 48:
+            report.error(entry, "Bank %s is too small (%s bytes)" % (bank_number + 1, bank_size))
+        elif bank_position < 0x0C10 or bank_position + bank_size > size:
+            report.error(entry, "Bank %s at %s with %s bytes lies outside of the file (%s bytes)" % (
+                bank_number + 1, bank_position, bank_size, size,
+            ))
+        else:
+            banks.append((bank_number, long_name[:16], long_name, bank_position, bank_size))
+
+    end = 0x0C10
+
+    for bank_number, name, long_name, position, bank_size in sorted(banks, key=lambda bank: bank[3]):
+        if position < end:
+            report.error(position, "Bank %s overlaps the previous bank" % (bank_number + 1))
+        elif position > end:
+            report.warning(end, "%s unused bytes before bank %s" % (position - end, bank_number + 1))
+
+        end = max(end, position + bank_size)
+
+    if end < size:
+        report.warning(end, "%s unused bytes at the end of the file" % (size - end))
+
+    return banks
+
+def check_bank(buf, bank, report):
+    '''
+    Checks the header of a bank and the headers of its registrations.
+    '''
+    bank_number, name, long_name, position, bank_size = bank
+    label = "Bank %s" % (bank_number + 1)
+
+    if buf[position + 16:position + 16 + len(BANK_MAGIC)] != BANK_MAGIC:
+        report.error(position + 16, "%s has no bank header" % label)
+        return
+
+    if regbank.filter_string(buf[position:position + 16]) != regbank.filter_string(name):
+        report.warning(position, "%s is named differently in the bank directory" % label)
+
+    end = position + bank_size
+    offset = position + 48
+    last_number = -1
+
+    while offset < end:
+        if offset + 10 > end:
+            report.error(offset, "%s ends inside a registration header" % label)
+            return
+
+        reg_id, reg_size = struct.unpack_from("> 6s l", buf, offset)
+
+        if reg_id[:5] != b"REG00" or not reg_id[5:6].isdigit():
+            report.error(offset, "%s has no registration header but %s" % (label, repr(reg_id)))
+            return
+
+        reg_number = int(reg_id[5:6])
+
+        if reg_number <= last_number:
+            report.error(offset, "%s: registration %s follows registration %s" % (
+                label, reg_number + 1, last_number + 1,
+            ))
+        elif reg_number > 7:
+            report.error(offset, "%s: registration number %s is out of range" % (label, reg_number + 1))
+
+        last_number = reg_number
+        report.registrations += 1
+
+        if reg_size < 22:
+            report.error(offset, "%s: registration %s is too small (%s bytes)" % (label, reg_number + 1, reg_size))
+            return
+        elif offset + reg_size + 10 > end:
+            report.error(offset, "%s: registration %s with %s bytes exceeds the bank size" % (
+                label, reg_number + 1, reg_size,
+            ))
+            return
+
+        offset += reg_size + 10
+
+def check_userfile_ini(data, banks, report):
+    '''
+    Compares the [REGISTRATION] section of USERFILE.INI with the bank
+    directory. The listed bank files must match the long names of the
+    banks in the order of the directory.
+    '''
+    if data is None:
+        report.warning(None, "No USERFILE.INI found")
+        return
+
+    sections = dict(userfiles.parse_userfile_ini(data.decode("latin-1")))
+
+    if not "[REGISTRATION]" in sections:
+        if banks:
+            report.error(None, "USERFILE.INI lists no registration banks")
+
+        return
+
+    bank_files = []
+    total = None
+
+    for line in sections["[REGISTRATION]"]:
+        if line.startswith("TOTAL FILE NUM:"):
+            total = line.split(":", 1)[1].strip()
+        elif "=" in line:
+            bank_files.append(line.split("=", 1)[1].strip())
+
+    long_names = [long_name.decode("latin-1").strip() for number, name, long_name, position, bank_size in banks]
+
+    if total != str(len(bank_files)):
+        report.error(None, "USERFILE.INI lists %s bank files but claims %s" % (len(bank_files), total))
+
+    if len(bank_files) != len(long_names):
+        report.error(None, "USERFILE.INI lists %s bank files, Regist.reg contains %s banks" % (
+            len(bank_files), len(long_names),
+        ))
+    elif bank_files != long_names:
+        report.error(None, "USERFILE.INI lists other bank files than Regist.reg")
+
+def verify_backup(input_dir):
+    '''
+    Checks the structure of a backup directory or archive without parsing
+    any registration payload:
+
+      - the bank directory against the file length (sizes, positions,
+        overlaps, duplicate bank numbers)
+      - the header of each bank
+      - the REG00x headers of each bank: ascending numbers and sizes which
+        add up to the bank size
+      - the bank files listed in USERFILE.INI
+
+    Returns a Report. Backups which cannot be read at all are reported as
+    a single error.
+    '''
+    report = Report(input_dir)
+    ini_data = None
+
+    try:
+        if archive.is_archive(input_dir):
+            backup_archive = archive.BackupArchive(input_dir)
+
+            try:
+                registration_file = regbank.RegistrationBuffer(input_dir, backup_archive.read("Regist.reg"))
+
+                try:
+                    ini_data = backup_archive.read("USERFILE.INI")
+                except KeyError:
+                    pass
+            finally:
+                backup_archive.close()
+        else:
+            registration_file = regbank.RegistrationFile(os.path.join(input_dir, "Regist.reg"))
+            ini_data = userfiles.read_file(userfiles.BackupDirectory(input_dir), "USERFILE.INI")
+    except (EnvironmentError, ValueError) as err:
+        report.error(None, str(err))
+        return report
+
+    try:
+        buf = registration_file.buffer
+        banks = check_index(buf, registration_file.size, report)
+        report.banks = len(banks)
+
+        for bank in sorted(banks, key=lambda bank: bank[3]):
+            check_bank(buf, bank, report)
+    finally:
+        registration_file.close()
+
+    check_userfile_ini(ini_data, banks, report)
+    return report
+
+def verify_job(input_dir):
+    '''
+    Pool job: Returns the report of a backup as a dictionary.
+    '''
+    return verify_backup(input_dir).as_dict()
+
+def verify_backups(inputs, jobs=0):
+    '''
+    Checks many backups with a pool of jobs worker processes (0 = one per
+    CPU). The backups are handed out in chunks, so that thousands of small
+    backups don't cost one round trip each. Yields the report dictionaries
+    in the order of inputs while the pool is still working.
+    '''
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs == 1 or len(inputs) < 2:
+        for input_dir in inputs:
+            yield verify_job(input_dir)
+
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(inputs)))
+
+    try:
+        for result in pool.imap(verify_job, inputs, CHUNK_SIZE):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
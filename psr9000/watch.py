@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: incremental rebuilds on map file changes (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes, ctypes.util, os, select, struct, sys, time
+import psr9000.regbank as regbank
+import psr9000.userfiles as userfiles
+
+# inotify events which mean that a file has been saved. Editors often write
+# a new file and rename it over the old one, so the directory is watched.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+def load_inotify():
+    '''
+    Returns the C library if it provides inotify (Linux), otherwise None.
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (AttributeError, OSError):
+        return None
+
+    return libc
+
+class FileWatcher(object):
+    '''
+    Waits for changes of a single file. inotify is used where available, so
+    that changes are noticed immediately without any load. Otherwise the
+    modification time, size and inode of the file are polled every interval
+    seconds.
+    '''
+
+    def __init__(self, path, interval=0.25):
+        self.path = path
+        self.interval = interval
+        self.fd = None
+        self.signature = self.stat()
+
+        libc = load_inotify()
+
+        if libc is None:
+            return
+
+        fd = libc.inotify_init()
+
+        if fd < 0:
+            return
+
+        directory = os.path.dirname(os.path.abspath(path))
+
+        if not isinstance(directory, bytes):
+            directory = directory.encode(sys.getfilesystemencoding())
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+        if libc.inotify_add_watch(fd, directory, mask) < 0:
+            os.close(fd)
+            return
+
+        self.fd = fd
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def read_events(self, timeout):
+        '''
+        Returns True if an inotify event for the watched file arrives within
+        timeout seconds. All pending events are consumed.
+        '''
+        name = os.path.basename(self.path)
+        found = False
+
+        while select.select([self.fd], [], [], timeout)[0]:
+            data = os.read(self.fd, 4096)
+            offset = 0
+
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                event_name = data[offset + 16:offset + 16 + length].rstrip(b"\x00").decode("utf-8", "replace")
+                offset += 16 + length
+
+                if event_name == name:
+                    found = True
+
+            timeout = 0
+
+        return found
+
+    def wait(self):
+        '''
+        Blocks until the file has been changed. Saving a file often causes
+        several events in a row, so a short quiet period is awaited before
+        returning.
+        '''
+        if self.fd is not None:
+            while not self.read_events(None):
+                pass
+
+            while self.read_events(0.05):
+                pass
+        else:
+            while self.stat() == self.signature:
+                time.sleep(self.interval)
+
+            time.sleep(0.05)
+
+        self.signature = self.stat()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def registration_signature(registration):
+    '''
+    Returns a value which differs if the registration would be written
+    differently. Lazily read payloads are identified by their location.
+    '''
+    location = registration.data_location()
+
+    if location:
+        source, offset, length = location
+        payload = (source.path, offset, length)
+    else:
+        payload = bytes(registration.data)
+
+    return (registration.number, registration.empty, registration.name, registration.size, payload)
+
+class IncrementalBackup(object):
+    '''
+    Output backup which is rewritten as little as possible on each update.
+    The first update() writes the whole backup with write_banks(). Later
+    updates compare the new banks with the ones written before and only
+    rewrite the banks whose content or position has changed, plus the
+    index and USERFILE.INI if the bank directory has changed. So a changed
+    registration name or a swapped pair of registrations only costs a few
+    small writes, while the file is truncated or extended as necessary.
+    '''
+
+    def __init__(self, output_dir, input_dir=None):
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.input_files = None
+        self.index_bytes = None
+        self.layout = []
+        self.end = 0
+
+    def get_layout(self, banks):
+        '''
+        Returns a list with the (position, number, name, registration
+        signatures) tuple of each bank and the end of the file.
+        '''
+        layout = []
+        position = 0x0C10
+
+        for bank in banks:
+            layout.append((
+                position, bank.number, bank.name,
+                tuple(registration_signature(registration) for registration in bank.registrations),
+            ))
+
+            position += regbank.bank_length(bank)
+
+        return layout, position
+
+    def update(self, banks):
+        '''
+        Writes the given list of registration banks. Returns the number of
+        banks actually written. If writing fails, the next update writes the
+        whole backup again.
+        '''
+        layout, end = self.get_layout(banks)
+        index_bytes, bank_files = regbank.build_index(banks)
+        registration_path = os.path.join(self.output_dir, "Regist.reg")
+
+        try:
+            if self.index_bytes is None or not os.path.exists(registration_path):
+                regbank.write_banks(banks, self.output_dir, self.input_dir)
+                written = len(banks)
+            else:
+                written = self.write_changes(banks, layout, end, index_bytes, registration_path)
+
+                if index_bytes != self.index_bytes:
+                    self.write_config(bank_files, end)
+        except:
+            # The output is only half written now and doesn't match the
+            # remembered layout anymore, so the next update writes it anew
+            self.index_bytes, self.layout, self.end = None, [], 0
+            raise
+
+        self.index_bytes, self.layout, self.end = index_bytes, layout, end
+        return written
+
+    def write_changes(self, banks, layout, end, index_bytes, registration_path):
+        '''
+        Rewrites the banks of Regist.reg which differ from the remembered
+        layout, plus the index if necessary. Returns the number of banks
+        written.
+        '''
+        registration_file = open(registration_path, "r+b")
+        copies = []
+        written = 0
+
+        try:
+            for i, bank in enumerate(banks):
+                if i < len(self.layout) and self.layout[i] == layout[i]:
+                    continue
+
+                registration_file.seek(layout[i][0])
+                regbank.write_bank(bank, registration_file, layout[i][0], copies)
+                written += 1
+
+            if index_bytes != self.index_bytes:
+                registration_file.seek(0)
+                registration_file.write(index_bytes)
+
+            regbank.copy_payloads(copies, registration_file)
+
+            if end != self.end:
+                registration_file.truncate(end)
+        finally:
+            registration_file.close()
+
+        return written
+
+    def get_input_files(self):
+        '''
+        Returns the total size of the other files of the input backup and
+        its USERFILE.INI. Both are read once with a single opening of the
+        backup, because the registrations are taken from the input backup
+        as it was when watching started, too. So archives are not opened
+        and decompressed again on each update.
+        '''
+        if self.input_files is None:
+            backup = userfiles.open_backup(self.input_dir)
+
+            try:
+                self.input_files = (userfiles.file_sizes(backup), userfiles.read_file(backup, "USERFILE.INI"))
+            finally:
+                backup.close()
+
+        return self.input_files
+
+    def write_config(self, bank_files, registration_size):
+        '''
+        Rewrites USERFILE.INI for the new bank directory.
+        '''
+        if self.input_dir is None:
+            config = regbank.userfile_ini(bank_files, registration_size)
+        else:
+            file_sizes, original_config = self.get_input_files()
+            config = regbank.userfile_ini(bank_files, registration_size + file_sizes)
+
+            if original_config is not None:
+                config = userfiles.merge_userfile_ini(original_config, config)
+
+        config_file = open(os.path.join(self.output_dir, "USERFILE.INI"), "wb")
+        config_file.write(config)
+        config_file.close()
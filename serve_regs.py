@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: serve_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sys
+import psr9000.server as server
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: serve_regs",
+        description = "Local HTTP/JSON service to list, search, rearrange and patch PSR-9000 backups"
+    )
+
+    cmd_parser.add_argument(
+        "-r", "--root",
+        help    = "Directory containing the backups to serve",
+    )
+
+    cmd_parser.add_argument(
+        "-b", "--bind",
+        default = "127.0.0.1",
+        help    = "Address to listen on. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-p", "--port",
+        type    = int,
+        default = 9000,
+        help    = "Port to listen on. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-t", "--threads",
+        type    = int,
+        default = 4,
+        help    = "Number of worker threads. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-c", "--cache-size",
+        type    = int,
+        default = server.MAX_CACHE_SIZE // (1024 * 1024),
+        help    = "Memory limit for cached backups in MB. Default is %(default)s",
+    )
+
+    cmd_parser.add_argument(
+        "-v", "--verbose",
+        action  = "store_true",
+        default = False,
+        help    = "Log each request to StdErr",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+
+    if not cmd_arguments.root:
+        sys.exit("Missing --root option is always required")
+    elif not os.path.isdir(cmd_arguments.root):
+        sys.exit("Root directory does not exist")
+    elif cmd_arguments.threads < 1:
+        sys.exit("At least one worker thread is required")
+
+    service = server.BackupService(cmd_arguments.root, cmd_arguments.cache_size * 1024 * 1024)
+    http_server = server.BackupServer(
+        (cmd_arguments.bind, cmd_arguments.port), service,
+        cmd_arguments.threads, cmd_arguments.verbose,
+    )
+
+    sys.stderr.write("Serving %s on http://%s:%s/\n" % (
+        os.path.abspath(cmd_arguments.root), cmd_arguments.bind, cmd_arguments.port,
+    ))
+
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        http_server.server_close()
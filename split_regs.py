@@ -16,8 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import argparse, os, sys
+import argparse, os, sys, time
+import psr9000.archive as archive
+import psr9000.batch as batch
+import psr9000.instrument as instrument
+import psr9000.plan as plan
 import psr9000.regbank as regbank
+import psr9000.regmerge as regmerge
+import psr9000.watch as watch
 
 if __name__ == "__main__":
     cmd_parser = argparse.ArgumentParser(
@@ -42,39 +48,215 @@ if __name__ == "__main__":
 
     cmd_parser.add_argument(
         "-i", "--input",
-        help    = "Name of old user data backup",
+        nargs   = "+",
+        help    = "Name of old user data backup. Several names or patterns like "
+                  "\"backups/*.usr\" switch to batch mode",
     )
 
     cmd_parser.add_argument(
         "-o", "--output",
-        help    = "Name of new user data backup",
+        help    = "Name of new user data backup. Directory for all new backups in batch mode",
+    )
+
+    cmd_parser.add_argument(
+        "-S", "--source",
+        action  = "append",
+        help    = "Additional backup for --create as NAME=PATH or just PATH (named like the file "
+                  "without extension). Map lines like \"NAME:03|1|Title\" take registrations from it",
     )
 
     cmd_parser.add_argument(
         "-m", "--map",
-        help    = "Map file. Default is to read StdIn / write StdOut"
+        help    = "Map file. Default is to read StdIn / write StdOut. "
+                  "Directory for all map files when splitting in batch mode"
+    )
+
+    cmd_parser.add_argument(
+        "--cache",
+        action  = "store_true",
+        default = False,
+        help    = "Keep the parsed index of each backup and the compiled plan of each map "
+                  "in a cache to speed up repeated runs",
+    )
+
+    cmd_parser.add_argument(
+        "-P", "--plan",
+        help    = "Write the copy plan compiled from the map with --create to this file (- for StdOut), "
+                  "e.g. to inspect or diff it. Without --output nothing else is written",
+    )
+
+    cmd_parser.add_argument(
+        "-w", "--watch",
+        action  = "store_true",
+        default = False,
+        help    = "Keep running after --create and update the new backup whenever the map file changes",
+    )
+
+    cmd_parser.add_argument(
+        "-j", "--jobs",
+        type    = int,
+        help    = "Number of backups processed in parallel in batch mode or loaded in parallel "
+                  "with --source (0 = one per CPU). Default is 1 in batch mode and %s with --source"
+                  % regmerge.LOAD_THREADS,
+    )
+
+    cmd_parser.add_argument(
+        "--profile",
+        nargs   = "?",
+        const   = "table",
+        choices = instrument.PROFILE_FORMATS,
+        help    = "Print a breakdown of the run to StdErr: a table of the library phases (default), "
+                  "the same as JSON or cProfile statistics. Batch workers are not included",
     )
 
     cmd_arguments = cmd_parser.parse_args()
 
     if not cmd_arguments.split and not cmd_arguments.create:
         sys.exit("Specify either --split or --create")
-    elif not cmd_arguments.input:
-        sys.exit("Missing --input option is always required")
-    elif cmd_arguments.create and not cmd_arguments.output:
+    elif not cmd_arguments.input and not cmd_arguments.source:
+        sys.exit("Missing --input option is required without --source")
+    elif cmd_arguments.source and not cmd_arguments.create:
+        sys.exit("Option --source can only be used with --create")
+    elif cmd_arguments.create and not cmd_arguments.output and not cmd_arguments.plan:
         sys.exit("Missing --output option is required in create mode")
-    elif cmd_arguments.input == cmd_arguments.output:
+    elif cmd_arguments.watch and not cmd_arguments.create:
+        sys.exit("Option --watch can only be used with --create")
+    elif cmd_arguments.watch and not cmd_arguments.map:
+        sys.exit("Missing --map option is required with --watch")
+    elif cmd_arguments.watch and archive.archive_format(cmd_arguments.output):
+        sys.exit("Option --watch cannot write archives")
+    elif cmd_arguments.watch and cmd_arguments.source:
+        sys.exit("Option --watch cannot be used with --source")
+    elif cmd_arguments.plan and (not cmd_arguments.create or cmd_arguments.watch or cmd_arguments.source):
+        sys.exit("Option --plan can only be used with --create but not with --watch or --source")
+    elif cmd_arguments.plan and cmd_arguments.plan != "-" and os.path.exists(cmd_arguments.plan):
+        sys.exit("Plan file already exists")
+
+    if cmd_arguments.profile:
+        instrument.start_profile(cmd_arguments.profile, sys.stderr)
+
+    if cmd_arguments.jobs is None:
+        cmd_arguments.jobs = regmerge.LOAD_THREADS if cmd_arguments.source else 1
+
+    if cmd_arguments.source:
+        if cmd_arguments.output and os.path.exists(cmd_arguments.output):
+            sys.exit("Output directory already exits")
+        elif cmd_arguments.map and not os.path.exists(cmd_arguments.map):
+            sys.exit("Map file does not exist")
+
+        input_dir = None
+
+        if cmd_arguments.input:
+            inputs = batch.expand_inputs(cmd_arguments.input)
+
+            if len(inputs) > 1:
+                sys.exit("Option --source cannot be used in batch mode")
+
+            input_dir = inputs[0]
+
+            if input_dir == cmd_arguments.output:
+                sys.exit("Input must be different from output")
+
+            try:
+                batch.check_input(input_dir)
+            except ValueError as err:
+                sys.exit(str(err))
+
+        if cmd_arguments.map:
+            map_file = open(cmd_arguments.map, "r")
+        else:
+            map_file = sys.stdin
+
+        try:
+            registration_map = regbank.read_registration_map(map_file)
+            sources = regmerge.parse_sources(cmd_arguments.source)
+            new_banks = regmerge.merge_registrations(
+                sources, registration_map, input_dir, cmd_arguments.jobs, cmd_arguments.cache,
+            )
+        except KeyError as err:
+            sys.exit(err.args[0])
+        except (EnvironmentError, ValueError) as err:
+            sys.exit(str(err))
+
+        if cmd_arguments.map:
+            map_file.close()
+
+        regbank.write_banks(new_banks, cmd_arguments.output, input_dir)
+        sys.exit(0)
+
+    inputs = batch.expand_inputs(cmd_arguments.input)
+
+    if len(inputs) > 1:
+        if cmd_arguments.watch:
+            sys.exit("Option --watch cannot be used in batch mode")
+        elif cmd_arguments.plan:
+            sys.exit("Option --plan cannot be used in batch mode")
+
+        start = time.time()
+
+        if cmd_arguments.split:
+            if not cmd_arguments.map:
+                sys.exit("Missing --map directory is required to split in batch mode")
+            elif not os.path.isdir(cmd_arguments.map):
+                os.mkdir(cmd_arguments.map)
+
+            try:
+                maps = batch.output_names(inputs, cmd_arguments.map)
+            except ValueError as err:
+                sys.exit(str(err))
+
+            errors = batch.run_batch(
+                batch.split_backup,
+                [(input_dir, map_path + ".map", cmd_arguments.cache) for input_dir, map_path in zip(inputs, maps)],
+                cmd_arguments.jobs,
+            )
+        else:
+            if cmd_arguments.map and not os.path.exists(cmd_arguments.map):
+                sys.exit("Map file does not exist")
+
+            if cmd_arguments.map:
+                map_file = open(cmd_arguments.map, "r")
+            else:
+                map_file = sys.stdin
+
+            registration_map = regbank.read_registration_map(map_file)
+
+            if cmd_arguments.map:
+                map_file.close()
+
+            if not os.path.isdir(cmd_arguments.output):
+                os.mkdir(cmd_arguments.output)
+
+            try:
+                outputs = batch.output_names(inputs, cmd_arguments.output)
+            except ValueError as err:
+                sys.exit(str(err))
+
+            errors = batch.run_batch(
+                batch.create_backup,
+                [(input_dir, output_dir, registration_map, cmd_arguments.cache)
+                 for input_dir, output_dir in zip(inputs, outputs)],
+                cmd_arguments.jobs,
+            )
+
+        if batch.print_report(inputs, errors, sys.stderr, time.time() - start):
+            sys.exit(1)
+
+        sys.exit(0)
+
+    cmd_arguments.input = inputs[0]
+
+    if cmd_arguments.input == cmd_arguments.output:
         sys.exit("Input must be different from output")
-    elif not os.path.exists(cmd_arguments.input):
-        sys.exit("Input directory does not exit")
-    elif not os.path.isdir(cmd_arguments.input):
-        sys.exit("Input file is no directory")
-    elif not os.path.exists(os.path.join(cmd_arguments.input, "Regist.reg")):
-        sys.exit("No registrations found inside input directory")
     elif cmd_arguments.output and os.path.exists(cmd_arguments.output):
         sys.exit("Output directory already exits")
 
-    banks = regbank.read_banks(cmd_arguments.input)
+    try:
+        batch.check_input(cmd_arguments.input)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    banks = batch.read_input(cmd_arguments.input, cmd_arguments.cache)
 
     if cmd_arguments.split:
         if cmd_arguments.map and os.path.exists(cmd_arguments.map):
@@ -89,6 +271,38 @@ if __name__ == "__main__":
 
         if cmd_arguments.map:
             map_file.close()
+    elif cmd_arguments.create and cmd_arguments.watch:
+        if not os.path.exists(cmd_arguments.map):
+            sys.exit("Map file does not exist")
+
+        watcher = watch.FileWatcher(cmd_arguments.map)
+        backup = watch.IncrementalBackup(cmd_arguments.output, cmd_arguments.input)
+        index = regbank.RegistrationIndex(banks)
+
+        try:
+            while True:
+                start = time.time()
+
+                try:
+                    map_file = open(cmd_arguments.map, "r")
+                    registration_map = regbank.read_registration_map(map_file)
+                    map_file.close()
+
+                    new_banks = regbank.rearrange_registrations(banks, registration_map, index)
+                    written = backup.update(new_banks)
+
+                    sys.stderr.write("%s: %s of %s banks written in %.1f ms\n" % (
+                        time.strftime("%H:%M:%S"), written, len(new_banks), (time.time() - start) * 1000,
+                    ))
+                except (EnvironmentError, KeyError, ValueError) as err:
+                    if isinstance(err, KeyError):
+                        err = err.args[0]
+
+                    sys.stderr.write("%s: %s\n" % (time.strftime("%H:%M:%S"), err))
+
+                watcher.wait()
+        except KeyboardInterrupt:
+            watcher.close()
     elif cmd_arguments.create:
         if cmd_arguments.map and not os.path.exists(cmd_arguments.map):
             sys.exit("Map file does not exist")
@@ -98,9 +312,32 @@ if __name__ == "__main__":
         else:
             map_file = sys.stdin
 
-        registration_map = regbank.read_registration_map(map_file)
-        new_banks = regbank.rearrange_registrations(banks, registration_map)
-        regbank.write_banks(new_banks, cmd_arguments.output)
+        if cmd_arguments.cache or cmd_arguments.plan:
+            try:
+                copy_plan = plan.get_plan(map_file.read(), banks, cmd_arguments.cache)
+            except KeyError as err:
+                sys.exit(err.args[0])
+            except ValueError as err:
+                sys.exit(str(err))
+
+            if cmd_arguments.plan == "-":
+                plan.write_plan_text(copy_plan, sys.stdout)
+            elif cmd_arguments.plan:
+                plan_file = open(cmd_arguments.plan, "w")
+                plan.write_plan_text(copy_plan, plan_file)
+                plan_file.close()
+
+            if cmd_arguments.output:
+                plan.write_plan(copy_plan, banks, cmd_arguments.output, cmd_arguments.input)
+        else:
+            registration_map = regbank.read_registration_map(map_file)
+
+            try:
+                new_banks = regbank.rearrange_registrations(banks, registration_map)
+            except KeyError as err:
+                sys.exit(err.args[0])
+
+            regbank.write_banks(new_banks, cmd_arguments.output, cmd_arguments.input)
 
         if cmd_arguments.map:
             map_file.close()
@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: store_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sys
+import psr9000.batch as batch
+import psr9000.regbank as regbank
+import psr9000.regstore as regstore
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: store_regs",
+        description = "Keep many PSR-9000 backups in a store where each registration is saved only once"
+    )
+
+    cmd_parser.add_argument(
+        "-d", "--store",
+        help    = "Directory of the registration store. Created if it doesn't exist",
+    )
+
+    cmd_parser.add_argument(
+        "-a", "--add",
+        nargs   = "+",
+        metavar = "INPUT",
+        help    = "Names of user data backups or patterns like \"backups/*.usr\" to add to the store",
+    )
+
+    cmd_parser.add_argument(
+        "-n", "--name",
+        help    = "Name of the added backup inside the store. Default is the directory name",
+    )
+
+    cmd_parser.add_argument(
+        "-r", "--rebuild",
+        nargs   = "?",
+        const   = "",
+        metavar = "NAME",
+        help    = "Name of a stored backup to write to --output. Can be left out with a --map "
+                  "whose registrations all name their stored backup",
+    )
+
+    cmd_parser.add_argument(
+        "-o", "--output",
+        help    = "Name of the rebuilt user data backup",
+    )
+
+    cmd_parser.add_argument(
+        "-m", "--map",
+        help    = "Map file to rearrange the rebuilt backup like split_regs.py --create does. "
+                  "Registrations like \"NAME:01|1|...\" are taken from other stored backups",
+    )
+
+    cmd_parser.add_argument(
+        "-l", "--list",
+        nargs   = "?",
+        const   = "",
+        metavar = "NAME",
+        help    = "List stored backups or the registrations of one stored backup with their hashes",
+    )
+
+    cmd_parser.add_argument(
+        "-w", "--which",
+        metavar = "HASH",
+        help    = "List all stored backups containing the registration with the given hash",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+    modes = [cmd_arguments.add, cmd_arguments.rebuild, cmd_arguments.list, cmd_arguments.which]
+
+    if not cmd_arguments.store:
+        sys.exit("Missing --store option is always required")
+    elif len([mode for mode in modes if mode is not None]) != 1:
+        sys.exit("Specify exactly one of --add, --rebuild, --list or --which")
+    elif cmd_arguments.rebuild is not None and not cmd_arguments.output:
+        sys.exit("Missing --output option is required to rebuild a backup")
+    elif cmd_arguments.rebuild == "" and not cmd_arguments.map:
+        sys.exit("Missing --map option is required to rebuild without a backup name")
+    elif cmd_arguments.output and os.path.exists(cmd_arguments.output):
+        sys.exit("Output directory already exits")
+    elif cmd_arguments.map and not os.path.exists(cmd_arguments.map):
+        sys.exit("Map file does not exist")
+
+    store = regstore.RegistrationStore(cmd_arguments.store)
+
+    if cmd_arguments.add:
+        inputs = batch.expand_inputs(cmd_arguments.add)
+
+        if cmd_arguments.name and len(inputs) > 1:
+            sys.exit("Option --name can only be used with a single backup")
+
+        for input_dir in inputs:
+            try:
+                batch.check_input(input_dir)
+                total, added = store.add_backup(input_dir, cmd_arguments.name)
+            except ValueError as err:
+                sys.exit("%s: %s" % (input_dir, err))
+
+            sys.stderr.write("%s: %s registrations, %s new\n" % (input_dir, total, added))
+    elif cmd_arguments.rebuild is not None:
+        try:
+            if cmd_arguments.map:
+                map_file = open(cmd_arguments.map, "r")
+                registration_map = regbank.read_registration_map(map_file)
+                map_file.close()
+
+                banks = store.load_mix(registration_map, cmd_arguments.rebuild or None)
+            else:
+                banks = store.load_backup(cmd_arguments.rebuild)
+        except KeyError as err:
+            sys.exit(err.args[0])
+        except ValueError as err:
+            sys.exit(str(err))
+
+        regbank.write_banks(banks, cmd_arguments.output)
+    elif cmd_arguments.list:
+        try:
+            backup = store.read_backup(cmd_arguments.list)
+        except KeyError as err:
+            sys.exit(err.args[0])
+
+        for bank in backup["banks"]:
+            for registration in bank["registrations"]:
+                if registration["hash"]:
+                    line = "%s  %02d|%s|%s\n" % (
+                        registration["hash"], bank["number"] + 1,
+                        registration["number"] + 1, registration["name"],
+                    )
+
+                    # Names are stored as Latin-1 text, write them back as
+                    # the bytes of the backup (see regstore.py)
+                    sys.stdout.write(line.encode("latin-1") if bytes is str else line)
+    elif cmd_arguments.list is not None:
+        for name in store.backups():
+            sys.stdout.write("%s\n" % name)
+    else:
+        for name in store.backups_containing(cmd_arguments.which.lower()):
+            sys.stdout.write("%s\n" % name)
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of archive and userfiles (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.archive as archive
+import psr9000.userfiles as userfiles
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.registration_path = os.path.join(self.temp_dir, "registrations")
+
+        registration_file = open(self.registration_path, "wb")
+        registration_file.write(b"\xd0\x06\x00\x00" * 100)
+        registration_file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_format(self, suffix):
+        path = os.path.join(self.temp_dir, "backup" + suffix)
+        archive.write_archive(
+            path, iter([("STYLE01.STY", b"style"), ("USERFILE.INI", b"ini")]),
+            [("Regist.reg", self.registration_path)],
+        )
+
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), sorted(["backup" + suffix, "registrations"]))
+
+        backup = userfiles.open_backup(path)
+
+        try:
+            self.assertEqual(backup.members(), ["Regist.reg", "STYLE01.STY", "USERFILE.INI"])
+            self.assertEqual(backup.size("regist.reg"), 400)
+            self.assertEqual(backup.read("Regist.reg"), b"\xd0\x06\x00\x00" * 100)
+            self.assertEqual(userfiles.list_files(backup), ["STYLE01.STY"])
+            self.assertEqual(userfiles.file_sizes(backup), 5)
+            self.assertEqual(userfiles.read_file(backup, "userfile.ini"), b"ini")
+            self.assertEqual(userfiles.read_file(backup, "SONG01.MID"), None)
+        finally:
+            backup.close()
+
+    def test_zip(self):
+        self.check_format(".zip")
+
+    def test_tar_gz(self):
+        self.check_format(".tar.gz")
+
+    def test_failed_write(self):
+        path = os.path.join(self.temp_dir, "backup.zip")
+
+        def members():
+            yield "STYLE01.STY", b"style"
+            raise ValueError("Broken input")
+
+        self.assertRaises(ValueError, archive.write_archive, path, members(), [("Regist.reg", self.registration_path)])
+        self.assertEqual(os.listdir(self.temp_dir), ["registrations"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the batch mode (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io, os, shutil, tempfile, unittest
+import psr9000.batch as batch
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+
+PATCHES = [(40, bytearray(b"\x01\x02"))]
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.inputs = []
+        os.mkdir(os.path.join(self.temp_dir, "input"))
+
+        for name in ("a.usr", "b.usr", "c.usr"):
+            self.inputs.append(os.path.join(self.temp_dir, "input", name))
+            synth.generate_backup(self.inputs[-1], bank_count=2, seed=len(self.inputs))
+
+        os.remove(os.path.join(self.inputs[1], "Regist.reg"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_expand_inputs(self):
+        pattern = os.path.join(self.temp_dir, "input", "*.usr")
+        missing = os.path.join(self.temp_dir, "missing", "*.usr")
+
+        self.assertEqual(batch.expand_inputs([self.inputs[2], pattern, missing]), [
+            self.inputs[2], self.inputs[0], self.inputs[1], missing,
+        ])
+
+    def test_output_names(self):
+        output_dir = os.path.join(self.temp_dir, "output")
+
+        self.assertEqual(batch.output_names(self.inputs[:2], output_dir), [
+            os.path.join(output_dir, "a.usr"), os.path.join(output_dir, "b.usr"),
+        ])
+        self.assertRaises(ValueError, batch.output_names, [self.inputs[0], os.path.join(self.temp_dir, "a.usr")], output_dir)
+
+    def check_batch(self, jobs):
+        output_dir = os.path.join(self.temp_dir, "output-%s" % jobs)
+        os.mkdir(output_dir)
+        outputs = batch.output_names(self.inputs, output_dir)
+
+        errors = batch.run_batch(
+            batch.patch_backup,
+            [(input_dir, output, PATCHES) for input_dir, output in zip(self.inputs, outputs)],
+            jobs,
+        )
+
+        self.assertEqual([error is None for error in errors], [True, False, True])
+        self.assertEqual(sorted(os.listdir(output_dir)), ["a.usr", "c.usr"])
+
+        for output in (outputs[0], outputs[2]):
+            for bank in regbank.read_banks(output):
+                for registration in bank.registrations:
+                    if not registration.empty:
+                        self.assertEqual(bytes(registration.data[8:10]), b"\x01\x02")
+
+        return errors
+
+    def test_failed_backups_dont_stop_the_batch(self):
+        self.assertEqual(self.check_batch(1), self.check_batch(2))
+
+    def test_report(self):
+        stream = io.StringIO() if bytes is not str else io.BytesIO()
+        failed = batch.print_report(["a.usr", "b.usr"], [None, "Broken\nbackup"], stream)
+
+        self.assertEqual(failed, 1)
+        self.assertEqual(stream.getvalue(), (
+            "OK      a.usr\n"
+            "FAILED  b.usr: Broken; backup\n"
+            "\n2 backups processed, 1 succeeded, 1 failed\n"
+        ))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the index cache (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.cache as cache
+import psr9000.synth as synth
+
+class CacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "a.usr")
+        synth.generate_backup(self.input_dir, bank_count=2, seed=1)
+        self.registration_path = os.path.join(self.input_dir, "Regist.reg")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_key_is_stable(self):
+        self.assertEqual(cache.cache_key(self.registration_path), cache.cache_key(self.registration_path))
+
+    def test_small_time_differences(self):
+        os.utime(self.registration_path, (1300000000.001, 1300000000.001))
+        key = cache.cache_key(self.registration_path)
+        os.utime(self.registration_path, (1300000000.002, 1300000000.002))
+
+        self.assertNotEqual(cache.cache_key(self.registration_path), key)
+
+    def test_replaced_file(self):
+        os.utime(self.registration_path, (1300000000, 1300000000))
+        key = cache.cache_key(self.registration_path)
+
+        # Another inode with the same content, size and time stamp
+        copy_path = self.registration_path + ".new"
+        other_path = self.registration_path + ".old"
+        shutil.copyfile(self.registration_path, copy_path)
+        os.utime(copy_path, (1300000000, 1300000000))
+        os.rename(self.registration_path, other_path)
+        os.rename(copy_path, self.registration_path)
+
+        self.assertNotEqual(cache.cache_key(self.registration_path), key)
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the chained command line (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, subprocess, sys, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def read_file(path):
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+class ChainTest(unittest.TestCase):
+    '''
+    Runs psr-tools and the standalone tools as processes, because both
+    read and write StdIn and StdOut, and compares their output.
+    '''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = self.path("input.usr")
+        banks = synth.generate_backup(self.input_dir, bank_count=3, seed=1)
+
+        with open(self.path("reversed.map"), "w") as map_file:
+            regbank.write_registration_map(list(reversed(banks)), map_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def run_tool(self, script, *args):
+        return subprocess.check_output([sys.executable, os.path.join(ROOT, script)] + list(args), cwd=self.temp_dir)
+
+    def assertSameBackup(self, output_dir, expected_dir):
+        for name in ("Regist.reg", "USERFILE.INI"):
+            self.assertEqual(read_file(os.path.join(output_dir, name)), read_file(os.path.join(expected_dir, name)))
+
+    def test_split(self):
+        self.run_tool("split_regs.py", "-s", "-i", "input.usr", "-m", "expected.map")
+        self.run_tool("psr-tools", "-i", "input.usr", "split", "-m", "output.map")
+
+        self.assertEqual(read_file(self.path("output.map")), read_file(self.path("expected.map")))
+        self.assertEqual(self.run_tool("psr-tools", "-i", "input.usr", "split"), read_file(self.path("expected.map")))
+
+    def test_patch_and_create(self):
+        self.run_tool("patch_regs.py", "-i", "input.usr", "-o", "patched.usr", "-s", "633", "-b", "310f")
+        self.run_tool("split_regs.py", "-c", "-i", "patched.usr", "-o", "expected.usr", "-m", "reversed.map")
+
+        self.run_tool(
+            "psr-tools", "-i", "input.usr", "-o", "chained.usr",
+            "patch", "-s", "633", "-b", "310f", "+", "create", "-m", "reversed.map",
+        )
+
+        self.assertSameBackup(self.path("chained.usr"), self.path("expected.usr"))
+
+    def test_pipe(self):
+        self.run_tool("split_regs.py", "-c", "-i", "input.usr", "-o", "expected.usr", "-m", "reversed.map")
+
+        registrations = self.run_tool("psr-tools", "-i", "input.usr", "create", "-m", "reversed.map")
+        self.assertEqual(registrations, read_file(self.path("expected.usr/Regist.reg")))
+
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "psr-tools"), "-f", "input.usr", "-o", "piped.usr", "patch", "-s", "633", "-b", "310f"],
+            stdin=subprocess.PIPE, cwd=self.temp_dir,
+        )
+        process.communicate(registrations)
+        self.assertEqual(process.returncode, 0)
+
+        self.run_tool("patch_regs.py", "-i", "expected.usr", "-o", "patched.usr", "-s", "633", "-b", "310f")
+        self.assertSameBackup(self.path("piped.usr"), self.path("patched.usr"))
+
+if __name__ == "__main__":
+    unittest.main()
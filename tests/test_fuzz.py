@@ -0,0 +1,44 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: replay of the fuzzing corpus (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, unittest
+import psr9000.fuzz as fuzz
+
+# Minimized inputs which broke the parser or writer before, see fuzz_regs.py.
+# The .txt file next to each input describes the original failure.
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+class CorpusTest(unittest.TestCase):
+
+    def test_corpus_exists(self):
+        self.assertTrue(fuzz.read_corpus(CORPUS_DIR))
+
+    def test_corpus(self):
+        failures = []
+
+        for name, data in fuzz.read_corpus(CORPUS_DIR):
+            failure = fuzz.guarded_check(data)
+
+            if failure is not None:
+                failures.append("%s: %s" % (name, failure))
+
+        self.assertEqual(failures, [])
+
+    def test_synthetic_seeds_round_trip(self):
+        self.assertEqual(fuzz.check_seeds(fuzz.synthetic_seeds(seed=1)), [])
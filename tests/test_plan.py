@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of compiled plans (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io, os, shutil, tempfile, unittest
+import psr9000.instrument as instrument
+import psr9000.plan as plan
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+
+MAP_TEXT = '''\
+01|N|Mix
+03|2|Two
+01|1|One
+01|3|
+
+02|N|Copy
+02|4|Four
+'''
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "a.usr")
+        synth.generate_backup(self.input_dir, bank_count=3, filled=1.0, seed=1)
+
+        self.banks = regbank.read_banks(self.input_dir, lazy=True)
+
+        map_path = os.path.join(self.temp_dir, "mix.map")
+        map_file = open(map_path, "w")
+        map_file.write(MAP_TEXT)
+        map_file.close()
+
+        map_file = open(map_path, "r")
+        self.registration_map = regbank.read_registration_map(map_file)
+        map_file.close()
+
+    def tearDown(self):
+        plan.banks_source(self.banks).close()
+        shutil.rmtree(self.temp_dir)
+
+    def execute(self, compiled, source):
+        output_file = tempfile.TemporaryFile()
+
+        try:
+            plan.execute_plan(compiled, source, output_file)
+            output_file.seek(0)
+            return output_file.read()
+        finally:
+            output_file.close()
+
+    def test_plan_writes_the_same_as_write_banks(self):
+        compiled = plan.compile_plan(self.banks, self.registration_map)
+        expected = io.BytesIO()
+        regbank.write_registration_file(regbank.rearrange_registrations(self.banks, self.registration_map), expected)
+
+        self.assertEqual(self.execute(compiled, plan.banks_source(self.banks)), expected.getvalue())
+        self.assertEqual(compiled["size"], len(expected.getvalue()))
+
+    def test_copies_are_counted_once(self):
+        compiled = plan.compile_plan(self.banks, self.registration_map)
+        copied = sum(operation[3] for operation in compiled["operations"] if operation[0] == "copy")
+        counters = {}
+
+        def hook(event, name, value):
+            if event == "count":
+                counters[name] = counters.get(name, 0) + value
+
+        instrument.add_hook(hook)
+
+        try:
+            self.execute(compiled, plan.banks_source(self.banks))
+        finally:
+            instrument.remove_hook(hook)
+
+        self.assertTrue(copied > 0)
+        self.assertEqual(counters["bytes_written"], compiled["size"])
+        self.assertEqual(counters["bytes_read"], copied)
+
+    def test_dump_and_load(self):
+        compiled = plan.compile_plan(self.banks, self.registration_map)
+        loaded = plan.load_plan(plan.dump_plan(compiled))
+
+        self.assertEqual(plan.dump_plan(loaded), plan.dump_plan(compiled))
+        self.assertEqual(
+            self.execute(loaded, plan.banks_source(self.banks)),
+            self.execute(compiled, plan.banks_source(self.banks)),
+        )
+
+    def test_other_versions_are_rejected(self):
+        compiled = plan.compile_plan(self.banks, self.registration_map)
+        compiled["version"] = plan.PLAN_VERSION - 1
+
+        self.assertRaises(ValueError, plan.load_plan, plan.dump_plan(compiled))
+
+    def test_plan_must_fit_the_source(self):
+        compiled = plan.compile_plan(self.banks, self.registration_map)
+        source = plan.banks_source(self.banks)
+        short_source = regbank.RegistrationBuffer("short", bytes(source.view(0, 0x0C10)))
+
+        self.assertRaises(ValueError, self.execute, compiled, short_source)
+
+    def test_key_depends_on_map_and_index(self):
+        other_dir = os.path.join(self.temp_dir, "b.usr")
+        synth.generate_backup(other_dir, bank_count=3, filled=1.0, seed=2)
+        other_banks = regbank.read_banks(other_dir, lazy=True)
+
+        try:
+            key = plan.plan_key(MAP_TEXT, self.banks)
+
+            self.assertEqual(key, plan.plan_key(MAP_TEXT, regbank.read_banks(self.input_dir)))
+            self.assertNotEqual(key, plan.plan_key(MAP_TEXT + "\n", self.banks))
+            self.assertNotEqual(key, plan.plan_key(MAP_TEXT, other_banks))
+        finally:
+            plan.banks_source(other_banks).close()
@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of regbank (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io, os, shutil, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+
+def plain_banks(banks):
+    '''
+    Returns the banks as plain dictionaries with all payloads as bytes, so
+    that eagerly and lazily read banks can be compared.
+    '''
+    result = []
+
+    for bank in banks:
+        bank = bank.as_dict()
+
+        for registration in bank["registrations"]:
+            registration["head"] = bytes(registration["head"])
+            registration["data"] = bytes(registration["data"])
+
+        result.append(bank)
+
+    return result
+
+class ReadBanksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "a.usr")
+        self.banks = synth.generate_backup(self.input_dir, bank_count=4, seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_lazy_equals_eager(self):
+        eager = regbank.read_banks(self.input_dir)
+        lazy = regbank.read_banks(self.input_dir, lazy=True)
+
+        self.assertEqual(plain_banks(lazy), plain_banks(eager))
+        self.assertEqual(len(eager), 4)
+
+        for bank in lazy:
+            for registration in bank.registrations:
+                if not registration.empty:
+                    self.assertNotEqual(registration.data_location(), None)
+
+    def test_archive_and_stream_equal_directory(self):
+        expected = plain_banks(regbank.read_banks(self.input_dir))
+        archive_path = os.path.join(self.temp_dir, "a.zip")
+        regbank.write_banks(self.banks, archive_path)
+
+        self.assertEqual(plain_banks(regbank.read_banks(archive_path, lazy=True)), expected)
+
+        with open(os.path.join(self.input_dir, "Regist.reg"), "rb") as registration_file:
+            stream = io.BytesIO(registration_file.read())
+
+        self.assertEqual(plain_banks(regbank.read_registration_stream(stream)), expected)
+
+    def test_synthetic_banks_are_read_back(self):
+        banks = regbank.read_banks(self.input_dir)
+
+        for bank, expected in zip(banks, self.banks):
+            self.assertEqual(bank.name, expected.name)
+
+            for registration, expected_registration in zip(bank.registrations, expected.registrations):
+                self.assertEqual(registration.empty, expected_registration.empty)
+
+                if not registration.empty:
+                    self.assertEqual(registration.name, expected_registration.name)
+                    self.assertEqual(bytes(registration.data), bytes(expected_registration.data))
+
+class RecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registration = regbank.Registration(2, False, "Title", 1210, b"h" * 32, b"d" * 1188)
+        self.bank = regbank.Bank(0, "Bank", 0x0C10, 48, [self.registration])
+
+    def test_dict_access(self):
+        self.assertEqual(self.bank["name"], "Bank")
+        self.assertEqual(self.registration.get("data"), b"d" * 1188)
+        self.assertEqual(self.registration.get("offset", "missing"), "missing")
+        self.assertTrue("head" in self.registration)
+        self.assertFalse("source" in self.registration)
+        self.assertRaises(KeyError, lambda: self.bank["missing"])
+
+        self.registration["name"] = "Other"
+        self.assertEqual(self.registration.name, "Other")
+
+    def test_dict_round_trip(self):
+        bank = regbank.Bank.from_dict(self.bank.as_dict())
+
+        self.assertEqual(bank.as_dict(), self.bank.as_dict())
+        self.assertEqual(sorted(bank.as_dict()["registrations"][0]), sorted(regbank.Registration.fields))
+
+    def test_copy_shares_payloads(self):
+        copy = self.registration.copy()
+        copy.number = 5
+        copy.name = "Copy"
+
+        self.assertTrue(copy.data is self.registration.data)
+        self.assertEqual((self.registration.number, self.registration.name), (2, "Title"))
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.registration, "__dict__"))
+        self.assertFalse(hasattr(self.bank, "__dict__"))
+
+def read_map(text):
+    return regbank.read_registration_map(io.StringIO(text) if bytes is not str else io.BytesIO(text))
+
+class RearrangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.banks = synth.generate_banks(bank_count=2, filled=1.0, seed=1)
+
+    def test_references(self):
+        registration_map = read_map(
+            "01|N|Mixed\n"
+            "02|3|Renamed\n"
+            "||reg 01-2\n"
+            "01|1|\n"
+        )
+
+        new_banks = regbank.rearrange_registrations(self.banks, registration_map)
+        registrations = new_banks[0].registrations
+
+        self.assertEqual(new_banks[0].name, "Mixed")
+        self.assertEqual([registration.name for registration in registrations[:2]], ["Renamed", "reg 01-2"])
+        self.assertTrue(registrations[0].data is self.banks[1].registrations[2].data)
+        self.assertTrue(registrations[1].data is self.banks[0].registrations[1].data)
+        self.assertEqual([registration.empty for registration in registrations], [False, False] + 6 * [True])
+        self.assertEqual([registration.number for registration in registrations], list(range(8)))
+
+    def test_index_is_reused(self):
+        index = regbank.RegistrationIndex(self.banks)
+        registration_map = read_map("01|N|Bank\n01|1|One\n")
+
+        first = regbank.rearrange_registrations(self.banks, registration_map, index)
+        second = regbank.rearrange_registrations(self.banks, registration_map, index)
+        self.assertEqual(first[0].as_dict(), second[0].as_dict())
+
+    def test_all_missing_references_are_reported(self):
+        registration_map = read_map(
+            "01|N|Broken\n"
+            "||Nope\n"
+            "09|1|No bank\n"
+            "01|9|No registration\n"
+            "01|1|Fine\n"
+        )
+
+        try:
+            regbank.rearrange_registrations(self.banks, registration_map)
+        except KeyError as err:
+            self.assertEqual(err.args[0].split("\n"), [
+                "Couldn't find registration named 'Nope'",
+                "Couldn't find bank number 9",
+                "Couldn't find registration 9 in bank 1",
+            ])
+        else:
+            self.fail("KeyError not raised")
+
+class WriteBanksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "a.usr")
+        synth.generate_backup(self.input_dir, bank_count=4, seed=1)
+        self.original = self.read_registrations(self.input_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read_registrations(self, backup_dir):
+        with open(os.path.join(backup_dir, "Regist.reg"), "rb") as registration_file:
+            return registration_file.read()
+
+    def write(self, banks, name):
+        output_dir = os.path.join(self.temp_dir, name)
+        regbank.write_banks(banks, output_dir, self.input_dir)
+        return self.read_registrations(output_dir)
+
+    def test_round_trip(self):
+        self.assertEqual(self.write(regbank.read_banks(self.input_dir), "eager.usr"), self.original)
+        self.assertEqual(self.write(regbank.read_banks(self.input_dir, lazy=True), "lazy.usr"), self.original)
+
+        stream = io.BytesIO()
+        regbank.write_registration_stream(regbank.read_banks(self.input_dir, lazy=True), stream)
+        self.assertEqual(stream.getvalue(), self.original)
+
+    def test_copy_through_equals_in_memory(self):
+        map_file = io.StringIO() if bytes is not str else io.BytesIO()
+        regbank.write_registration_map(list(reversed(regbank.read_banks(self.input_dir))), map_file)
+        map_file.seek(0)
+        registration_map = regbank.read_registration_map(map_file)
+
+        eager = regbank.rearrange_registrations(regbank.read_banks(self.input_dir), registration_map)
+        lazy = regbank.rearrange_registrations(regbank.read_banks(self.input_dir, lazy=True), registration_map)
+
+        expected = self.write(eager, "eager.usr")
+        self.assertEqual(self.write(lazy, "lazy.usr"), expected)
+        self.assertNotEqual(expected, self.original)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of near-duplicate search (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random, unittest
+import psr9000.regbank as regbank
+import psr9000.regcluster as regcluster
+
+def all_close_pairs(payloads, max_distance):
+    return [
+        (i, j) for i in range(len(payloads)) for j in range(i + 1, len(payloads))
+        if regcluster.within_distance(payloads[i], payloads[j], max_distance)
+    ]
+
+def similar_payloads(length, count=60, seed=1):
+    '''
+    Returns distinct payloads which differ from a random template in a few
+    bytes at its beginning.
+    '''
+    rng = random.Random(seed)
+    template = bytearray(rng.getrandbits(8) for i in range(length))
+    payloads = set()
+
+    for i in range(count):
+        payload = bytearray(template)
+
+        for change in range(rng.randint(0, 12)):
+            payload[rng.randrange(min(length, 40))] = rng.getrandbits(8)
+
+        payloads.add(bytes(payload))
+
+    return sorted(payloads)
+
+class ClosePairsPythonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.payloads = similar_payloads(200)
+
+    def test_same_as_comparing_all_pairs(self):
+        for max_distance in (0, 3, 8, 60):
+            self.assertEqual(
+                sorted(regcluster.close_pairs_python(self.payloads, max_distance, jobs=1)),
+                all_close_pairs(self.payloads, max_distance),
+            )
+
+    def test_worker_processes(self):
+        chunk_size = regcluster.CHUNK_SIZE
+        regcluster.CHUNK_SIZE = 10
+
+        try:
+            pairs = regcluster.close_pairs_python(self.payloads, 8, jobs=2)
+        finally:
+            regcluster.CHUNK_SIZE = chunk_size
+
+        self.assertEqual(sorted(pairs), all_close_pairs(self.payloads, 8))
+
+    def test_single_payload(self):
+        self.assertEqual(regcluster.close_pairs_python(self.payloads[:1], 8), [])
+
+@unittest.skipUnless(regcluster.numpy, "NumPy is not installed")
+class ClosePairsTest(unittest.TestCase):
+
+    def matrix(self, payloads):
+        matrix = regcluster.numpy.zeros((len(payloads), len(payloads[0])), regcluster.numpy.uint8)
+
+        for row, payload in enumerate(payloads):
+            matrix[row] = bytearray(payload)
+
+        return matrix
+
+    def check(self, payloads):
+        for max_distance in (0, 3, 8, 60):
+            self.assertEqual(
+                sorted(regcluster.close_pairs(self.matrix(payloads), max_distance)),
+                sorted(regcluster.close_pairs_python(payloads, max_distance, jobs=1)),
+            )
+
+    def test_one_hot(self):
+        self.check(similar_payloads(200))
+
+    def test_direct_comparison(self):
+        onehot_size = regcluster.ONEHOT_SIZE
+        regcluster.ONEHOT_SIZE = 0
+
+        try:
+            self.check(similar_payloads(200))
+        finally:
+            regcluster.ONEHOT_SIZE = onehot_size
+
+    def test_odd_and_empty_lengths(self):
+        self.check(similar_payloads(37))
+        self.check(similar_payloads(1, count=10))
+        self.check([b"", b""])
+
+    def test_clusters(self):
+        entries = [
+            ("a.usr", number, regbank.Registration(number % 8, False, b"Reg", len(payload) + 22, b"", payload))
+            for number, payload in enumerate(similar_payloads(200) + similar_payloads(37, seed=2))
+        ]
+
+        clusters = regcluster.cluster_registrations(entries, 4, jobs=1)
+        numpy = regcluster.numpy
+        regcluster.numpy = None
+
+        try:
+            expected = regcluster.cluster_registrations(entries, 4, jobs=1)
+        finally:
+            regcluster.numpy = numpy
+
+        self.assertEqual(
+            [([entry[1] for entry in cluster["members"]], cluster["offsets"]) for cluster in clusters],
+            [([entry[1] for entry in cluster["members"]], cluster["offsets"]) for cluster in expected],
+        )
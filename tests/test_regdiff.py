@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of regdiff (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import psr9000.regbank as regbank
+import psr9000.regdiff as regdiff
+
+class Output(list):
+    write = list.append
+
+def spec(*runs):
+    output_file = Output()
+    regdiff.write_patch_spec([{"runs": list(result)} for result in runs], output_file)
+    return "".join(output_file)
+
+class FindRunsTest(unittest.TestCase):
+
+    def test_runs(self):
+        self.assertEqual(regdiff.find_runs(b"\x00\x01\x02\x03", b"\x00\x09\x09\x03"), [(33, b"\x01\x02", b"\x09\x09")])
+        self.assertEqual(regdiff.find_runs(b"\x01\x02", b"\x09\x02\x03"), [(32, b"\x01", b"\x09")])
+        self.assertEqual(regdiff.find_runs(b"\x01\x02", b"\x01\x02"), [])
+
+class PatchSpecTest(unittest.TestCase):
+
+    def test_single_run(self):
+        self.assertEqual(spec([(633, b"\x02\x10", b"\x31\x0f")]), "633|310f\n")
+
+    def test_duplicate_runs(self):
+        self.assertEqual(spec([(633, b"\x02\x10", b"\x31\x0f")], [(633, b"\x02\x10", b"\x31\x0f")]), "633|310f\n")
+
+    def test_overlapping_runs(self):
+        self.assertEqual(spec([(633, b"\x02\x10", b"\x31\x0f")], [(634, b"\x00", b"\x0f")]), "633|310f\n")
+        self.assertEqual(spec([(633, b"\x02", b"\x31")], [(634, b"\x00\x00", b"\x0f\x01")]), "633|310f01\n")
+
+    def test_separate_runs(self):
+        self.assertEqual(spec([(633, b"\x02", b"\x31"), (640, b"\x00", b"\x01")]), "633|31\n640|01\n")
+
+    def test_conflict(self):
+        self.assertRaises(ValueError, spec, [(633, b"\x02\x10", b"\x31\x0f")], [(634, b"\x00", b"\x0e")])
+
+# Pairs of payloads with empty, odd and differing lengths
+PAYLOADS = [
+    (b"", b""),
+    (b"", b"\x01"),
+    (b"\x05", b"\x06"),
+    (b"\x00\x01\x02\x03\x04\x05\x06", b"\x00\x09\x09\x03\x04\x05\x07"),
+    (b"\x00\x01\x02\x03\x04\x05\x06", b"\x00\x01\x02\x03\x04\x05\x06"),
+    (b"\x10\x11\x12\x13\x14", b"\x10\x00\x12\x00\x14\x15\x16\x17"),
+    (b"\x10\x11\x12\x13\x14", b"\x00\x11\x12\x13\x00"),
+]
+
+@unittest.skipUnless(regdiff.numpy, "NumPy is not installed")
+class NumpyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = regdiff.numpy
+
+    def tearDown(self):
+        regdiff.numpy = self.numpy
+
+    def without_numpy(self, function, *args):
+        regdiff.numpy = None
+
+        try:
+            return function(*args)
+        finally:
+            regdiff.numpy = self.numpy
+
+    def test_find_runs(self):
+        for old_data, new_data in PAYLOADS:
+            self.assertEqual(
+                regdiff.find_runs(old_data, new_data),
+                self.without_numpy(regdiff.find_runs, old_data, new_data),
+            )
+
+    def test_diff_pairs(self):
+        bank = regbank.Bank(0, b"Bank", 0x0C10, 48)
+        pairs = []
+
+        for number, (old_data, new_data) in enumerate(PAYLOADS):
+            pairs.append((
+                bank, regbank.Registration(number % 8, False, b"Old", len(old_data) + 22, b"", old_data),
+                bank, regbank.Registration(number % 8, False, b"New", len(new_data) + 22, b"", new_data),
+            ))
+
+        self.assertEqual(
+            [result["runs"] for result in regdiff.diff_pairs(pairs)],
+            [result["runs"] for result in self.without_numpy(regdiff.diff_pairs, pairs)],
+        )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the columnar export (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import ast, os, shutil, struct, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.regexport as regexport
+import psr9000.synth as synth
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ITEM_SIZES = {"|u1": 1, "|S16": 16, "<i4": 4, "|b1": 1}
+
+def read_npy_header(path):
+    '''
+    Returns the magic string and header dictionary of a .npy file, the
+    offset of its data and the file size without using NumPy.
+    '''
+    with open(path, "rb") as npy_file:
+        magic = npy_file.read(8)
+        length = struct.unpack("<H", npy_file.read(2))[0]
+        header = ast.literal_eval(npy_file.read(length).decode("ascii"))
+
+    return magic, header, 10 + length, os.path.getsize(path)
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.inputs = []
+
+        for name in ("a.usr", "b.usr"):
+            self.inputs.append(os.path.join(self.temp_dir, name))
+            synth.generate_backup(self.inputs[-1], bank_count=2, seed=len(self.inputs))
+
+        self.store_dir = os.path.join(self.temp_dir, "store")
+        self.count = regexport.export_registrations(self.inputs, self.store_dir)
+        self.registrations = [
+            (source, bank, registration)
+            for source, input_dir in enumerate(self.inputs)
+            for bank in regbank.read_banks(input_dir)
+            for registration in bank.registrations
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_headers(self):
+        self.assertEqual(self.count, len(self.registrations))
+        width = max(len(registration.data) for source, bank, registration in self.registrations)
+
+        for column, descr in regexport.COLUMNS + (("payload", "|u1"),):
+            magic, header, offset, size = read_npy_header(os.path.join(self.store_dir, column + ".npy"))
+            shape = (self.count, width) if column == "payload" else (self.count,)
+
+            self.assertEqual(magic, b"\x93NUMPY\x01\x00")
+            self.assertEqual(header, {"descr": descr, "fortran_order": False, "shape": shape})
+            self.assertEqual(offset % 64, 0)
+            self.assertEqual(size, offset + ITEM_SIZES[descr] * self.count * (width if column == "payload" else 1))
+
+    @unittest.skipUnless(numpy, "NumPy is not installed")
+    def test_columns(self):
+        store = regexport.open_registrations(self.store_dir)
+
+        for column, descr in regexport.COLUMNS:
+            self.assertEqual(store[column].dtype, numpy.dtype(descr))
+
+        self.assertEqual(store["sources"], [os.path.abspath(input_dir) for input_dir in self.inputs])
+
+        for i, (source, bank, registration) in enumerate(self.registrations):
+            data = bytes(registration.data)
+
+            self.assertEqual(store["payload"][i, :len(data)].tobytes(), data)
+            self.assertFalse(store["payload"][i, len(data):].any())
+            self.assertEqual(store["bank"][i], bank.number)
+            self.assertEqual(store["registration"][i], registration.number)
+            self.assertEqual(store["name"][i], registration.name)
+            self.assertEqual(store["size"][i], registration.size)
+            self.assertEqual(store["empty"][i], registration.empty)
+            self.assertEqual(store["source"][i], source)
+
+if __name__ == "__main__":
+    unittest.main()
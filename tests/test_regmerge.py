@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of regmerge (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.instrument as instrument
+import psr9000.regbank as regbank
+import psr9000.regmerge as regmerge
+import psr9000.synth as synth
+
+class SourceNameTest(unittest.TestCase):
+
+    def test_directory(self):
+        self.assertEqual(regmerge.source_name("backups/live2010.usr"), "live2010")
+        self.assertEqual(regmerge.source_name("backups/live2010.usr/"), "live2010")
+
+    def test_archives(self):
+        self.assertEqual(regmerge.source_name("a.zip"), "a")
+        self.assertEqual(regmerge.source_name("x.tar"), "x")
+        self.assertEqual(regmerge.source_name("backups/live2010.tar.gz"), "live2010")
+        self.assertEqual(regmerge.source_name("backups/Live2010.TGZ"), "Live2010")
+
+    def test_parse_sources(self):
+        self.assertEqual(regmerge.parse_sources(["old=a.zip", "b.tar.bz2"]), {"old": "a.zip", "b": "b.tar.bz2"})
+        self.assertRaises(ValueError, regmerge.parse_sources, ["a.zip", "a.tar"])
+
+class ReadPayloadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.counters = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read_payloads(self, path):
+        synth.generate_backup(path, bank_count=2, seed=1)
+        banks = regbank.read_banks(path, lazy=True)
+        registrations = [registration for bank in banks for registration in bank.registrations if not registration.empty]
+        expected = [bytes(registration.data) for registration in registrations]
+
+        def hook(event, name, value):
+            if event == "count":
+                self.counters[name] = self.counters.get(name, 0) + value
+
+        instrument.add_hook(hook)
+
+        try:
+            regmerge.read_payloads(registrations)
+        finally:
+            instrument.remove_hook(hook)
+
+        self.assertEqual([bytes(registration.data) for registration in registrations], expected)
+        return sum(len(data) for data in expected)
+
+    def test_bytes_read_are_counted(self):
+        length = self.read_payloads(os.path.join(self.temp_dir, "a.usr"))
+        self.assertEqual(self.counters["bytes_read"], length)
+
+    def test_archives_are_not_counted_twice(self):
+        self.read_payloads(os.path.join(self.temp_dir, "a.zip"))
+        self.assertEqual(self.counters.get("bytes_read", 0), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the patch engine (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io, os, shutil, stat, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.regpatch as regpatch
+import psr9000.synth as synth
+
+PATCHES = [(40, bytearray(b"\x01\x02")), (100, bytearray(b"\xff"))]
+
+def file_mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def read_file(path):
+    registration_file = open(path, "rb")
+    data = registration_file.read()
+    registration_file.close()
+    return data
+
+class PatchFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "a.usr")
+        self.registration_path = os.path.join(self.input_dir, "Regist.reg")
+        synth.generate_backup(self.input_dir, bank_count=3, seed=1)
+        os.chmod(self.registration_path, 0o640)
+
+        self.original = read_file(self.registration_path)
+        banks = regbank.read_banks(self.input_dir)
+        self.amount = regpatch.patch_banks(banks, PATCHES)
+
+        expected = io.BytesIO()
+        regbank.write_registration_file(banks, expected)
+        self.expected = expected.getvalue()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_in_place(self):
+        self.assertEqual(regpatch.patch_file(self.input_dir, PATCHES), self.amount)
+        self.assertEqual(read_file(self.registration_path), self.expected)
+        self.assertEqual(sorted(os.listdir(self.input_dir)), ["Regist.reg", "USERFILE.INI"])
+
+    def test_in_place_keeps_mode(self):
+        regpatch.patch_file(self.input_dir, PATCHES)
+        self.assertEqual(file_mode(self.registration_path), 0o640)
+
+    def test_direct(self):
+        inode = os.stat(self.registration_path).st_ino
+
+        self.assertEqual(regpatch.patch_file(self.input_dir, PATCHES, direct=True), self.amount)
+        self.assertEqual(read_file(self.registration_path), self.expected)
+        self.assertEqual(os.stat(self.registration_path).st_ino, inode)
+
+    def test_output(self):
+        output_dir = os.path.join(self.temp_dir, "b.usr")
+
+        self.assertEqual(regpatch.patch_file(self.input_dir, PATCHES, output_dir), self.amount)
+        self.assertEqual(read_file(os.path.join(output_dir, "Regist.reg")), self.expected)
+        self.assertEqual(file_mode(os.path.join(output_dir, "Regist.reg")), 0o640)
+        self.assertEqual(read_file(self.registration_path), self.original)
+        self.assertEqual(
+            read_file(os.path.join(output_dir, "USERFILE.INI")),
+            read_file(os.path.join(self.input_dir, "USERFILE.INI")),
+        )
+
+    def test_nothing_to_patch(self):
+        inode = os.stat(self.registration_path).st_ino
+
+        regpatch.patch_file(self.input_dir, [])
+        self.assertEqual(os.stat(self.registration_path).st_ino, inode)
+        self.assertEqual(read_file(self.registration_path), self.original)
+
+    def test_invalid_patches_write_nothing(self):
+        self.assertRaises(ValueError, regpatch.patch_file, self.input_dir, [(10, bytearray(b"\x01"))])
+        self.assertEqual(read_file(self.registration_path), self.original)
+        self.assertEqual(sorted(os.listdir(self.input_dir)), ["Regist.reg", "USERFILE.INI"])
+
+def read_spec(text):
+    return regpatch.read_patch_spec(io.StringIO(text) if bytes is not str else io.BytesIO(text))
+
+class PatchSpecTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(read_spec(
+            "# Volume pedal\n"
+            "633|310f\n"
+            "\n"
+            " 0x280 | 02 \n"
+            "633|310f|640=02,0x281!=ff\n"
+        ), [
+            (633, bytearray(b"\x31\x0f"), []),
+            (0x280, bytearray(b"\x02"), []),
+            (633, bytearray(b"\x31\x0f"), [(640, bytearray(b"\x02"), True), (0x281, bytearray(b"\xff"), False)]),
+        ])
+
+    def test_syntax_errors(self):
+        for line in ("633", "633|31|640=02|x", "x|31", "633|3", "633|", "633|31|640", "633|31|640="):
+            self.assertRaises(ValueError, read_spec, line + "\n")
+
+    def test_invalid_patches(self):
+        self.assertRaises(ValueError, regpatch.check_patches, [(20, bytearray(b"\x01\x02"))])
+        self.assertRaises(ValueError, regpatch.check_patches, [(40, bytearray(b"\x01\x02")), (41, bytearray(b"\x03"))])
+        self.assertRaises(ValueError, regpatch.check_patches, [(40, bytearray(b"\x01"), [(10, bytearray(b"\x00"), True)])])
+
+        self.assertEqual(
+            regpatch.check_patches([(41, bytearray(b"\x03")), (39, bytearray(b"\x01\x02"))]),
+            [(39, bytearray(b"\x01\x02"), ()), (41, bytearray(b"\x03"), ())],
+        )
+
+numpy = regpatch.load_numpy()
+
+@unittest.skipUnless(numpy, "NumPy is not installed")
+class PatchMatrixTest(unittest.TestCase):
+
+    def registrations(self):
+        registrations = []
+
+        for number, length in enumerate((0, 1, 9, 13, 40, 41, 77, 40)):
+            data = bytearray((number * 7 + i) % 256 for i in range(length))
+            registrations.append(regbank.Registration(number % 8, False, "Reg %s" % number, length + 22, b"", data))
+
+        registrations[7].data[2] = 99
+        return registrations
+
+    def check(self, patches):
+        patches = regpatch.check_patches(patches)
+        expected = self.registrations()
+        amount = sum(regpatch.patch_registration(registration, patches) for registration in expected)
+        registrations = self.registrations()
+
+        self.assertEqual(regpatch.patch_matrix(registrations, patches), amount)
+        self.assertEqual(
+            [bytes(registration.data) for registration in registrations],
+            [bytes(registration.data) for registration in expected],
+        )
+
+    def test_unconditional(self):
+        self.check([(32, bytearray(b"\xaa")), (40, bytearray(b"\x01\x02\x03"))])
+
+    def test_patches_beyond_short_payloads(self):
+        self.check([(70, bytearray(b"\x05")), (104, bytearray(b"\x06\x07"))])
+
+    def test_conditions(self):
+        self.check([
+            (33, bytearray(b"\x10"), [(34, bytearray(b"\x63"), True)]),
+            (36, bytearray(b"\x11"), [(34, bytearray(b"\x63"), False)]),
+            (50, bytearray(b"\x12"), [(100, bytearray(b"\x00"), False)]),
+        ])
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the name index (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.regsearch as regsearch
+import psr9000.synth as synth
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+NAMES = ("Stand By Me", "Standard Piano", "Hey Jude")
+
+class NameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.backup = os.path.join(self.temp_dir, "a.usr")
+        self.broken = os.path.join(self.temp_dir, "broken.usr")
+
+        banks = synth.generate_banks(bank_count=2, filled=1.0, seed=1)
+
+        for registration, name in zip(banks[1].registrations, NAMES):
+            registration.name = name
+
+        regbank.write_banks(banks, self.backup)
+
+        os.mkdir(self.broken)
+
+        with open(os.path.join(self.broken, "Regist.reg"), "wb") as registration_file:
+            registration_file.write(b"garbage")
+
+        self.index = regsearch.NameIndex()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_results(self, results):
+        output_file = StringIO()
+        regsearch.write_results(results, output_file)
+        return output_file.getvalue()
+
+    def test_prefix_search(self):
+        self.index.update([self.backup])
+
+        self.assertEqual(self.write_results(self.index.search("stand")), (
+            "# %s\n"
+            "02|1|Stand By Me\n"
+            "02|2|Standard Piano\n"
+        ) % self.backup)
+
+        self.assertEqual(self.write_results(self.index.search("stand by")), (
+            "# %s\n"
+            "02|1|Stand By Me\n"
+        ) % self.backup)
+
+        self.assertEqual(self.index.search("stand jude"), [])
+
+    def test_fuzzy_search(self):
+        self.index.update([self.backup])
+
+        results = self.index.search("stnad by me", fuzzy=True)
+
+        self.assertEqual(self.write_results(results[:1]), (
+            "# %s\n"
+            "02|1|Stand By Me\n"
+        ) % self.backup)
+
+        self.assertTrue(all(score >= 0.5 for score, path, bank, registration, name in results))
+
+    def test_broken_backups_are_skipped(self):
+        self.assertEqual(self.index.update([self.broken, self.backup]), 1)
+        self.assertEqual(sorted(self.index.backups), [self.backup])
+        self.assertEqual([path for path, error in self.index.errors], [self.broken])
+        self.assertEqual(len(self.index.search("jude")), 1)
+
+    def test_backups_broken_later_are_removed(self):
+        self.index.update([self.backup])
+
+        with open(os.path.join(self.backup, "Regist.reg"), "wb") as registration_file:
+            registration_file.write(b"garbage")
+
+        self.index.update([])
+        self.assertEqual(self.index.backups, {})
+        self.assertEqual([path for path, error in self.index.errors], [self.backup])
+        self.assertEqual(self.index.search("jude"), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the registration store (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.instrument as instrument
+import psr9000.regstore as regstore
+import psr9000.synth as synth
+
+def map_registration(source, bank, registration, name):
+    return {
+        "empty": False, "source": source, "bank": bank,
+        "registration": registration, "name": name,
+    }
+
+class LoadMixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = regstore.RegistrationStore(os.path.join(self.temp_dir, "store"))
+        self.banks = {}
+
+        for name in ("a.usr", "b.usr"):
+            path = os.path.join(self.temp_dir, name)
+            self.banks[name] = synth.generate_backup(path, bank_count=2, seed=len(self.banks) + 1)
+            self.store.add_backup(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_mix_of_stored_backups(self):
+        registration_map = [{"number": 0, "name": b"Mix", "registrations": [
+            map_registration("a.usr", 0, 1, b"One"),
+            map_registration("b.usr", 1, 2, b"Two"),
+        ] + 6 * [{"empty": True}]}]
+
+        banks = self.store.load_mix(registration_map)
+        registrations = banks[0].registrations
+
+        self.assertEqual(registrations[0].data, self.banks["a.usr"][0].registrations[1].data)
+        self.assertEqual(registrations[1].data, self.banks["b.usr"][1].registrations[2].data)
+        self.assertEqual(registrations[1].name, b"Two")
+        self.assertTrue(registrations[2].empty)
+
+    def test_unqualified_registrations_need_a_backup(self):
+        registration_map = [{"number": 0, "name": b"Mix", "registrations": [
+            map_registration(None, 0, 1, b"One"),
+            map_registration("b.usr", 0, 1, b"Two"),
+        ]}]
+
+        self.assertRaises(KeyError, self.store.load_mix, registration_map)
+
+        banks = self.store.load_mix(registration_map, "a.usr")
+        self.assertEqual(banks[0].registrations[0].data, self.banks["a.usr"][0].registrations[1].data)
+        self.assertEqual(banks[0].registrations[1].data, self.banks["b.usr"][0].registrations[1].data)
+
+    def test_unknown_backup(self):
+        registration_map = [{"number": 0, "name": b"Mix", "registrations": [
+            map_registration("c.usr", 0, 1, b"One"),
+        ]}]
+
+        self.assertRaises(KeyError, self.store.load_mix, registration_map)
+
+    def test_bytes_read_are_counted(self):
+        counters = {}
+
+        def hook(event, name, value):
+            if event == "count":
+                counters[name] = counters.get(name, 0) + value
+
+        instrument.add_hook(hook)
+
+        try:
+            banks = self.store.load_backup("a.usr")
+        finally:
+            instrument.remove_hook(hook)
+
+        self.assertEqual(counters["bytes_read"], sum(
+            len(registration.data) for bank in banks for registration in bank.registrations
+        ))
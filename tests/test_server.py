@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the backup service (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.server as server
+import psr9000.synth as synth
+
+class BackupCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.backups = []
+
+        for name in ("a.usr", "b.usr", "c.zip"):
+            self.backups.append(os.path.join(self.temp_dir, name))
+            synth.generate_backup(self.backups[-1], bank_count=2, seed=len(self.backups))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_size_is_uncompressed(self):
+        cache = server.BackupCache()
+
+        with cache.use(self.backups[2]) as banks:
+            self.assertEqual(len(banks), 2)
+
+        entry = cache.entries[self.backups[2]]
+        self.assertEqual(cache.size, len(entry.source.buffer))
+        self.assertNotEqual(cache.size, os.path.getsize(self.backups[2]))
+
+    def test_eviction_closes_unused_entries(self):
+        cache = server.BackupCache(1)
+        first = cache.acquire(self.backups[0])
+        cache.release(first)
+        second = cache.acquire(self.backups[1])
+
+        self.assertTrue(first.evicted)
+        self.assertTrue(first.source._file is None)
+        self.assertEqual(cache.size, second.source.size)
+        cache.release(second)
+
+    def test_entries_in_use_stay_open(self):
+        cache = server.BackupCache(1)
+        first = cache.acquire(self.backups[0])
+        second = cache.acquire(self.backups[1])
+
+        self.assertTrue(first.evicted)
+        self.assertTrue(first.source._file is not None)
+        self.assertTrue(len(bytes(first.banks[0].registrations[0].head)) == 32)
+
+        cache.release(first)
+        self.assertTrue(first.source._file is None)
+        cache.release(second)
+        self.assertEqual(cache.metrics()["evictions"], 1)
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        for seed, name in enumerate(("a.usr", "b.zip")):
+            synth.generate_backup(os.path.join(self.temp_dir, name), bank_count=2, filled=1.0, seed=seed)
+
+        os.mkdir(os.path.join(self.temp_dir, "broken.usr"))
+
+        with open(os.path.join(self.temp_dir, "broken.usr", "Regist.reg"), "wb") as registration_file:
+            registration_file.write(b"garbage")
+
+        self.service = server.BackupService(self.temp_dir)
+        self.updates = []
+        update = self.service.names.update
+
+        def record_update(input_dirs, check_all=True):
+            self.updates.append(sorted(os.path.basename(path) for path in input_dirs))
+            return update(input_dirs, check_all)
+
+        self.service.names.update = record_update
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_broken_backups_are_reported(self):
+        results = self.service.search("reg 01-1")
+
+        self.assertEqual([result["backup"] for result in results], ["a.usr", "b.zip", "broken.usr"])
+        self.assertEqual(results[0]["name"], "REG 01-1")
+        self.assertTrue("error" in results[2])
+
+    def test_only_changed_backups_are_read(self):
+        self.service.search("reg")
+        self.service.search("reg")
+        self.assertEqual(self.updates, [["a.usr", "b.zip", "broken.usr"]])
+
+        synth.generate_backup(os.path.join(self.temp_dir, "b.zip"), bank_count=1, filled=1.0, seed=3)
+        shutil.rmtree(os.path.join(self.temp_dir, "a.usr"))
+
+        results = self.service.search("reg")
+        self.assertEqual(self.updates[1:], [["b.zip"]])
+        self.assertEqual(set(result["backup"] for result in results), set(["b.zip", "broken.usr"]))
+        self.assertEqual(len(results), 9)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the other user files (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, stat, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+import psr9000.userfiles as userfiles
+
+USERFILE_INI = (
+    "[TITLE]\r\n9000Pro USERFILE.INI\r\nYAMAHA Corporation\r\n"
+    "[STYLE]\r\nTOTAL FILE NUM:2\r\n1 = Swing.STY\r\n2 = Waltz.STY\r\n"
+    "[TOTAL USER DATA SIZE]\r\n100KB\r\n"
+    "[REGISTRATION]\r\nTOTAL FILE NUM:1\r\n1 = 01OLD.REG\r\n"
+    "[SONG]\r\nTOTAL FILE NUM:1\r\n1 = Song.MID\r\n"
+    "[DATAEND]\r\n"
+)
+
+class MergeUserfileIniTest(unittest.TestCase):
+
+    def test_untouched_sections_are_kept(self):
+        merged = userfiles.merge_userfile_ini(USERFILE_INI, regbank.userfile_ini(["01NEW.REG", "02NEW.REG"], 200))
+
+        self.assertEqual(merged, (
+            "[TITLE]\r\n9000Pro USERFILE.INI\r\nYAMAHA Corporation\r\n"
+            "[STYLE]\r\nTOTAL FILE NUM:2\r\n1 = Swing.STY\r\n2 = Waltz.STY\r\n"
+            "[TOTAL USER DATA SIZE]\r\n200KB\r\n"
+            "[REGISTRATION]\r\nTOTAL FILE NUM:2\r\n1 = 01NEW.REG\r\n2 = 02NEW.REG\r\n"
+            "[SONG]\r\nTOTAL FILE NUM:1\r\n1 = Song.MID\r\n"
+            "[DATAEND]\r\n"
+        ))
+
+    def test_missing_sections_are_added(self):
+        merged = userfiles.merge_userfile_ini(
+            "[TITLE]\r\n9000Pro USERFILE.INI\r\n[DATAEND]\r\n",
+            regbank.userfile_ini(["01NEW.REG"], 200),
+        )
+
+        self.assertEqual(merged, (
+            "[TITLE]\r\n9000Pro USERFILE.INI\r\n"
+            "[TOTAL USER DATA SIZE]\r\n200KB\r\n"
+            "[REGISTRATION]\r\nTOTAL FILE NUM:1\r\n1 = 01NEW.REG\r\n"
+            "[DATAEND]\r\n"
+        ))
+
+class CopyFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "input.usr")
+        self.banks = synth.generate_backup(self.input_dir, bank_count=2, seed=1)
+
+        with open(os.path.join(self.input_dir, "USERFILE.INI"), "wb") as config_file:
+            config_file.write(USERFILE_INI)
+
+        self.style_path = os.path.join(self.input_dir, "Swing.STY")
+
+        with open(self.style_path, "wb") as style_file:
+            style_file.write(b"style data" * 100)
+
+        os.chmod(self.style_path, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assertCopied(self, output_path):
+        with open(output_path, "rb") as output_file:
+            self.assertEqual(output_file.read(), b"style data" * 100)
+
+        self.assertEqual(stat.S_IMODE(os.stat(output_path).st_mode), 0o640)
+
+    def test_clone_file_fallbacks(self):
+        fcntl = userfiles.fcntl
+        userfiles.fcntl = None
+
+        try:
+            output_path = os.path.join(self.temp_dir, "hardlink.STY")
+            self.assertEqual(userfiles.clone_file(self.style_path, output_path), "hardlink")
+            self.assertTrue(os.path.samefile(self.style_path, output_path))
+
+            output_path = os.path.join(self.temp_dir, "copy.STY")
+            self.assertTrue(userfiles.clone_file(self.style_path, output_path, False) in ("copy_file_range", "copy"))
+            self.assertFalse(os.path.samefile(self.style_path, output_path))
+            self.assertCopied(output_path)
+        finally:
+            userfiles.fcntl = fcntl
+
+        output_path = os.path.join(self.temp_dir, "clone.STY")
+        self.assertTrue(userfiles.clone_file(self.style_path, output_path, False) in ("reflink", "copy_file_range", "copy"))
+        self.assertCopied(output_path)
+
+    def test_write_banks_keeps_user_files(self):
+        output_dir = os.path.join(self.temp_dir, "output.usr")
+        regbank.write_banks(self.banks[1:], output_dir, self.input_dir)
+
+        self.assertCopied(os.path.join(output_dir, "Swing.STY"))
+
+        with open(os.path.join(output_dir, "USERFILE.INI"), "rb") as config_file:
+            sections = userfiles.parse_userfile_ini(config_file.read())
+
+        self.assertEqual([section for section, lines in sections], [
+            "[TITLE]", "[STYLE]", "[TOTAL USER DATA SIZE]", "[REGISTRATION]", "[SONG]", "[DATAEND]",
+        ])
+        self.assertEqual(dict(sections)["[STYLE]"], ["TOTAL FILE NUM:2", "1 = Swing.STY", "2 = Waltz.STY"])
+        self.assertEqual(dict(sections)["[REGISTRATION]"][0], "TOTAL FILE NUM:1")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of the backup checks (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, struct, tempfile, unittest
+import psr9000.synth as synth
+import psr9000.verify as verify
+
+class VerifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "a.usr")
+        self.banks = synth.generate_backup(self.input_dir, bank_count=2, filled=1.0, seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def patch_registrations(self, offset, data):
+        registration_file = open(os.path.join(self.input_dir, "Regist.reg"), "r+b")
+        registration_file.seek(offset)
+        registration_file.write(data)
+        registration_file.close()
+
+    def messages(self, report):
+        return [(offset, message) for level, offset, message in report.errors()]
+
+    def test_valid_backup(self):
+        report = verify.verify_backup(self.input_dir)
+
+        self.assertEqual(report.problems, [])
+        self.assertEqual(report.banks, 2)
+        self.assertEqual(report.registrations, 16)
+        self.assertTrue(report.as_dict()["ok"])
+
+    def test_valid_archive(self):
+        archive_path = os.path.join(self.temp_dir, "a.zip")
+        synth.generate_backup(archive_path, bank_count=2, filled=1.0, seed=1)
+
+        self.assertEqual(verify.verify_backup(archive_path).problems, [])
+
+    def test_bank_outside_of_file(self):
+        self.patch_registrations(20, struct.pack(">l", 0x7fffffff))
+        report = verify.verify_backup(self.input_dir)
+
+        # The bank is left out, so USERFILE.INI lists one bank file too many
+        self.assertEqual(len(report.errors()), 2)
+        self.assertEqual(report.errors()[0][1], 0)
+        self.assertTrue("outside of the file" in report.errors()[0][2])
+        self.assertFalse(report.as_dict()["ok"])
+
+    def test_invalid_registration_header(self):
+        offset = self.banks[0].position + 48
+        self.patch_registrations(offset, b"XYZ001")
+
+        self.assertEqual(self.messages(verify.verify_backup(self.input_dir)), [
+            (offset, "Bank 1 has no registration header but %s" % repr(b"XYZ001")),
+        ])
+
+    def test_registration_exceeds_bank(self):
+        offset = self.banks[0].position + 48
+        self.patch_registrations(offset + 6, struct.pack(">l", self.banks[0].size))
+
+        self.assertEqual(self.messages(verify.verify_backup(self.input_dir)), [
+            (offset, "Bank 1: registration 1 with %s bytes exceeds the bank size" % self.banks[0].size),
+        ])
+
+    def test_missing_backup(self):
+        report = verify.verify_backup(os.path.join(self.temp_dir, "missing.usr"))
+
+        self.assertEqual(len(report.errors()), 1)
+        self.assertEqual(report.errors()[0][1], None)
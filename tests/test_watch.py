@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: tests of incremental backups (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, unittest
+import psr9000.regbank as regbank
+import psr9000.synth as synth
+import psr9000.watch as watch
+
+def read_file(path):
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+class IncrementalBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "input.usr")
+        self.output_dir = os.path.join(self.temp_dir, "output.usr")
+        synth.generate_backup(self.input_dir, bank_count=4, seed=1)
+
+        self.banks = regbank.read_banks(self.input_dir)
+        self.backup = watch.IncrementalBackup(self.output_dir, self.input_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assertWrittenLike(self, banks):
+        expected_dir = os.path.join(self.temp_dir, "expected.usr")
+        regbank.write_banks(banks, expected_dir, self.input_dir)
+
+        for name in ("Regist.reg", "USERFILE.INI"):
+            self.assertEqual(
+                read_file(os.path.join(self.output_dir, name)),
+                read_file(os.path.join(expected_dir, name)),
+            )
+
+        shutil.rmtree(expected_dir)
+
+    def test_only_changed_banks_are_written(self):
+        self.assertEqual(self.backup.update(self.banks), 4)
+        self.assertEqual(self.backup.update(self.banks), 0)
+
+        banks = list(self.banks)
+        banks[3] = regbank.Bank(3, banks[3].name, banks[3].position, banks[3].size)
+        banks[3].registrations = list(reversed(self.banks[3].registrations))
+
+        self.assertEqual(self.backup.update(banks), 1)
+        self.assertWrittenLike(banks)
+
+    def test_removed_banks(self):
+        self.backup.update(self.banks)
+
+        self.assertEqual(self.backup.update(self.banks[1:]), 3)
+        self.assertWrittenLike(self.banks[1:])
+
+        self.assertEqual(self.backup.update(self.banks), 4)
+        self.assertWrittenLike(self.banks)
+
+    def test_failed_update_writes_everything_again(self):
+        self.backup.update(self.banks)
+        write_bank = regbank.write_bank
+
+        def fail(*args):
+            raise IOError("No space left on device")
+
+        regbank.write_bank = fail
+
+        try:
+            self.assertRaises(IOError, self.backup.update, self.banks[1:])
+        finally:
+            regbank.write_bank = write_bank
+
+        self.assertEqual(self.backup.layout, [])
+        self.assertEqual(self.backup.update(self.banks), 4)
+        self.assertWrittenLike(self.banks)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+#encoding=utf-8
+# psr-tools: verify_regs (http://www.patk.org)
+# Copyright (C) 2011  Dennis Schulmeister <dennis@patk.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, sys, time
+import psr9000.batch as batch
+import psr9000.verify as verify
+
+def write_text(result, stream, warnings=False):
+    '''
+    Prints the result of a backup as one line plus one line per problem.
+    '''
+    if result["ok"]:
+        stream.write("OK      %s\n" % result["backup"])
+    else:
+        stream.write("FAILED  %s\n" % result["backup"])
+
+    for problem in result["problems"]:
+        if problem["level"] == "warning" and not warnings:
+            continue
+
+        if problem["offset"] is None:
+            location = "-"
+        else:
+            location = "0x%06x" % problem["offset"]
+
+        stream.write("        %-7s %-12s %s\n" % (problem["level"], location, problem["message"]))
+
+if __name__ == "__main__":
+    cmd_parser = argparse.ArgumentParser(
+        prog        = "psr-tools: verify_regs",
+        description = "Fast structural check of PSR-9000 user data backups"
+    )
+
+    cmd_parser.add_argument(
+        "-i", "--input",
+        nargs   = "+",
+        help    = "Names of user data backups or patterns like \"backups/*.usr\"",
+    )
+
+    cmd_parser.add_argument(
+        "-r", "--report",
+        help    = "Also write a JSON report with all problems to this file (- for StdOut)",
+    )
+
+    cmd_parser.add_argument(
+        "-w", "--warnings",
+        action  = "store_true",
+        default = False,
+        help    = "Also print warnings, not just errors",
+    )
+
+    cmd_parser.add_argument(
+        "-j", "--jobs",
+        type    = int,
+        default = 0,
+        help    = "Number of worker processes (0 = one per CPU, the default)",
+    )
+
+    cmd_arguments = cmd_parser.parse_args()
+
+    if not cmd_arguments.input:
+        sys.exit("Missing --input option is always required")
+
+    inputs = batch.expand_inputs(cmd_arguments.input)
+    start = time.time()
+    results = []
+
+    if cmd_arguments.report == "-":
+        text_stream = sys.stderr
+    else:
+        text_stream = sys.stdout
+
+    for result in verify.verify_backups(inputs, cmd_arguments.jobs):
+        write_text(result, text_stream, cmd_arguments.warnings)
+        results.append(result)
+
+    failed = len([result for result in results if not result["ok"]])
+
+    text_stream.write("\n%s backups verified, %s failed in %.2f seconds\n" % (
+        len(results), failed, time.time() - start,
+    ))
+
+    if cmd_arguments.report:
+        report = {
+            "backups": len(results),
+            "failed": failed,
+            "results": results,
+        }
+
+        if cmd_arguments.report == "-":
+            report_file = sys.stdout
+        else:
+            report_file = open(cmd_arguments.report, "w")
+
+        json.dump(report, report_file, indent=1, sort_keys=True)
+        report_file.write("\n")
+
+        if cmd_arguments.report != "-":
+            report_file.close()
+
+    if failed:
+        sys.exit(1)